@@ -0,0 +1,409 @@
+"""asyncio flavour of the funding bot: one event loop drives every symbol of every account
+
+    python3 async_bot.py
+
+runs a bot for every account in the web app's settings table (HOST_DB_PATH) if it exists,
+or the one in settings.py otherwise. the bots share one aiohttp session, and their requests
+are in flight together instead of queueing behind each other on threads. needs aiohttp
+"""
+
+import asyncio
+from datetime import datetime
+import os
+import signal
+from time import perf_counter
+
+from market_maker.async_bitmex import AsyncBitMEX, aiohttp
+from market_maker.market_maker import ExchangeInterface, log_cancel
+from market_maker.settings import settings
+from market_maker.utils import log
+
+from bot import FundingBot
+from funding import FundingScheduler
+import host
+from journal import Journal
+from snapshot import SnapshotWriter
+import strat
+
+
+logger = log.setup_custom_logger('async')
+
+
+class AsyncFundingBot(FundingBot):
+    """FundingBot whose requests are awaited on an event loop
+
+    planning (plan, stop_orders, entry_order, ...) is FundingBot's; only the parts that talk to
+    the exchange are coroutines. build one with `await AsyncFundingBot.create()`
+    """
+
+    def __init__(self, exchange: ExchangeInterface, config=None, session=None,
+                 name: str = 'fundingbot') -> None:
+        self.settings = config or settings
+
+        self.session = session
+
+        self.name = name
+
+        self.logger = log.setup_custom_logger(name, log_level=self.settings.LOG_LEVEL)
+
+        self.journal = Journal.open(self.settings.JOURNAL_PATH) if self.settings.JOURNAL_PATH else None
+
+        self.running = True
+
+        self.exchange = exchange
+
+        self.load_state()
+
+        self.export_metrics()
+
+        # listeners run on the event loop, so they can wake it directly
+        self.wakeup = asyncio.Event()
+
+    @classmethod
+    async def create(cls, config=None, session=None, name: str = 'fundingbot') -> 'AsyncFundingBot':
+        config = config or settings
+
+        bot = cls(await cls.open_exchange(config, session), config, session, name)
+
+        if not await bot.resume():
+            await bot.cancel_open_orders()
+
+        return bot
+
+    @staticmethod
+    async def open_exchange(config, session) -> ExchangeInterface:
+        connector = AsyncBitMEX(base_url=config.BASE_URL, symbols=config.SYMBOL.split('|'),
+                                apiKey=config.API_KEY, apiSecret=config.API_SECRET,
+                                orderIDPrefix=config.ORDERID_PREFIX, postOnly=config.POST_ONLY,
+                                timeout=config.TIMEOUT, session=session, max_retries=config.API_MAX_RETRIES)
+
+        await connector.connect()
+
+        return ExchangeInterface(config=config, connector=connector)
+
+    async def monitor(self) -> None:
+        tick = self.note_quotes()
+
+        to_amend = []
+        to_create = []
+        to_cancel = []
+
+        for state in self.symbols.values():
+            self.plan(state, to_amend, to_create, to_cancel)
+
+        # the batches touch different orders, so they can all be in flight at once
+        jobs = []
+
+        if to_amend:
+            jobs.append(self._amend_orders(to_amend))
+
+        if to_create:
+            created = asyncio.ensure_future(self._create_orders(to_create))
+
+            jobs.append(created)
+
+        if to_cancel:
+            jobs.append(self._cancel_orders(to_cancel))
+
+        await asyncio.gather(*jobs)
+
+        if to_amend and tick is not None:
+            self.exchange.bitmex.latency.record('quote_to_amend', perf_counter() - tick)
+
+        if to_create and not created.result():
+            self.replan(to_create)
+
+        self.save_state()
+
+    async def enter_position(self, side: str, trade_quantity: int, market=False, symbol: str = None) -> None:
+        state = self.get_state(symbol)
+
+        await self._create_orders([self.entry_order(state, side, trade_quantity, market)])
+
+        state.could_hedge = False
+
+    async def exit_position(self, market=False, wait_for_fill=False, symbol: str = None) -> None:
+        state = self.get_state(symbol)
+
+        order = self.exit_order(state, market)
+
+        if order is None:
+            return
+
+        await self._create_orders([order])
+
+        if wait_for_fill and not market and not await self.wait_until_flat(state, self.settings.EXIT_FILL_TIMEOUT):
+            if not self.running:
+                return
+
+            self.logger.warning('%s exit not filled after %is, closing at market' %
+                                (state.symbol, self.settings.EXIT_FILL_TIMEOUT))
+
+            await self.cancel_open_orders(state.symbol)
+
+            order = self.exit_order(state, market=True)
+
+            if order is not None:
+                await self._create_orders([order])
+
+        state.hedge_exists = False
+
+    async def wait_until_flat(self, state, timeout: float = None) -> bool:
+        loop = asyncio.get_running_loop()
+
+        deadline = None if timeout is None else loop.time() + timeout
+
+        while self.running:
+            remaining = None if deadline is None else deadline - loop.time()
+
+            if remaining is not None and remaining <= 0:
+                return False
+
+            if await self.exchange.bitmex.wait_for_position(state.symbol, 0, remaining):
+                return True
+
+            if not self.exchange.is_open():
+                await asyncio.sleep(1)
+
+        return False
+
+    async def hedge(self, side: str, market=False, symbol: str = None) -> None:
+        await self._create_orders([self.hedge_order(self.get_state(symbol), side, market)])
+
+    async def cancel_open_orders(self, symbol: str = None) -> None:
+        self.logger.info('cancelling all open orders%s' % (' for ' + symbol if symbol else ''))
+
+        open_orders = self.exchange.bitmex.open_orders(symbol)
+
+        if not open_orders:
+            self.logger.info(' ~ no open orders')
+            return
+
+        try:
+            if symbol is None:
+                # like cancel_all_orders, catch anything the websocket hasn't shown us yet
+                open_orders = await self.exchange.bitmex.http_open_orders()
+
+            await self._cancel_orders(open_orders)
+        except Exception as e:
+            self.logger.error('unable to cancel orders: %s', e)
+
+        for state in self.symbols.values():
+            if symbol is None or state.symbol == symbol:
+                state.limits_exist = False
+
+    async def shutdown(self) -> None:
+        self.logger.info('shutting down, all open orders will be cancelled')
+
+        self.stop()
+
+        await self.cancel_open_orders()
+
+        self.save_state()
+
+        if self.snapshot_path is not None:
+            # other accounts' bots are still on this loop
+            await asyncio.get_running_loop().run_in_executor(None, SnapshotWriter.open().flush)
+
+        await self.exchange.bitmex.close()
+
+        self.unexport_metrics()
+
+    async def run_loop(self) -> None:
+        while self.running:
+            if not self.exchange.is_open():
+                self.logger.error('realtime data connection has closed, reloading')
+
+                await self.reload()
+
+                continue
+
+            self.sanity_check()
+
+            if (datetime.utcnow() - self.last_status).total_seconds() >= 10:
+                self.print_status()
+
+                self.last_status = datetime.utcnow()
+
+            await self.monitor()
+
+            if self.settings.EVENT_DRIVEN:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.settings.LOOP_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+                self.wakeup.clear()
+            else:
+                await asyncio.sleep(self.settings.LOOP_INTERVAL)
+
+    async def resume(self) -> bool:
+        stale = self.check_snapshot()
+
+        if stale is None:
+            return False
+
+        if stale:
+            await self._cancel_orders(stale)
+
+        self.save_state()
+
+        return True
+
+    async def reload(self) -> None:
+        self.logger.info('reloading data connection...')
+
+        snapshot = self.snapshot()
+
+        while self.running:
+            try:
+                await self.exchange.bitmex.reconnect()
+            except Exception as e:
+                self.logger.error(e)
+                self.logger.error('attempting to reload in 3 seconds...')
+
+                await asyncio.sleep(3)
+            else:
+                break
+
+        self.add_listeners()
+
+        stale = self.reconcile(snapshot)
+
+        if stale:
+            await self._cancel_orders(stale)
+
+        self.save_state()
+
+    async def _create_orders(self, orders) -> bool:
+        start = perf_counter()
+
+        try:
+            await self.exchange.bitmex.create_bulk_orders(orders)
+        except Exception as e:
+            self.logger.error('unable to create orders: %s' % e)
+
+            return False
+        finally:
+            self.exchange.bitmex.latency.record('create_orders', perf_counter() - start)
+
+        return True
+
+    async def _amend_orders(self, orders) -> None:
+        start = perf_counter()
+
+        try:
+            await self.exchange.bitmex.amend_bulk_orders(orders)
+        except Exception as e:
+            if getattr(e, 'status', None) == 400:
+                self.logger.info(' ~ order has already been fulfilled')
+            else:
+                self.logger.error('unable to amend orders: %s' % e)
+        finally:
+            self.exchange.bitmex.latency.record('amend_orders', perf_counter() - start)
+
+    async def _cancel_orders(self, orders) -> None:
+        for order in orders:
+            log_cancel(order, self.exchange.get_instrument(order['symbol'])['tickLog'])
+
+        try:
+            results = await self.exchange.bitmex.cancel([order['orderID'] for order in orders])
+        except Exception as e:
+            self.logger.error('unable to cancel orders: %s' % e)
+            return
+
+        for order_id, error in self.exchange.unconfirmed_cancels(results).items():
+            self.logger.error('unable to cancel order %s: %s' % (order_id, error))
+
+
+async def half_funding(bot: AsyncFundingBot, symbol: str) -> None:
+    """strat.half_funding, awaited"""
+
+    state = bot.get_state(symbol)
+
+    state.could_hedge = False
+
+    await bot.exit_position(market=False, wait_for_fill=True, symbol=symbol)
+
+    await bot.cancel_open_orders(symbol)
+
+    funding_rate = bot.get_funding_rate(symbol)
+
+    logger.info('%s funding rate: %.4f%%' % (symbol, funding_rate * 100))
+
+    if funding_rate < 0:
+        await bot.enter_position('Buy', state.size_buy, market=False, symbol=symbol)
+    else:
+        await bot.enter_position('Sell', state.size_sell, market=False, symbol=symbol)
+
+
+async def funding_over(bot: AsyncFundingBot, symbol: str) -> None:
+    """strat.funding_over, awaited"""
+
+    await bot.exit_position(market=False, wait_for_fill=True, symbol=symbol)
+
+
+def spawn(job, bot: AsyncFundingBot, symbol: str) -> None:
+    asyncio.ensure_future(job(bot, symbol))
+
+
+async def run(configs: dict) -> None:
+    """run a bot for each name -> settings in configs until they're all stopped"""
+
+    async with aiohttp.ClientSession() as session:
+        names = list(configs)
+
+        results = await asyncio.gather(*(AsyncFundingBot.create(configs[name], session, name)
+                                         for name in names), return_exceptions=True)
+
+        bots = []
+
+        for name, result in zip(names, results):
+            if isinstance(result, BaseException):
+                logger.error('unable to start %s: %s' % (name, result))
+            else:
+                bots.append(result)
+
+        scheduler = FundingScheduler()
+
+        for bot in bots:
+            strat.schedule_funding(scheduler, bot, jobs=(half_funding, funding_over), run=spawn)
+
+        loop = asyncio.get_running_loop()
+
+        for sig in [signal.SIGTERM, signal.SIGINT]:
+            loop.add_signal_handler(sig, lambda: [bot.stop() for bot in bots])
+
+        scheduled = asyncio.ensure_future(scheduler.run_async())
+
+        async def run_bot(bot: AsyncFundingBot) -> None:
+            # one account failing shouldn't take the others down with it
+            try:
+                await bot.run_loop()
+            except Exception as e:
+                bot.logger.error('bot exiting with exception: %s' % e)
+
+                bot.stop()
+
+        try:
+            await asyncio.gather(*(run_bot(bot) for bot in bots))
+        finally:
+            scheduler.stop()
+
+            await scheduled
+
+            await asyncio.gather(*(bot.shutdown() for bot in bots), return_exceptions=True)
+
+
+def main() -> None:
+    if os.path.exists(settings.HOST_DB_PATH):
+        configs = {'fundingbot%i' % account_id: host.account_settings(account)
+                   for account_id, account in host.load_accounts(settings.HOST_DB_PATH).items()}
+    else:
+        configs = {'fundingbot': settings}
+
+    asyncio.run(run(configs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,459 @@
+"""backtest the funding strategy on historical funding rates and prices
+
+    python3 backtest.py --funding funding.csv --prices trades.csv
+    python3 backtest.py --synthetic 365
+
+funding files need timestamp, symbol and fundingRate columns (bitmex's funding history).
+price files are either bars (timestamp, symbol, open, high, low, close) or trades
+(timestamp, symbol, price), which are bucketed into one-minute bars. csv or parquet (needs
+pyarrow); timestamps are iso 8601 or epoch seconds
+
+strategy settings (POSITION_SIZE_*, HEDGE*, STOP_*, FUNDING_*) come from settings.py, and
+every funding event of every symbol is simulated at once as numpy arrays, following the bot:
+
+    - FUNDING_ENTRY_LEAD before funding, exit anything open and enter: long if the rate is
+      negative, short otherwise (strat.half_funding)
+    - stop limit and stop market orders STOP_LIMIT_MULTIPLIER / STOP_MARKET_MULTIPLIER away
+      from the entry (FundingBot.stop_orders); if either is touched, the position is closed
+      there and pays no funding
+    - FUNDING_EXIT_DELAY after funding, exit (strat.funding_over)
+    - with HEDGE, whenever flat after a position, hold a hedge on HEDGE_SIDE until the next
+      entry (FundingBot.hedge_order)
+
+fills are at the bar price of the moment the bot would act, with maker fees on limit orders
+and taker fees on stops. pnl is in xbt
+"""
+
+import argparse
+import csv
+import time
+
+import numpy as np
+
+from market_maker.ws.history import parse_timestamp
+
+from bot import per_symbol
+from funding import MIN_FLAT
+
+
+# taker fee and maker rebate, as a fraction of the value traded
+TAKER_FEE = 0.00075
+MAKER_FEE = -0.00025
+
+# how a contract's value in xbt moves with its price: inverse contracts (XBTUSD) are worth
+# multiplier / price each, quanto ones (ETHUSD) price * multiplier
+CONTRACTS = {'XBTUSD': ('inverse', 1.0), 'ETHUSD': ('quanto', 0.000001)}
+
+# bucket size trades are turned into bars at
+BAR_SECONDS = 60
+
+
+class Market:
+    """one symbol's history as arrays: its funding events and its price bars"""
+
+    def __init__(self, symbol: str, funding_times, funding_rates, times, open_, high, low) -> None:
+        self.symbol = symbol
+
+        self.funding_times = np.asarray(funding_times, dtype=np.float64)
+        self.funding_rates = np.asarray(funding_rates, dtype=np.float64)
+
+        # bar open times, in epoch seconds
+        self.times = np.asarray(times, dtype=np.float64)
+
+        self.open = np.asarray(open_, dtype=np.float64)
+        self.high = np.asarray(high, dtype=np.float64)
+        self.low = np.asarray(low, dtype=np.float64)
+
+        self.kind, self.multiplier = CONTRACTS.get(symbol, ('inverse', 1.0))
+
+    def value(self, quantity, price):
+        """value in xbt of a quantity of contracts"""
+
+        if self.kind == 'inverse':
+            return quantity * self.multiplier / price
+
+        return quantity * price * self.multiplier
+
+    def pnl(self, quantity, entry, exit_):
+        """xbt made by a position of signed quantity from entry to exit price"""
+
+        if self.kind == 'inverse':
+            return quantity * self.multiplier * (1 / entry - 1 / exit_)
+
+        return quantity * self.multiplier * (exit_ - entry)
+
+
+def parameters(config, symbol: str) -> dict:
+    """the strategy settings for one symbol, split across config.SYMBOL like the bot splits them"""
+
+    symbols = config.SYMBOL.split('|')
+
+    if symbol not in symbols:
+        raise ValueError('%s is not one of the symbols in the settings (%s)' % (symbol, config.SYMBOL))
+
+    return {
+        'size_buy': per_symbol(config.POSITION_SIZE_BUY, symbols, int)[symbol],
+        'size_sell': per_symbol(config.POSITION_SIZE_SELL, symbols, int)[symbol],
+        'hedge': bool(config.HEDGE),
+        'hedge_side': per_symbol(config.HEDGE_SIDE, symbols)[symbol],
+        'hedge_multiplier': float(config.HEDGE_MULTIPLIER),
+        'stop_limit': float(config.STOP_LIMIT_MULTIPLIER or 0),
+        'stop_market': float(config.STOP_MARKET_MULTIPLIER or 0),
+        'lead': float(config.FUNDING_ENTRY_LEAD),
+        'delay': float(config.FUNDING_EXIT_DELAY or 0),
+    }
+
+
+def first_hit(hit):
+    """index of the first True in each row, and whether there is one"""
+
+    return np.argmax(hit, axis=1), hit.any(axis=1)
+
+
+def simulate(market: Market, params: dict, balance: float = 1.0) -> dict:
+    """every funding event of one market at once; returns per-event arrays"""
+
+    times, funding, rates = market.times, market.funding_times, market.funding_rates
+
+    lead = params['lead']
+
+    # like the scheduler, never before the previous exit
+    if len(funding) > 1:
+        lead = min(lead, float(np.median(np.diff(funding))) - params['delay'] - MIN_FLAT)
+
+    # only events whose whole entry-to-exit window has bars
+    inside = (funding - lead >= times[0]) & (funding + params['delay'] < times[-1])
+
+    funding, rates = funding[inside], rates[inside]
+
+    entry_bar = np.searchsorted(times, funding - lead)
+    funding_bar = np.minimum(np.searchsorted(times, funding), len(times) - 1)
+    exit_bar = np.minimum(np.searchsorted(times, funding + params['delay']), len(times) - 1)
+
+    entry_price = market.open[entry_bar]
+    exit_price = market.open[exit_bar]
+    funding_price = market.open[funding_bar]
+
+    # half_funding: negative funding pays longs
+    side = np.where(rates < 0, 1.0, -1.0)
+    quantity = side * np.where(rates < 0, params['size_buy'], params['size_sell'])
+
+    # the bars each position is open for, one row per event; past the exit is masked off
+    width = int((exit_bar - entry_bar).max()) if len(funding) else 0
+    width = max(width, 1)
+
+    window = entry_bar[:, None] + np.arange(width)
+
+    open_for = window < exit_bar[:, None]
+
+    window = np.minimum(window, len(times) - 1)
+
+    # the adverse extreme of each bar, signed so a move against the position is always down
+    adverse = np.where(side[:, None] > 0, market.low[window], -market.high[window])
+
+    stopped = np.zeros(len(funding), dtype=bool)
+    stop_bar = exit_bar.copy()
+    stop_price = exit_price.copy()
+
+    market_stop = np.zeros(len(funding), dtype=bool)
+
+    if params['stop_market'] > 0:
+        stop_px = entry_price * (1 - side * params['stop_market'])
+
+        index, hit = first_hit(open_for & (adverse <= (side * stop_px)[:, None]))
+
+        stopped, market_stop = hit, hit
+        stop_bar = np.where(hit, entry_bar + index, stop_bar)
+        stop_price = np.where(hit, stop_px, stop_price)
+
+    if params['stop_limit'] > 0:
+        stop_px = entry_price * (1 - side * params['stop_limit'])
+
+        index, hit = first_hit(open_for & (adverse <= (side * stop_px)[:, None]))
+
+        # the limit sits a tick inside the stop, so it fills unless the market stop was hit
+        # on the same bar or earlier, i.e. price gapped through both
+        limit = hit & ~(market_stop & (stop_bar <= entry_bar + index))
+
+        stopped = stopped | limit
+        stop_bar = np.where(limit, entry_bar + index, stop_bar)
+        stop_price = np.where(limit, stop_px, stop_price)
+
+    close_price = np.where(stopped, stop_price, exit_price)
+
+    price_pnl = market.pnl(quantity, entry_price, close_price)
+
+    # longs pay shorts when the rate is positive; stopped positions are gone by funding
+    funding_pnl = np.where(stopped, 0.0, -rates * side * market.value(np.abs(quantity), funding_price))
+
+    fees = (MAKER_FEE * market.value(np.abs(quantity), entry_price) +
+            np.where(stopped, TAKER_FEE, MAKER_FEE) * market.value(np.abs(quantity), close_price))
+
+    hedge_pnl = np.zeros(len(funding))
+
+    if params['hedge']:
+        hedge_side = 1.0 if params['hedge_side'] == 'Buy' else -1.0
+
+        # hedge_order: sized on the balance (held at the starting one here) and price
+        def hedge(start, end, funding_paid):
+            quantity = hedge_side * np.floor((balance - .1) * params['hedge_multiplier'] * start)
+
+            pnl = market.pnl(quantity, start, end)
+
+            pnl -= MAKER_FEE * (market.value(np.abs(quantity), start) + market.value(np.abs(quantity), end))
+
+            return pnl - funding_paid * hedge_side * market.value(np.abs(quantity), funding_price)
+
+        # after a stop, until funding_over exits it; stopped before funding, it pays funding
+        hedge_pnl += np.where(stopped, hedge(stop_price, exit_price, np.where(stop_bar <= funding_bar, rates, 0)), 0)
+
+        # after each exit, until the next entry exits it. no funding falls in between, and the
+        # last one is still open
+        between = hedge(exit_price, np.append(entry_price[1:], exit_price[-1:]), 0)
+
+        hedge_pnl[:-1] += between[:-1]
+
+    return {
+        'symbol': market.symbol,
+        'funding_time': funding,
+        'rate': rates,
+        'quantity': quantity,
+        'entry_price': entry_price,
+        'close_price': close_price,
+        'stopped': stopped,
+        'price_pnl': price_pnl,
+        'funding_pnl': funding_pnl,
+        'fees': fees,
+        'hedge_pnl': hedge_pnl,
+        'pnl': price_pnl + funding_pnl - fees + hedge_pnl,
+    }
+
+
+def backtest(markets: dict, config, balance: float = 1.0) -> dict:
+    """simulate every market with the settings in config; returns per-symbol results and totals"""
+
+    results = {symbol: simulate(market, parameters(config, symbol), balance)
+               for symbol, market in markets.items()}
+
+    return {'results': results, 'summary': summarize(results, balance)}
+
+
+def summarize(results: dict, balance: float = 1.0) -> dict:
+    times = np.concatenate([r['funding_time'] for r in results.values()])
+    pnl = np.concatenate([r['pnl'] for r in results.values()])
+
+    # symbols funding at the same moment count as one step of the equity curve
+    moments, step = np.unique(times, return_inverse=True)
+
+    equity = balance + np.cumsum(np.bincount(step, weights=pnl, minlength=len(moments)))
+
+    peak = np.maximum.accumulate(np.concatenate(([balance], equity)))[1:]
+
+    return {
+        'events': len(pnl),
+        'stops': int(sum(r['stopped'].sum() for r in results.values())),
+        'pnl': float(pnl.sum()),
+        'funding': float(sum(r['funding_pnl'].sum() for r in results.values())),
+        'price': float(sum(r['price_pnl'].sum() for r in results.values())),
+        'hedge': float(sum(r['hedge_pnl'].sum() for r in results.values())),
+        'fees': float(sum(r['fees'].sum() for r in results.values())),
+        'max_drawdown': float(((peak - equity) / peak).max()) if len(equity) else 0.0,
+    }
+
+
+#
+# loading
+#
+
+def read_table(path: str) -> dict:
+    """column name -> list of values, from a csv or parquet file"""
+
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('reading parquet needs pyarrow: pip install pyarrow')
+
+        return pyarrow.parquet.read_table(path).to_pydict()
+
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+
+    return {column: [row[column] for row in rows] for column in (rows[0] if rows else [])}
+
+
+def epoch(values) -> np.ndarray:
+    values = list(values)
+
+    if values and isinstance(values[0], str) and not values[0].replace('.', '', 1).isdigit():
+        return np.array([parse_timestamp(v) for v in values])
+
+    if values and hasattr(values[0], 'timestamp'):
+        return np.array([v.timestamp() for v in values])
+
+    return np.asarray(values, dtype=np.float64)
+
+
+def split(table: dict, symbol_column: str = 'symbol') -> dict:
+    """symbol -> indices of its rows"""
+
+    symbols = np.asarray(table[symbol_column])
+
+    return {symbol: np.flatnonzero(symbols == symbol) for symbol in np.unique(symbols)}
+
+
+def load_funding(path: str) -> dict:
+    """symbol -> (times, rates), sorted by time"""
+
+    table = read_table(path)
+
+    times = epoch(table['timestamp'])
+    rates = np.asarray(table['fundingRate'], dtype=np.float64)
+
+    funding = {}
+
+    for symbol, rows in split(table).items():
+        order = rows[np.argsort(times[rows], kind='stable')]
+
+        funding[symbol] = (times[order], rates[order])
+
+    return funding
+
+
+def bars_from_trades(times, prices, seconds: int = BAR_SECONDS) -> tuple:
+    """bucket trades into (times, open, high, low) bars; empty buckets carry the last price"""
+
+    order = np.argsort(times, kind='stable')
+
+    times, prices = times[order], prices[order]
+
+    bucket = (times // seconds).astype(np.int64)
+
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+
+    first, last = bucket[0], bucket[-1]
+
+    bar_open = np.full(last - first + 1, np.nan)
+    bar_high = np.full(last - first + 1, np.nan)
+    bar_low = np.full(last - first + 1, np.nan)
+    bar_close = np.full(last - first + 1, np.nan)
+
+    slots = bucket[starts] - first
+
+    bar_open[slots] = prices[starts]
+    bar_high[slots] = np.maximum.reduceat(prices, starts)
+    bar_low[slots] = np.minimum.reduceat(prices, starts)
+    bar_close[slots] = prices[np.r_[starts[1:], len(prices)] - 1]
+
+    # forward fill empty buckets with the previous close
+    filled = np.where(np.isnan(bar_open), 0, np.arange(len(bar_open)))
+    np.maximum.accumulate(filled, out=filled)
+
+    previous = bar_close[filled]
+
+    empty = np.isnan(bar_open)
+
+    bar_open[empty] = bar_high[empty] = bar_low[empty] = previous[empty]
+
+    return (first + np.arange(len(bar_open))) * float(seconds), bar_open, bar_high, bar_low
+
+
+def load_prices(path: str) -> dict:
+    """symbol -> (times, open, high, low) bars"""
+
+    table = read_table(path)
+
+    times = epoch(table['timestamp'])
+
+    prices = {}
+
+    for symbol, rows in split(table).items():
+        if 'open' in table:
+            order = rows[np.argsort(times[rows], kind='stable')]
+
+            prices[symbol] = (times[order],
+                              np.asarray(table['open'], dtype=np.float64)[order],
+                              np.asarray(table['high'], dtype=np.float64)[order],
+                              np.asarray(table['low'], dtype=np.float64)[order])
+        else:
+            prices[symbol] = bars_from_trades(times[rows], np.asarray(table['price'], dtype=np.float64)[rows])
+
+    return prices
+
+
+def load_markets(funding_path: str, prices_path: str, symbols: list = None) -> dict:
+    funding = load_funding(funding_path)
+    prices = load_prices(prices_path)
+
+    symbols = symbols or sorted(set(funding) & set(prices))
+
+    return {symbol: Market(symbol, *funding[symbol], *prices[symbol]) for symbol in symbols}
+
+
+def synthetic_markets(days: int, symbols: list, seed: int = 0) -> dict:
+    """random-walk minute bars and 8-hourly funding, for trying the engine out"""
+
+    random = np.random.default_rng(seed)
+
+    start = 1546300800.0  # 2019-01-01 00:00 utc
+
+    times = start + np.arange(days * 24 * 60) * 60.0
+
+    markets = {}
+
+    for i, symbol in enumerate(symbols):
+        price = (10000.0 if symbol == 'XBTUSD' else 200.0) * np.exp(
+                np.cumsum(random.normal(0, 0.0008, len(times))))
+
+        noise = np.abs(random.normal(0, 0.0004, len(times)))
+
+        # bitmex funds at 04:00, 12:00 and 20:00 utc
+        funding_times = start + 4 * 3600 + np.arange(days * 3) * 8 * 3600.0
+        funding_rates = random.normal(0.0001, 0.0004, len(funding_times))
+
+        markets[symbol] = Market(symbol, funding_times, funding_rates, times,
+                                 price, price * (1 + noise), price * (1 - noise))
+
+    return markets
+
+
+def main() -> None:
+    from market_maker.settings import settings
+
+    parser = argparse.ArgumentParser(description='backtest the funding strategy with the settings in settings.py')
+    parser.add_argument('--funding', help='funding history (csv or parquet)')
+    parser.add_argument('--prices', help='bars or trades (csv or parquet)')
+    parser.add_argument('--synthetic', type=int, metavar='DAYS', help='use random data instead')
+    parser.add_argument('--symbols', help="e.g. 'XBTUSD|ETHUSD'; defaults to settings.SYMBOL")
+    parser.add_argument('--balance', type=float, default=1.0, help='starting balance in xbt')
+    args = parser.parse_args()
+
+    symbols = (args.symbols or settings.SYMBOL).split('|')
+
+    if args.synthetic:
+        markets = synthetic_markets(args.synthetic, symbols)
+    elif args.funding and args.prices:
+        markets = load_markets(args.funding, args.prices, symbols)
+    else:
+        parser.error('give --funding and --prices, or --synthetic')
+
+    start = time.perf_counter()
+
+    result = backtest(markets, settings, args.balance)
+
+    elapsed = time.perf_counter() - start
+
+    for symbol, r in result['results'].items():
+        print('%-8s %5i events, %4i stopped, pnl %+.6f (funding %+.6f, hedge %+.6f)' %
+              (symbol, len(r['pnl']), r['stopped'].sum(), r['pnl'].sum(), r['funding_pnl'].sum(), r['hedge_pnl'].sum()))
+
+    summary = result['summary']
+
+    print('total    pnl %+.6f xbt, funding %+.6f, price %+.6f, hedge %+.6f, fees %.6f, max drawdown %.2f%%' %
+          (summary['pnl'], summary['funding'], summary['price'], summary['hedge'], summary['fees'],
+           summary['max_drawdown'] * 100))
+    print('simulated %i events in %.1fms' % (summary['events'], elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
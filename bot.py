@@ -1,60 +1,178 @@
-from datetime import datetime, timedelta
+from datetime import datetime
+import sqlite3
 import sys
-from time import sleep
+import threading
+from time import perf_counter, sleep, time
 
 from market_maker.market_maker import ExchangeInterface
-from market_maker.utils import log
+from market_maker.settings import settings
+from market_maker.utils import exporter, log, ticks
+from market_maker.utils.dispatch import wait_all
+from market_maker.utils.latency import format_interval
 
-import settings
-from utils import math
+from journal import Journal
+from snapshot import (ORDER_KEYS, STOP_TYPES, SnapshotWriter, read_snapshot, snapshot_path,
+                      snapshot_settings)
 
 
-class FundingBot:
-    def __init__(self) -> None:
-        self.logger = log.setup_custom_logger('fundingbot')
-        
-        self.exchange = ExchangeInterface()
-        
-        self.start_balance = self.exchange.get_margin()['marginBalance'] / 100000000
+def per_symbol(value, symbols, cast=None) -> dict:
+    """split a 'XBTUSD|ETHUSD'-style setting into a value per symbol
 
-        self.tick_size = self.exchange.get_instrument()['tickSize']
+    a value without '|' applies to every symbol
+    """
 
-        self.loop_count = 1
+    if isinstance(value, str) and '|' in value:
+        values = value.split('|')
 
-        self.start_time = datetime.utcnow().isoformat(timespec='seconds') + 'Z'
+        if len(values) != len(symbols):
+            raise ValueError('setting %s does not have one value per symbol (%s)' %
+                             (value, '|'.join(symbols)))
+    else:
+        values = [value] * len(symbols)
+
+    if cast is not None:
+        values = [cast(v) for v in values]
+
+    return dict(zip(symbols, values))
+
+
+class SymbolState:
+    """everything the bot tracks separately for each symbol it trades"""
+
+    def __init__(self, symbol: str, tick_size: float, position: int, size_buy: int,
+                 size_sell: int, hedge_side: str) -> None:
+        self.symbol = symbol
+
+        self.tick_size = tick_size
 
-        self.last_request = datetime.utcnow()
+        self.grid = ticks.grid(tick_size)
+
+        self.size_buy = size_buy
+        self.size_sell = size_sell
+
+        self.hedge_side = hedge_side
+
+        self.infer(position)
+
+    def infer(self, position: int) -> None:
+        """guess the flags from the position alone, as on a fresh start"""
 
         self.limits_exist = False
 
-        position = self.exchange.get_position()['currentQty']
-        
-        self.hedge_exists = position != 0 and (abs(position) not in
-                [settings.POSITION_SIZE_BUY, settings.POSITION_SIZE_SELL])
+        self.hedge_exists = position != 0 and abs(position) not in [self.size_buy, self.size_sell]
 
         self.could_hedge = position == 0
 
-        self.cancel_open_orders()
+
+class FundingBot:
+    def __init__(self, config=None, session=None, name: str = 'fundingbot') -> None:
+        """config replaces the global settings and session is shared with other bots,
+        so one process can host a bot per account (see host.py)
+        """
+
+        self.settings = config or settings
+
+        self.session = session
+
+        self.name = name
+
+        self.logger = log.setup_custom_logger(name, log_level=self.settings.LOG_LEVEL)
+
+        self.journal = Journal.open(self.settings.JOURNAL_PATH) if self.settings.JOURNAL_PATH else None
+
+        self.running = True
+
+        self.exchange = self.connect()
+
+        self.load_state()
+
+        self.export_metrics()
+
+        if not self.resume():
+            self.cancel_open_orders()
+
+    def load_state(self) -> None:
+        """start tracking balance and per-symbol state for a freshly connected exchange"""
+
+        # set from the websocket thread whenever something we react to changes
+        self.wakeup = threading.Event()
+
+        self.add_listeners()
+
+        self.start_balance = self.exchange.get_margin()['marginBalance'] / 100000000
+
+        self.last_status = datetime.utcnow()
+
+        self.start_time = datetime.utcnow().isoformat(timespec='seconds') + 'Z'
+
+        self.snapshot_path = snapshot_path(self.settings, self.name)
+
+        # what was last written there, to only write changes
+        self.saved = None
+
+        self.started = time()
+
+        self.last_latency_log = time()
+
+        # symbol -> arrival of the last quote monitor() saw, to time only new ones
+        self.seen_quotes = {}
+
+        symbols = self.exchange.symbols
+
+        sizes_buy = per_symbol(self.settings.POSITION_SIZE_BUY, symbols, int)
+        sizes_sell = per_symbol(self.settings.POSITION_SIZE_SELL, symbols, int)
+        hedge_sides = per_symbol(self.settings.HEDGE_SIDE, symbols)
+
+        self.symbols = {}
+
+        for symbol in symbols:
+            self.symbols[symbol] = SymbolState(
+                    symbol, self.exchange.get_instrument(symbol)['tickSize'],
+                    self.exchange.get_position(symbol)['currentQty'],
+                    sizes_buy[symbol], sizes_sell[symbol], hedge_sides[symbol])
 
     def sanity_check(self) -> None:
-        self.exchange.check_if_orderbook_empty()
+        for symbol in self.symbols:
+            self.exchange.check_if_orderbook_empty(symbol)
 
-        self.exchange.check_market_open()
+            self.exchange.check_market_open(symbol)
 
     def print_status(self) -> None:
-        position = self.exchange.get_position()
-        ticker = self.exchange.get_ticker()
         current_balance = self.exchange.get_margin()['marginBalance'] / 100000000
-        open_orders = self.exchange.bitmex.open_orders()
 
-        self.logger.info('ticker buy: %.2f USD' % ticker['buy'])
-        self.logger.info('ticker sell: %.2f USD' % ticker['sell'])
+        for symbol in self.symbols:
+            self.print_symbol_status(symbol)
+
+        self.logger.info('starting XBT balance: %.6f XBT (%s)' %
+                         (self.start_balance, self.start_time))
+
+        self.logger.info('current XBT balance: %.6f XBT' % current_balance)
+
+        if self.journal is not None:
+            self.log_journal()
+
+        self.log_latency()
+
+        sys.stdout.write('-' * 20 + '\n')
+        sys.stdout.flush()
+
+    def print_symbol_status(self, symbol: str) -> None:
+        position = self.exchange.get_position(symbol)
+        ticker = self.exchange.get_ticker(symbol)
+        open_orders = self.exchange.bitmex.open_orders(symbol)
+
+        currency = symbol[:3]
+
+        self.logger.info('%s ticker buy: %.2f USD' % (symbol, ticker['buy']))
+        self.logger.info('%s ticker sell: %.2f USD' % (symbol, ticker['sell']))
 
         current_quantity = position['currentQty']
-        
-        self.logger.info('funding rate: %.4f%%' % (self.get_funding_rate() * 100))
-        
-        self.logger.info('current position: %i USD' % current_quantity)
+
+        self.logger.info('%s funding rate: %.4f%%' % (symbol, self.get_funding_rate(symbol) * 100))
+
+        self.log_market(symbol)
+
+        self.logger.info('%s current position: %i' % (symbol, current_quantity))
 
         if current_quantity:
             average_entry_price = position['avgEntryPrice']
@@ -62,30 +180,25 @@ class FundingBot:
             self.logger.info(' ~ average entry price: %.2f USD' % average_entry_price)
 
             original_value = current_quantity / average_entry_price
-            
+
             self.logger.info(' ~ original position value: %.6f %s' %
-                    (original_value, settings.SYMBOL[:3]))
+                    (original_value, currency))
 
             current_value = current_quantity / ticker['buy' if current_quantity > 0 else 'sell']
 
             self.logger.info(' ~ current position value: %.6f %s' %
-                    (current_value, settings.SYMBOL[:3]))
+                    (current_value, currency))
 
             value_delta = current_value - original_value
 
             self.logger.info(' ~ position value delta: %.6f %s' %
-                    (value_delta, settings.SYMBOL[:3]))
+                    (value_delta, currency))
 
             profit = -value_delta * (ticker['buy'] if current_quantity < 0 else ticker['sell'])
 
             self.logger.info(' ~ position profit: %.2f USD' % profit)
-        
-        self.logger.info('starting XBT balance: %.6f XBT (%s)' %
-                         (self.start_balance, self.start_time))
 
-        self.logger.info('current XBT balance: %.6f XBT' % current_balance)
-
-        self.logger.info('open orders:%s' % (' none' if not open_orders else ''))
+        self.logger.info('%s open orders:%s' % (symbol, ' none' if not open_orders else ''))
 
         for order in open_orders:
             if order['ordType'] == 'Limit':
@@ -106,149 +219,357 @@ class FundingBot:
                 else:
                     self.logger.info(' ~ stop order: close, stop price: %.2f USD' %
                                      order['stopPx'])
-        
-        sys.stdout.write('-' * 20 + '\n')
-        sys.stdout.flush()
 
-    def get_price(self, side: str) -> float:
-        ticker = self.exchange.get_ticker()
-        
+    def log_journal(self) -> None:
+        """log pnl from the fills and funding journalled since the bot started"""
+
+        try:
+            totals = self.journal.totals(self.name, since=self.started)
+        except sqlite3.Error as e:
+            self.logger.warning('unable to read the journal: %s' % e)
+            return
+
+        self.logger.info('realised pnl since start: %.6f XBT (funding %+.6f XBT, fees %.6f XBT)' %
+                         (totals['pnl'], totals['funding'], totals['fees']))
+
+    def log_latency(self) -> None:
+        """every LATENCY_LOG_INTERVAL seconds, log p50/p99/max of each stage over the interval"""
+
+        interval = self.settings.LATENCY_LOG_INTERVAL
+
+        if not interval or time() - self.last_latency_log < interval:
+            return
+
+        self.last_latency_log = time()
+
+        line = format_interval(self.exchange.bitmex.latency.interval())
+
+        if line:
+            self.logger.info('latency p50/p99/max ms: %s' % line)
+
+    def export_metrics(self) -> None:
+        """serve this bot's latencies and health metrics on the metrics endpoint, if there is one"""
+
+        if self.settings.METRICS_PORT and exporter.serve(self.settings.METRICS_PORT):
+            exporter.register(self.name, self.exchange.bitmex.latency)
+            exporter.register(self.name, self.exchange.bitmex.metrics)
+
+    def unexport_metrics(self) -> None:
+        exporter.unregister(self.name, self.exchange.bitmex.latency)
+        exporter.unregister(self.name, self.exchange.bitmex.metrics)
+
+    def note_quotes(self) -> float:
+        """record how long each new quote waited for monitor() to see it
+
+        returns when the newest one arrived (a perf_counter() value), or None if there are none
+        """
+
+        now = perf_counter()
+
+        newest = None
+
+        for symbol in self.symbols:
+            received = self.exchange.bitmex.ws.quote_received(symbol)
+
+            if received is None or received == self.seen_quotes.get(symbol):
+                continue
+
+            self.seen_quotes[symbol] = received
+
+            self.exchange.bitmex.latency.record('quote_to_monitor', now - received)
+
+            newest = received if newest is None else max(newest, received)
+
+        return newest
+
+    def log_market(self, symbol: str, price: float = None) -> None:
+        """log recent vwap and volatility, and how far price is from the vwap"""
+
+        vwap = self.exchange.bitmex.vwap(symbol, self.settings.VWAP_WINDOW)
+
+        if vwap is None:
+            return
+
+        volatility = self.exchange.bitmex.volatility(symbol)
+
+        self.logger.info(' ~ %is vwap: %.2f USD%s, volatility: %s' %
+                         (self.settings.VWAP_WINDOW, vwap,
+                          '' if price is None else ' (price %+.3f%%)' % ((price / vwap - 1) * 100),
+                          'n/a' if volatility is None else '%.4f%%' % (volatility * 100)))
+
+    def top_of_book(self, symbol: str) -> tuple:
+        """best bid and ask, from the l2 book if it's streamed, otherwise from the quote"""
+
+        book = self.exchange.bitmex.market_depth(symbol)
+
+        if book is not None and book.best_bid() and book.best_ask():
+            return book.best_bid()[0], book.best_ask()[0]
+
+        ticker = self.exchange.get_ticker(symbol)
+
+        return ticker['buy'], ticker['sell']
+
+    def sweep(self, symbol: str, side: str, quantity: int) -> float:
+        """log what a market order would really fill at, and return its average price
+
+        None without an l2 book (WS_ORDER_BOOK)
+        """
+
+        book = self.exchange.bitmex.market_depth(symbol)
+
+        if book is None:
+            return None
+
+        # a buy takes the asks, a sell the bids
+        average, worst, filled = book.sweep('Sell' if side == 'Buy' else 'Buy', quantity)
+
+        if average is None:
+            return None
+
+        self.logger.info(' ~ book fills %i/%i @ %.2f average, %.2f worst' % (filled, quantity, average, worst))
+
+        if filled < quantity:
+            self.logger.warning(' ~ not enough %s liquidity in the book for %i contracts' % (symbol, quantity))
+
+        return average
+
+    def get_price(self, side: str, symbol: str = None) -> float:
+        state = self.get_state(symbol)
+
         if side.lower() not in ['buy', 'sell']:
             raise ValueError('invalid side passed to get_price: %s' % side)
 
+        bid, ask = self.top_of_book(state.symbol)
+
         if side.lower() == 'buy':
-            return ticker['sell'] - self.tick_size
+            return state.grid.step(ask, -1)
         else:
-            return ticker['buy'] + self.tick_size
+            return state.grid.step(bid, 1)
+
+    def get_state(self, symbol: str = None) -> SymbolState:
+        return self.symbols[symbol or self.exchange.symbol]
 
     def monitor(self) -> None:
         """if the price moves negatively 1.5% away from a position, exit the position
         if there is an open order and the ticker moves, move the order
+
+        orders for every symbol are batched into one request per kind
         """
-        
-        ticker = self.exchange.get_ticker()
-        
-        open_orders = self.exchange.bitmex.open_orders()
+
+        tick = self.note_quotes()
 
         to_amend = []
-        
+        to_create = []
+        to_cancel = []
+
+        for state in self.symbols.values():
+            self.plan(state, to_amend, to_create, to_cancel)
+
+        # the batches touch different orders, so they can all be in flight at once
+        pending = []
+
+        if to_amend:
+            pending.append(self.exchange.bitmex.dispatch(self._amend_orders, to_amend))
+
+        if to_create:
+            created = self.exchange.bitmex.dispatch(self._create_orders, to_create)
+
+            pending.append(created)
+
+        if to_cancel:
+            pending.append(self.exchange.bitmex.dispatch(self._cancel_orders, to_cancel))
+
+        wait_all(pending)
+
+        if to_amend and tick is not None:
+            self.exchange.bitmex.latency.record('quote_to_amend', perf_counter() - tick)
+
+        if to_create and not created.result():
+            self.replan(to_create)
+
+        self.save_state()
+
+    def plan(self, state: SymbolState, to_amend: list, to_create: list, to_cancel: list) -> None:
+        """work out the amends, new orders and cancels one symbol needs right now"""
+
+        open_orders = self.exchange.bitmex.open_orders(state.symbol)
+
         for order in open_orders:
             if order['ordType'] != 'Limit':
                 continue
 
-            to_change = False
+            new_price = self.get_price(order['side'], state.symbol)
+
+            # compared in whole ticks, so float noise never triggers an amend
+            behind = state.grid.ticks(new_price) - state.grid.ticks(order['price'])
 
             if order['side'] == 'Buy':
-                if order['price'] < self.get_price('buy'):
-                    to_change = True
-                    new_price = self.get_price('buy')
+                to_change = behind > 0
             else:
-                if order['price'] > self.get_price('sell'):
-                    to_change = True
-                    new_price = self.get_price('sell')
+                to_change = behind < 0
 
             if to_change:
                 to_amend.append({'orderID': order['orderID'], 'price': new_price})
 
-                self.logger.info('amending order %i from %.2f to %.2f' %
-                            (order['leavesQty'], order['price'], new_price))
-        
-        if to_amend:
-            self._amend_orders(to_amend)
+                self.logger.info('amending %s order %i from %.2f to %.2f' %
+                            (state.symbol, order['leavesQty'], order['price'], new_price))
 
-        position = self.exchange.get_position()
+        position = self.exchange.get_position(state.symbol)
 
         quantity = position['currentQty']
 
         if quantity:
-            if not self.limits_exist and not self.hedge_exists:
-                avg_price = position['avgEntryPrice']
+            if not state.limits_exist and not state.hedge_exists:
+                to_create.extend(self.stop_orders(state, position))
 
-                limit_delta = avg_price * settings.STOP_LIMIT_MULTIPLIER
-                market_delta = avg_price * settings.STOP_MARKET_MULTIPLIER
+                state.limits_exist = True
 
-                if quantity > 0:
-                    limit_stopPx = math.to_nearest(avg_price - limit_delta, self.tick_size)
-                    limit_stop_price = limit_stopPx + self.tick_size
+            state.could_hedge = True
+        else:
+            to_cancel.extend(o for o in open_orders if o['ordType'] in ['StopLimit', 'Stop'])
 
-                    market_stopPx = math.to_nearest(avg_price - market_delta, self.tick_size)
+            state.limits_exist = False
 
-                    side = 'Sell'
-                else:
-                    limit_stopPx = math.to_nearest(avg_price + limit_delta, self.tick_size)
-                    limit_stop_price = limit_stopPx - self.tick_size
+            if self.settings.HEDGE and not state.hedge_exists and state.could_hedge:
+                to_create.append(self.hedge_order(state, state.hedge_side, market=False))
 
-                    market_stopPx = math.to_nearest(avg_price + market_delta, self.tick_size)
+                state.hedge_exists = True
 
-                    side = 'Buy'
+    def stop_orders(self, state: SymbolState, position: dict) -> list:
+        quantity = position['currentQty']
 
-                orders = []
+        avg_price = position['avgEntryPrice']
 
-                if settings.STOP_LIMIT_MULTIPLIER > 0:
-                    limit_stop = {'stopPx': limit_stopPx, 'price': limit_stop_price,
-                                  'execInst': 'LastPrice,Close', 'ordType': 'StopLimit',
-                                  'side': side}
+        limit_delta = avg_price * self.settings.STOP_LIMIT_MULTIPLIER
+        market_delta = avg_price * self.settings.STOP_MARKET_MULTIPLIER
 
-                    orders.append(limit_stop)
+        if quantity > 0:
+            limit_stopPx = state.grid.round(avg_price - limit_delta)
+            limit_stop_price = state.grid.step(limit_stopPx, 1)
 
-                if settings.STOP_MARKET_MULTIPLIER > 0:
-                    market_stop = {'stopPx': market_stopPx, 'execInst': 'LastPrice,Close',
-                                   'ordType': 'Stop', 'side': side}
+            market_stopPx = state.grid.round(avg_price - market_delta)
 
-                    orders.append(market_stop)
-                
-                if orders:
-                    self._create_orders(orders)
+            side = 'Sell'
+        else:
+            limit_stopPx = state.grid.round(avg_price + limit_delta)
+            limit_stop_price = state.grid.step(limit_stopPx, -1)
 
-                self.limits_exist = True
+            market_stopPx = state.grid.round(avg_price + market_delta)
 
-            self.could_hedge = True
-        else:
-            to_cancel = [o for o in open_orders if o['ordType'] in ['StopLimit', 'Stop']]
+            side = 'Buy'
+
+        orders = []
+
+        if self.settings.STOP_LIMIT_MULTIPLIER > 0:
+            limit_stop = {'symbol': state.symbol, 'stopPx': limit_stopPx, 'price': limit_stop_price,
+                          'execInst': 'LastPrice,Close', 'ordType': 'StopLimit', 'side': side}
+
+            orders.append(limit_stop)
 
-            if to_cancel:
-                self._cancel_orders(to_cancel)
+        if self.settings.STOP_MARKET_MULTIPLIER > 0:
+            market_stop = {'symbol': state.symbol, 'stopPx': market_stopPx,
+                           'execInst': 'LastPrice,Close', 'ordType': 'Stop', 'side': side}
 
-            self.limits_exist = False
+            orders.append(market_stop)
 
-            if settings.HEDGE and not self.hedge_exists and self.could_hedge:
-                self.hedge(settings.HEDGE_SIDE, market=False)
+        return orders
 
-                self.hedge_exists = True
+    def enter_position(self, side: str, trade_quantity: int, market=False, symbol: str = None) -> None:
+        state = self.get_state(symbol)
 
-    def enter_position(self, side: str, trade_quantity: int, market=False) -> None:
+        self._create_orders([self.entry_order(state, side, trade_quantity, market)])
+
+        state.could_hedge = False
+
+    def entry_order(self, state: SymbolState, side: str, trade_quantity: int, market=False) -> dict:
         if market:
-            self.logger.info('entering a position at market (%.2f): quantity: %i, side: %s' %
-                        (self.exchange.get_ticker()[side.lower()], trade_quantity, side))
+            self.logger.info('entering a %s position at market (%.2f): quantity: %i, side: %s' %
+                        (state.symbol, self.exchange.get_ticker(state.symbol)[side.lower()],
+                         trade_quantity, side))
+
+            self.sweep(state.symbol, side, trade_quantity)
 
             order = {'type': 'Market', 'orderQty': trade_quantity, 'side': side}
         else:
-            price = self.get_price(side)
+            price = self.get_price(side, state.symbol)
 
-            self.logger.info('entering a position ~ price: %.2f, quantity: %i, side: %s' %
-                        (price, trade_quantity, side))
+            self.logger.info('entering a %s position ~ price: %.2f, quantity: %i, side: %s' %
+                        (state.symbol, price, trade_quantity, side))
+
+            self.log_market(state.symbol, price)
 
             order = {'price': price, 'orderQty': trade_quantity, 'side': side}
 
+        order['symbol'] = state.symbol
+
+        return order
+
+    def exit_position(self, market=False, wait_for_fill=False, symbol: str = None) -> None:
+        state = self.get_state(symbol)
+
+        order = self.exit_order(state, market)
+
+        if order is None:
+            return
+
         self._create_orders([order])
 
-        self.could_hedge = False
+        if wait_for_fill and not market and not self.wait_until_flat(state, self.settings.EXIT_FILL_TIMEOUT):
+            if not self.running:
+                return
+
+            self.logger.warning('%s exit not filled after %is, closing at market' %
+                                (state.symbol, self.settings.EXIT_FILL_TIMEOUT))
+
+            self.cancel_open_orders(state.symbol)
+
+            order = self.exit_order(state, market=True)
+
+            if order is not None:
+                self._create_orders([order])
+
+        state.hedge_exists = False
+
+    def wait_until_flat(self, state: SymbolState, timeout: float = None) -> bool:
+        """wait for the symbol's position to close, waking as soon as the websocket says so
+
+        false if it's still open after timeout seconds, or the bot stopped
+        """
+
+        deadline = None if timeout is None else time() + timeout
+
+        while self.running:
+            remaining = None if deadline is None else deadline - time()
+
+            if remaining is not None and remaining <= 0:
+                return False
+
+            if self.exchange.bitmex.wait_for_position(state.symbol, 0, remaining):
+                return True
+
+            if not self.exchange.is_open():
+                # the run loop is reconnecting; wait on the new connection once it's up
+                sleep(1)
+
+        return False
+
+    def exit_order(self, state: SymbolState, market=False) -> dict:
+        """the order that closes a symbol's position, or None if there's no position"""
 
-    def exit_position(self, market=False, wait_for_fill=False) -> None:
-        self.logger.info('exiting current position. at market: %s' %
-                         ('true' if market else 'false'))
+        self.logger.info('exiting current %s position. at market: %s' %
+                         (state.symbol, 'true' if market else 'false'))
 
-        position = self.exchange.get_position()
+        position = self.exchange.get_position(state.symbol)
 
         quantity = position['currentQty']
 
         if quantity == 0:
             self.logger.info(' ~ not currently in a position')
-        
-            self.hedge_exists = False
-            self.could_hedge = True
-            
-            return
+
+            state.hedge_exists = False
+            state.could_hedge = True
+
+            return None
 
         if quantity < 0:
             exit_side = 'Buy'
@@ -258,77 +579,123 @@ class FundingBot:
         if market:
             order = {'type': 'Market', 'execInst': 'Close', 'side': exit_side}
         else:
-            exit_price = self.get_price(exit_side)
+            exit_price = self.get_price(exit_side, state.symbol)
 
             order = {'price': exit_price, 'execInst': 'Close', 'side': exit_side}
 
-        self._create_orders([order])
+        order['symbol'] = state.symbol
 
-        if wait_for_fill and not market:
-            while True:
-                sleep(1)
+        return order
 
-                postition = self.exchange.get_position()
-
-                if position['currentQty'] == 0:
-                    break
-
-        self.hedge_exists = False
-
-    def hedge(self, side: str, market=False) -> None:
+    def hedge_order(self, state: SymbolState, side: str, market=False) -> dict:
         current_balance = self.exchange.get_margin()['marginBalance'] / 100000000
 
         self.logger.info('current balance: %.6f' % current_balance)
-        
+
         if side not in ['Buy', 'Sell']:
             raise ValueError('side %s is not a valid side. options: Buy, Sell' % side)
-        
-        ticker = self.exchange.get_ticker()
 
-        price = ticker[side.lower()]
+        bid, ask = self.top_of_book(state.symbol)
 
-        quantity = int((current_balance-.1) * settings.HEDGE_MULTIPLIER * price)
+        price = bid if side == 'Buy' else ask
 
-        self.logger.info('entering a hedge (at market: %s): %i @ %.2f' %
-                    ('true' if market else 'false', quantity, price))
+        quantity = int((current_balance-.1) * self.settings.HEDGE_MULTIPLIER * price)
 
         if market:
-            order = {'type': 'Market', 'orderQty': quantity, 'side': side}
+            # size against what the order will actually fill at, not the top level
+            average = self.sweep(state.symbol, side, quantity)
+
+            if average is not None:
+                price = average
+
+                quantity = int((current_balance-.1) * self.settings.HEDGE_MULTIPLIER * price)
+
+        self.logger.info('entering a %s hedge (at market: %s): %i @ %.2f' %
+                    (state.symbol, 'true' if market else 'false', quantity, price))
+
+        if market:
+            return {'symbol': state.symbol, 'type': 'Market', 'orderQty': quantity, 'side': side}
         else:
-            order = {'price': price, 'orderQty': quantity, 'side': side}
+            return {'symbol': state.symbol, 'price': price, 'orderQty': quantity, 'side': side}
 
-        self._create_orders([order])
-        
-    def cancel_open_orders(self) -> None:
-        self.logger.info('cancelling all open orders')
+    def hedge(self, side: str, market=False, symbol: str = None) -> None:
+        self._create_orders([self.hedge_order(self.get_state(symbol), side, market)])
+
+    def cancel_open_orders(self, symbol: str = None) -> None:
+        """cancel open orders for one symbol, or for every symbol if none is given"""
+
+        self.logger.info('cancelling all open orders%s' % (' for ' + symbol if symbol else ''))
 
         # saves an api request, as getting open orders is via the websocket
-        open_orders = self.exchange.bitmex.open_orders()
+        open_orders = self.exchange.bitmex.open_orders(symbol)
 
         if not open_orders:
             self.logger.info(' ~ no open orders')
             return
 
         try:
-            self.exchange.cancel_all_orders()
+            if symbol is None:
+                self.exchange.cancel_all_orders()
+            else:
+                self._cancel_orders(open_orders)
         except Exception as e:
             self.logger.error('unable to cancel orders: %s', e)
-        
-        self.limits_exist = False
 
-    def exit(self, *args) -> None:
+        for state in self.symbols.values():
+            if symbol is None or state.symbol == symbol:
+                state.limits_exist = False
+
+    def stop(self) -> None:
+        """make run_loop return after its current pass"""
+
+        self.running = False
+
+        self.wakeup.set()
+
+    def shutdown(self) -> None:
         self.logger.info('shutting down, all open orders will be cancelled')
-        
+
+        self.stop()
+
         self.cancel_open_orders()
-        
+
+        self.save_state()
+
+        if self.snapshot_path is not None:
+            SnapshotWriter.open().flush()
+
         #self.exit_position()
-        
+
         self.exchange.bitmex.exit()
 
+        self.unexport_metrics()
+
+        if self.journal is not None:
+            self.journal.flush()
+
+    def exit(self, *args) -> None:
+        self.shutdown()
+
         sys.exit()
 
+    def add_listeners(self) -> None:
+        """wake the run loop on quote, order and position changes for our symbols"""
+
+        ws = self.exchange.bitmex.ws
+
+        for table in ['quote', 'instrument', 'order', 'position']:
+            ws.add_listener(table, self.on_update)
+
+        if self.journal is not None:
+            ws.add_listener('execution', self.journal.listener(self.name))
+
+    def on_update(self, table, action, data) -> None:
+        # runs on the websocket thread; the instrument table carries every symbol
+        if any(row.get('symbol') in self.exchange.symbols for row in data):
+            self.wakeup.set()
+
     def run_loop(self) -> None:
-        while True:
+        while self.running:
             if not self.exchange.is_open():
                 self.logger.error('realtime data connection has closed, reloading')
 
@@ -338,91 +705,242 @@ class FundingBot:
 
             self.sanity_check()
 
-            if (self.loop_count*settings.LOOP_INTERVAL) % 10 == 0:
+            if (datetime.utcnow() - self.last_status).total_seconds() >= 10:
                 self.print_status()
-                
-                self.loop_count = 0
 
-            self.loop_count += 1
+                self.last_status = datetime.utcnow()
 
             self.monitor()
-            
-            sleep(settings.LOOP_INTERVAL)
+
+            if self.settings.EVENT_DRIVEN:
+                # the timeout keeps the old polling behaviour as a watchdog
+                self.wakeup.wait(self.settings.LOOP_INTERVAL)
+                self.wakeup.clear()
+            else:
+                sleep(self.settings.LOOP_INTERVAL)
 
     def reload(self) -> None:
+        """reconnect the websocket, and square what we knew with what it sends now"""
+
         self.logger.info('reloading data connection...')
 
-        try:
-            self.exchange = ExchangeInterface()
-        except Exception as e:
-            self.logger.error(e)
-            self.logger.error('attempting to reload in 3 seconds...')
+        snapshot = self.snapshot()
 
-            sleep(3)
+        while self.running:
+            try:
+                self.exchange.bitmex.reconnect()
+            except Exception as e:
+                self.logger.error(e)
+                self.logger.error('attempting to reload in 3 seconds...')
+
+                sleep(3)
+            else:
+                break
+
+        self.add_listeners()
+
+        stale = self.reconcile(snapshot)
+
+        if stale:
+            self._cancel_orders(stale)
+
+        self.save_state()
+
+    def snapshot(self) -> dict:
+        """each symbol's flags, position and open orders, as last seen on the websocket"""
+
+        symbols = {}
+
+        for symbol, state in self.symbols.items():
+            position = self.exchange.get_position(symbol)
+
+            symbols[symbol] = {
+                'limits_exist': state.limits_exist,
+                'hedge_exists': state.hedge_exists,
+                'could_hedge': state.could_hedge,
+                'position': {'currentQty': position['currentQty'],
+                             'avgEntryPrice': position['avgEntryPrice']},
+                'orders': [{key: order.get(key) for key in ORDER_KEYS}
+                           for order in self.exchange.bitmex.open_orders(symbol)],
+            }
+
+        return {'settings': snapshot_settings(self.settings), 'symbols': symbols}
+
+    def save_state(self) -> None:
+        """queue the snapshot to be written if anything in it has changed since the last one"""
+
+        if self.snapshot_path is None:
+            return
+
+        snapshot = self.snapshot()
+
+        if snapshot == self.saved:
+            return
 
-            self.reload()
+        # written on the snapshot thread; this runs after every monitor() pass
+        SnapshotWriter.open().save(self.snapshot_path, snapshot)
 
-        sleep(3)
+        self.saved = snapshot
 
-    def get_instrument(self):
-        return self.exchange.bitmex.instrument(symbol=settings.SYMBOL)
+    def resume(self) -> bool:
+        """carry on from the last run's snapshot instead of cancelling everything
+
+        false if there's no snapshot, or it was taken under different settings
+        """
+
+        stale = self.check_snapshot()
+
+        if stale is None:
+            return False
+
+        if stale:
+            self._cancel_orders(stale)
+
+        self.save_state()
+
+        return True
+
+    def check_snapshot(self) -> list:
+        """reconcile against the saved snapshot if it fits, returning the orders to cancel"""
+
+        if self.snapshot_path is None:
+            return None
+
+        snapshot = read_snapshot(self.snapshot_path)
+
+        if snapshot is None:
+            return None
+
+        if snapshot.get('settings') != snapshot_settings(self.settings):
+            self.logger.info('settings have changed since the last snapshot, starting afresh')
+
+            return None
+
+        self.logger.info('resuming from %s' % self.snapshot_path)
+
+        return self.reconcile(snapshot)
+
+    def reconcile(self, snapshot: dict) -> list:
+        """restore each symbol's flags from a snapshot, checked against the websocket's fresh
+        partials, and return the orders that no longer fit
+
+        stops are kept while the position is the one they were placed for and they're all still
+        resting where they were; otherwise they're cancelled and plan() places new ones
+        """
 
-    def get_funding_rate(self) -> float:
-        return self.get_instrument()['fundingRate']
+        stale = []
 
-    def respect_rate_limit(fn):
-        def wrapped(self, *args, **kwargs):
-            new_datetime = self.last_request + timedelta(seconds=settings.API_REST_INTERVAL)
+        for symbol, state in self.symbols.items():
+            saved = snapshot['symbols'][symbol]
 
-            wait_time = (new_datetime - datetime.utcnow()).total_seconds()
+            position = self.exchange.get_position(symbol)
+            quantity = position['currentQty']
 
-            if wait_time > 0:
-                sleep(wait_time)
+            open_orders = self.exchange.bitmex.open_orders(symbol)
 
-            return fn(self, *args, **kwargs)
-        return wrapped
+            stops = [o for o in open_orders if o['ordType'] in STOP_TYPES]
+
+            known = {o['orderID']: o for o in saved['orders']}
+
+            if [position['currentQty'], position['avgEntryPrice']] != \
+                    [saved['position']['currentQty'], saved['position']['avgEntryPrice']]:
+                # filled, stopped out or traded by hand in the meantime
+                self.logger.info('%s position changed from %i to %i while away' %
+                                 (symbol, saved['position']['currentQty'], quantity))
+
+                state.infer(quantity)
+
+                stale += stops
+
+                continue
+
+            state.limits_exist = saved['limits_exist']
+            state.hedge_exists = saved['hedge_exists']
+            state.could_hedge = saved['could_hedge']
+
+            kept = all(o['orderID'] in known and o['stopPx'] == known[o['orderID']]['stopPx']
+                       for o in stops)
+
+            kept = kept and len(stops) == sum(o['ordType'] in STOP_TYPES for o in saved['orders'])
+
+            if state.limits_exist and kept:
+                self.logger.info('%s stops still in place: %s' %
+                                 (symbol, ', '.join('%.2f' % o['stopPx'] for o in stops) or 'none'))
+            else:
+                stale += stops
+
+                state.limits_exist = False
+
+            # a hedge that was cancelled rather than filled has to be placed again
+            if state.hedge_exists and not quantity and \
+                    not any(o['ordType'] == 'Limit' for o in open_orders):
+                state.hedge_exists = False
+
+        return stale
+
+    def connect(self) -> ExchangeInterface:
+        return ExchangeInterface(config=self.settings, session=self.session)
+
+    def get_instrument(self, symbol: str = None):
+        return self.exchange.bitmex.instrument(symbol=symbol or self.exchange.symbol)
+
+    def get_funding_rate(self, symbol: str = None) -> float:
+        return self.get_instrument(symbol)['fundingRate']
+
+    # rate limiting is handled by the BitMEX connector, which spaces requests out only
+    # when the exchange says we're running low
+
+    def _create_orders(self, orders) -> bool:
+        """place orders, returning whether they were
+
+        the connector already retries (with the same clOrdIDs, so nothing is placed twice); an error
+        here means it gave up
+        """
+
+        start = perf_counter()
 
-    @respect_rate_limit
-    def _create_orders(self, orders) -> None:
         try:
             self.exchange.bitmex.create_bulk_orders(orders)
         except Exception as e:
-            self.logger.warning('caught an error when requesting to the bitmex api: %s', e)
-
-            self.logger.info('retrying request after 5 seconds...')
+            self.logger.error('unable to create orders: %s' % e)
 
-            sleep(5)
+            return False
+        finally:
+            self.exchange.bitmex.latency.record('create_orders', perf_counter() - start)
 
-            self._create_orders(orders)
+        return True
 
-        self.last_request = datetime.utcnow()
-
-    @respect_rate_limit
     def _amend_orders(self, orders) -> None:
+        start = perf_counter()
+
         try:
             self.exchange.bitmex.amend_bulk_orders(orders)
         except Exception as e:
-            self.logger.warning('caught an error when requesting to the bitmex api: %s', e)
-
             if '400 Client Error' in str(e):
                 self.logger.info(' ~ order has already been fulfilled')
             else:
-                self.logger.info(' ~ retrying request after 5 seconds')
+                # the next tick plans the amends afresh
+                self.logger.error('unable to amend orders: %s' % e)
+        finally:
+            self.exchange.bitmex.latency.record('amend_orders', perf_counter() - start)
 
-                sleep(5)
+    def replan(self, orders) -> None:
+        """clear the flags that stop plan() asking for these orders again, after creating them failed"""
 
-                self._amend_orders(orders)
+        for order in orders:
+            state = self.get_state(order.get('symbol'))
 
-        self.last_request = datetime.utcnow()
+            if order.get('ordType') in STOP_TYPES:
+                state.limits_exist = False
+            else:
+                state.hedge_exists = False
 
-    @respect_rate_limit
     def _cancel_orders(self, orders) -> None:
-        for order in orders:
-            try:
-                self.exchange.cancel_order(order)
-            except Exception as e:
-                self.logger.error('unable to cancel order: %s' % e)
-
-            sleep(settings.API_REST_INTERVAL)
+        try:
+            failed = self.exchange.cancel_bulk_orders(orders)
+        except Exception as e:
+            self.logger.error('unable to cancel orders: %s' % e)
+            return
 
-        self.last_request = datetime.utcnow()
+        for order_id, error in failed.items():
+            self.logger.error('unable to cancel order %s: %s' % (order_id, error))
@@ -0,0 +1,280 @@
+"""funding-event scheduler
+
+each symbol's funding jobs run at deadlines worked out from its instrument's fundingTimestamp
+and fundingInterval, instead of at fixed wall-clock times:
+
+    enter   FUNDING_ENTRY_LEAD seconds before funding (but after the previous exit)
+    exit    FUNDING_EXIT_DELAY seconds after it
+
+the scheduler sleeps until the next deadline rather than polling, and is woken whenever an
+instrument's funding fields change, so a moved funding time or a new interval reschedules
+"""
+
+import asyncio
+from datetime import datetime
+import threading
+from time import time
+
+from market_maker.utils import log
+from market_maker.ws.history import parse_timestamp
+
+
+logger = log.setup_custom_logger('funding')
+
+# fundingInterval is sent as a timestamp this long after 2000-01-01
+INTERVAL_EPOCH = parse_timestamp('2000-01-01T00:00:00.000Z')
+
+# instruments are re-read at least this often, even if nothing wakes the scheduler
+MAX_SLEEP = 60
+
+# an entry is never scheduled closer than this to the previous funding's exit
+MIN_FLAT = 60
+
+
+class SymbolSchedule:
+    """one symbol of one bot: the funding event it's working towards, and whether it has entered"""
+
+    def __init__(self, bot, symbol: str, jobs: tuple, run, tag=None) -> None:
+        self.bot = bot
+        self.symbol = symbol
+        self.enter, self.exit = jobs
+        self.run = run
+        self.tag = tag
+
+        # epoch seconds of the funding event we're working towards, and of the last one exited
+        self.funding = None
+        self.last = None
+
+        self.interval = None
+
+        self.entered = False
+
+        # the websocket our instrument listener is on; a reconnect replaces it
+        self.ws = None
+
+    def entry_time(self) -> float:
+        lead = self.bot.settings.FUNDING_ENTRY_LEAD
+
+        if self.interval:
+            lead = min(lead, self.interval - self.bot.settings.FUNDING_EXIT_DELAY - MIN_FLAT)
+
+        return self.funding - lead
+
+    def exit_time(self) -> float:
+        return self.funding + self.bot.settings.FUNDING_EXIT_DELAY
+
+    def next_deadline(self) -> float:
+        if self.funding is None:
+            return None
+
+        return self.exit_time() if self.entered else self.entry_time()
+
+    def refresh(self, now: float) -> None:
+        """pick up the instrument's current funding time"""
+
+        instrument = self.bot.exchange.get_instrument(self.symbol)
+
+        if not instrument.get('fundingTimestamp'):
+            return
+
+        funding = parse_timestamp(instrument['fundingTimestamp'])
+
+        interval = None
+
+        if instrument.get('fundingInterval'):
+            interval = parse_timestamp(instrument['fundingInterval']) - INTERVAL_EPOCH
+
+        if self.funding is None:
+            # right after an exit, until the instrument rolls over to the next funding
+            if self.last is not None and funding <= self.last:
+                return
+
+            self.funding = funding
+            self.interval = interval
+
+            # started too late to enter this one; it's still exited
+            self.entered = now >= self.entry_time()
+
+            logger.info('%s funding at %s: entering at %s, exiting at %s' %
+                        (self.symbol, format_time(self.funding),
+                         'n/a' if self.entered else format_time(self.entry_time()),
+                         format_time(self.exit_time())))
+
+        elif (funding, interval) != (self.funding, self.interval) and now < self.funding:
+            # moved before it happened. once it has, the instrument has just rolled over to the next
+            # one, and this one still needs its exit
+            logger.info('%s funding moved from %s to %s' %
+                        (self.symbol, format_time(self.funding), format_time(funding)))
+
+            self.funding = funding
+            self.interval = interval
+
+    def fire(self, now: float) -> None:
+        if self.funding is None:
+            return
+
+        if not self.entered:
+            if now >= self.entry_time():
+                self.entered = True
+
+                self.run(self.enter, self.bot, self.symbol)
+
+        elif now >= self.exit_time():
+            self.run(self.exit, self.bot, self.symbol)
+
+            self.last = self.funding
+            self.funding = None
+            self.entered = False
+
+
+class FundingScheduler:
+    """runs every added bot's funding jobs, per symbol, at deadlines read from the instruments"""
+
+    def __init__(self) -> None:
+        self.schedules = []
+
+        # websocket -> how many schedules rely on our listener there; it's added once per websocket
+        self.listening = {}
+
+        # guards the schedules; notified to wake the scheduler early
+        self.condition = threading.Condition(threading.RLock())
+
+        self.changed = False
+
+        self.running = True
+
+        # set by run_async, which waits on an asyncio.Event instead
+        self.loop = None
+        self.event = None
+
+    def add(self, bot, jobs: tuple, run, tag=None) -> None:
+        """schedule a bot's (entry, exit) jobs for each of its symbols
+
+        run(job, bot, symbol) starts a job when it's due; tag the bot to clear it later
+        """
+
+        with self.condition:
+            for symbol in bot.symbols:
+                self.schedules.append(SymbolSchedule(bot, symbol, jobs, run, tag))
+
+            self.wake()
+
+    def clear(self, tag) -> None:
+        with self.condition:
+            for schedule in [s for s in self.schedules if s.tag == tag]:
+                self.schedules.remove(schedule)
+
+                self.unlisten(schedule)
+
+    def stop(self) -> None:
+        with self.condition:
+            self.running = False
+
+            self.wake()
+
+    def wake(self) -> None:
+        with self.condition:
+            self.changed = True
+
+            self.condition.notify_all()
+
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    def on_instrument(self, table, action, data) -> None:
+        # every instrument's updates come through here; only funding changes matter
+        if any('fundingTimestamp' in row or 'fundingInterval' in row for row in data):
+            self.wake()
+
+    def run_pending(self) -> float:
+        """run whatever is due, and return the seconds until the next deadline"""
+
+        with self.condition:
+            self.changed = False
+
+            now = time()
+
+            deadline = now + MAX_SLEEP
+
+            for schedule in list(self.schedules):
+                try:
+                    self.listen(schedule)
+
+                    schedule.refresh(now)
+                except Exception as e:
+                    # e.g. the bot is reconnecting; try again next time round
+                    logger.warning('unable to read %s funding: %s' % (schedule.symbol, e))
+
+                schedule.fire(now)
+
+                if schedule.next_deadline() is not None:
+                    deadline = min(deadline, schedule.next_deadline())
+
+            return max(deadline - time(), 0)
+
+    def listen(self, schedule: SymbolSchedule) -> None:
+        """make sure we hear about instrument changes on the schedule's bot's current websocket
+
+        a bot's symbols share one websocket, so the listener is added once however many there are
+        """
+
+        ws = schedule.bot.exchange.bitmex.ws
+
+        if schedule.ws is ws:
+            return
+
+        self.unlisten(schedule)
+
+        if ws not in self.listening:
+            ws.add_listener('instrument', self.on_instrument)
+
+        self.listening[ws] = self.listening.get(ws, 0) + 1
+
+        schedule.ws = ws
+
+    def unlisten(self, schedule: SymbolSchedule) -> None:
+        ws, schedule.ws = schedule.ws, None
+
+        if ws is None:
+            return
+
+        self.listening[ws] -= 1
+
+        if not self.listening[ws]:
+            del self.listening[ws]
+
+            ws.remove_listener('instrument', self.on_instrument)
+
+    def run(self) -> None:
+        """run jobs until stopped; blocks, so give it a thread"""
+
+        while self.running:
+            timeout = self.run_pending()
+
+            with self.condition:
+                if not self.changed and self.running:
+                    self.condition.wait(timeout)
+
+    async def run_async(self) -> None:
+        """run, awaiting the deadlines on the event loop instead"""
+
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+        try:
+            while self.running:
+                timeout = self.run_pending()
+
+                if not self.changed:
+                    try:
+                        await asyncio.wait_for(self.event.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+
+                self.event.clear()
+        finally:
+            self.loop = None
+
+
+def format_time(timestamp: float) -> str:
+    return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3] + ' utc'
@@ -0,0 +1,220 @@
+from hashlib import sha1
+import signal
+import sqlite3
+import sys
+import threading
+from time import sleep, time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from market_maker.settings import settings
+from market_maker.utils import log
+from market_maker.utils.dotdict import dotdict
+
+from bot import FundingBot
+from funding import FundingScheduler
+import strat
+
+
+logger = log.setup_custom_logger('host')
+
+# columns of the web app's settings table, each of which overrides the upper-cased setting
+keys = ('api_key', 'api_secret', 'symbol', 'position_size_buy', 'position_size_sell',
+        'hedge', 'hedge_side', 'hedge_multiplier', 'stop_limit_multiplier',
+        'stop_market_multiplier')
+
+# how long to wait before trying to start an account that failed to start again
+RETRY_INTERVAL = 60
+
+
+def load_accounts(db_path: str) -> dict:
+    """account id -> {column: value} for every row of the settings table"""
+
+    conn = sqlite3.connect(db_path)
+
+    try:
+        rows = conn.execute('SELECT id, %s FROM settings' % ', '.join(keys)).fetchall()
+    finally:
+        conn.close()
+
+    return {row[0]: dict(zip(keys, row[1:])) for row in rows}
+
+
+def account_settings(account: dict) -> dotdict:
+    """settings.py with the account's columns on top"""
+
+    config = dotdict(settings)
+
+    for key, value in account.items():
+        config[key.upper()] = value
+
+    config.HEDGE = bool(config.HEDGE)
+
+    return config
+
+
+class BotHost:
+    """runs a FundingBot for every account in the settings table, all in one process
+
+    accounts share one interpreter, one pool of http connections and one funding scheduler,
+    and are started, restarted or stopped as their rows are added, changed or deleted
+    """
+
+    def __init__(self, db_path: str = None) -> None:
+        self.db_path = db_path or settings.HOST_DB_PATH
+
+        self.session = requests.Session()
+
+        adapter = HTTPAdapter(pool_connections=settings.HOST_POOL_SIZE,
+                              pool_maxsize=settings.HOST_POOL_SIZE)
+
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.scheduler = FundingScheduler()
+
+        # guards bots and hashes, which bot threads touch as they start and die
+        self.lock = threading.RLock()
+
+        # account id -> FundingBot, or None while it is starting
+        self.bots = {}
+
+        # account id -> hash of the row it was started with
+        self.hashes = {}
+
+        # account id -> (row hash, time) of the last failed start
+        self.failed = {}
+
+        self.running = True
+
+    def sync(self) -> None:
+        accounts = load_accounts(self.db_path)
+
+        with self.lock:
+            for account_id in list(self.hashes):
+                if account_id not in accounts:
+                    logger.info('account %i was removed, stopping its bot' % account_id)
+
+                    self.stop_bot(account_id)
+
+            for account_id, account in accounts.items():
+                row_hash = sha1(repr(sorted(account.items())).encode('utf-8')).hexdigest()
+
+                if self.hashes.get(account_id) == row_hash:
+                    continue
+
+                failed_hash, failed_at = self.failed.get(account_id, (None, 0))
+
+                if failed_hash == row_hash and time() - failed_at < RETRY_INTERVAL:
+                    continue
+
+                if account_id in self.hashes:
+                    logger.info('settings for account %i have changed, restarting its bot' % account_id)
+
+                    self.stop_bot(account_id)
+                else:
+                    logger.info('starting bot for account %i' % account_id)
+
+                self.start_bot(account_id, account, row_hash)
+
+    def start_bot(self, account_id: int, account: dict, row_hash: str) -> None:
+        self.bots[account_id] = None
+        self.hashes[account_id] = row_hash
+
+        thread = threading.Thread(target=self.run_bot, args=(account_id, account, row_hash),
+                                  name='fundingbot%i' % account_id)
+        thread.daemon = True
+        thread.start()
+
+    def run_bot(self, account_id: int, account: dict, row_hash: str) -> None:
+        """build the bot and run it until it's stopped; runs on the account's own thread"""
+
+        # the websocket and the connector exit with SystemExit when they can't connect
+        try:
+            bot = FundingBot(config=account_settings(account), session=self.session,
+                             name='fundingbot%i' % account_id)
+        except (Exception, SystemExit) as e:
+            logger.error('unable to start bot for account %i: %s' % (account_id, e))
+
+            with self.lock:
+                if self.hashes.get(account_id) == row_hash:
+                    del self.bots[account_id]
+                    del self.hashes[account_id]
+
+                    self.failed[account_id] = (row_hash, time())
+
+            return
+
+        with self.lock:
+            # removed or changed while we were connecting
+            if self.hashes.get(account_id) != row_hash or not self.running:
+                bot.shutdown()
+                return
+
+            self.bots[account_id] = bot
+            self.failed.pop(account_id, None)
+
+            strat.schedule_funding(self.scheduler, bot, tag=account_id)
+
+        try:
+            bot.run_loop()
+        except (Exception, SystemExit) as e:
+            logger.error('bot for account %i exiting with exception: %s' % (account_id, e))
+
+            with self.lock:
+                # forget it, so the next sync starts it again
+                if self.bots.get(account_id) is bot:
+                    self.stop_bot(account_id)
+
+    def stop_bot(self, account_id: int) -> None:
+        self.scheduler.clear(account_id)
+
+        bot = self.bots.pop(account_id, None)
+
+        del self.hashes[account_id]
+
+        if bot is not None:
+            try:
+                bot.shutdown()
+            except Exception as e:
+                logger.error('error shutting down bot for account %i: %s' % (account_id, e))
+
+    def run(self) -> None:
+        scheduler = threading.Thread(target=self.scheduler.run, name='funding')
+        scheduler.daemon = True
+        scheduler.start()
+
+        while self.running:
+            try:
+                self.sync()
+            except sqlite3.Error as e:
+                logger.error('unable to read accounts from %s: %s' % (self.db_path, e))
+
+            sleep(settings.HOST_POLL_INTERVAL)
+
+    def exit(self, *args) -> None:
+        logger.info('shutting down %i bots' % len(self.bots))
+
+        with self.lock:
+            self.running = False
+
+            self.scheduler.stop()
+
+            for account_id in list(self.hashes):
+                self.stop_bot(account_id)
+
+        sys.exit()
+
+
+def main() -> None:
+    host = BotHost()
+
+    signal.signal(signal.SIGTERM, host.exit)
+    signal.signal(signal.SIGINT, host.exit)
+
+    host.run()
+
+
+if __name__ == '__main__':
+    main()
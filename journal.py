@@ -0,0 +1,357 @@
+"""execution journal
+
+every row of each bot's execution feed (fills, funding payments, and the New / Replaced /
+Canceled / Filled transitions of its orders) is appended to a sqlite database, so there's a
+record of what was traded, at what cost, and what funding it earned
+
+bots hand rows to the journal from their websocket listeners; a background thread writes
+them in batches, so nothing that trades ever waits on the disk
+
+    python3 journal.py [--db journal.db] [--account fundingbot] [--symbol XBTUSD]
+
+prints realised and funding pnl for each funding window
+"""
+
+import argparse
+import atexit
+from bisect import bisect_left
+from collections import defaultdict
+import queue
+import sqlite3
+import threading
+from time import monotonic
+
+from market_maker.settings import settings
+from market_maker.utils import constants, log
+from market_maker.ws.history import parse_timestamp
+
+import funding
+
+
+logger = log.setup_custom_logger('journal')
+
+# a batch is committed once it has this many rows, or this many seconds after its first one
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS executions (
+    exec_id TEXT PRIMARY KEY,
+    account TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    symbol TEXT,
+    exec_type TEXT,
+    order_id TEXT,
+    cl_ord_id TEXT,
+    side TEXT,
+    ord_type TEXT,
+    ord_status TEXT,
+    last_qty INTEGER,
+    last_px REAL,
+    exec_cost INTEGER,
+    exec_comm INTEGER,
+    commission REAL,
+    currency TEXT,
+    text TEXT
+);
+CREATE INDEX IF NOT EXISTS executions_symbol ON executions (account, symbol, timestamp);
+'''
+
+COLUMNS = ('exec_id', 'account', 'timestamp', 'symbol', 'exec_type', 'order_id', 'cl_ord_id',
+           'side', 'ord_type', 'ord_status', 'last_qty', 'last_px', 'exec_cost', 'exec_comm',
+           'commission', 'currency', 'text')
+
+INSERT = 'INSERT OR IGNORE INTO executions (%s) VALUES (%s)' % \
+    (', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)))
+
+# put on the queue to make the writer thread exit
+_STOP = object()
+
+# path -> Journal, so every bot in a process shares one writer per file
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+def connect(path: str) -> sqlite3.Connection:
+    db = sqlite3.connect(path, timeout=30)
+
+    # readers don't block the writer, nor it them
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+
+    db.executescript(SCHEMA)
+
+    return db
+
+
+def execution_row(account: str, row: dict) -> tuple:
+    return (row['execID'], account, parse_timestamp(row.get('transactTime') or row['timestamp']),
+            row.get('symbol'), row.get('execType'), row.get('orderID'), row.get('clOrdID'),
+            row.get('side'), row.get('ordType'), row.get('ordStatus'), row.get('lastQty'),
+            row.get('lastPx'), row.get('execCost'), row.get('execComm'), row.get('commission'),
+            row.get('settlCurrency') or row.get('currency'), row.get('text'))
+
+
+class Journal:
+    """appends executions to a sqlite file from a background thread, and answers pnl queries
+
+    use Journal.open(path) to share one per file
+    """
+
+    def __init__(self, path: str, batch_size: int = BATCH_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # the schema has to exist before anyone queries
+        connect(path).close()
+
+        # (account, rows) from the listeners, or an Event to set once everything before it is written
+        self.queue = queue.Queue()
+
+        self.thread = threading.Thread(target=self.__write, name='journal', daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def open(cls, path: str) -> 'Journal':
+        with _journals_lock:
+            if path not in _journals:
+                _journals[path] = cls(path)
+
+            return _journals[path]
+
+    def record(self, account: str, rows: list) -> None:
+        """queue execution rows; safe from any thread, and never touches the disk"""
+
+        if rows:
+            self.queue.put((account, rows))
+
+    def listener(self, account: str):
+        """an execution table listener that journals rows under account"""
+
+        def on_execution(table, action, data) -> None:
+            self.record(account, data)
+
+        return on_execution
+
+    def flush(self, timeout: float = None) -> bool:
+        """wait until everything queued so far is committed"""
+
+        done = threading.Event()
+
+        self.queue.put(done)
+
+        return done.wait(timeout)
+
+    def close(self) -> None:
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+
+            self.thread.join()
+
+    def __write(self) -> None:
+        db = connect(self.path)
+
+        running = True
+
+        while running:
+            batch, done = [], []
+
+            item = self.queue.get()
+
+            deadline = monotonic() + self.flush_interval
+
+            # gather whatever else turns up before the batch is due
+            while True:
+                if item is _STOP:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    done.append(item)
+                else:
+                    account, rows = item
+
+                    for row in rows:
+                        try:
+                            batch.append(execution_row(account, row))
+                        except (KeyError, TypeError, ValueError) as e:
+                            # it's lost from the journal, and windows() will be off from then on
+                            logger.error('unable to journal execution %s: %r' % (row, e))
+
+                if not running or done or len(batch) >= self.batch_size:
+                    break
+
+                try:
+                    item = self.queue.get(timeout=max(deadline - monotonic(), 0))
+                except queue.Empty:
+                    break
+
+            if batch:
+                try:
+                    with db:
+                        db.executemany(INSERT, batch)
+                except sqlite3.Error as e:
+                    logger.error('unable to write %i executions to %s: %s' % (len(batch), self.path, e))
+
+            for event in done:
+                event.set()
+
+        db.close()
+
+    def executions(self, account: str = None, symbol: str = None, exec_type: str = None,
+                   since: float = None, until: float = None) -> list:
+        """journalled executions as dicts, oldest first; times are epoch seconds"""
+
+        clauses, values = [], []
+
+        for column, operator, value in (('account', '=', account), ('symbol', '=', symbol),
+                                        ('exec_type', '=', exec_type), ('timestamp', '>=', since),
+                                        ('timestamp', '<', until)):
+            if value is not None:
+                clauses.append('%s %s ?' % (column, operator))
+                values.append(value)
+
+        query = 'SELECT %s FROM executions' % ', '.join(COLUMNS)
+
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+
+        db = connect(self.path)
+
+        try:
+            rows = db.execute(query + ' ORDER BY timestamp, rowid', values).fetchall()
+        finally:
+            db.close()
+
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def windows(self, account: str = None, symbol: str = None, since: float = None,
+                settle: float = None) -> list:
+        """realised and funding pnl per funding window, in XBT, oldest first
+
+        a funding window ends settle seconds after its funding payment, by when the exit should
+        have filled (by default FUNDING_EXIT_DELAY + EXIT_FILL_TIMEOUT, plus a minute); fills
+        after the last payment make up an open window with funding_time None
+
+        realised pnl is on average cost, carried across windows, so a position entered in one
+        window and closed in the next is realised in the next. it assumes the journal saw every
+        position opened: an execution that couldn't be journalled (logged as an error) is lost,
+        and every later window for its symbol is off by what it traded
+        """
+
+        if settle is None:
+            settle = settings.FUNDING_EXIT_DELAY + (settings.EXIT_FILL_TIMEOUT or 0) + funding.MIN_FLAT
+
+        by_symbol = defaultdict(list)
+
+        for execution in self.executions(account, symbol):
+            by_symbol[(execution['account'], execution['symbol'])].append(execution)
+
+        windows = []
+
+        for (account_, symbol_), executions in sorted(by_symbol.items()):
+            fundings = [e['timestamp'] for e in executions if e['exec_type'] == 'Funding']
+            ends = [t + settle for t in fundings]
+
+            found = {}
+
+            def window(timestamp: float) -> dict:
+                i = bisect_left(ends, timestamp)
+
+                if i not in found:
+                    found[i] = {'account': account_, 'symbol': symbol_,
+                                'funding_time': fundings[i] if i < len(fundings) else None,
+                                'fills': 0, 'traded': 0, 'realised': 0, 'fees': 0, 'funding': 0}
+
+                return found[i]
+
+            # position and its cost, as the exchange signs execCost
+            position = cost = 0
+
+            for execution in executions:
+                if execution['exec_type'] == 'Funding':
+                    # execComm is what was paid, so negative when funding was received
+                    window(execution['timestamp'])['funding'] -= execution['exec_comm'] or 0
+
+                elif execution['exec_type'] == 'Trade' and execution['last_qty']:
+                    current = window(execution['timestamp'])
+
+                    quantity = execution['last_qty'] * (1 if execution['side'] == 'Buy' else -1)
+                    fill_cost = execution['exec_cost'] or 0
+
+                    current['fills'] += 1
+                    current['traded'] += abs(quantity)
+                    current['fees'] += execution['exec_comm'] or 0
+
+                    if position and (position > 0) != (quantity > 0):
+                        closed = min(abs(quantity), abs(position))
+
+                        released = cost * closed / abs(position)
+                        used = fill_cost * closed / abs(quantity)
+
+                        # what was paid to open less what came back closing
+                        current['realised'] -= released + used
+
+                        cost -= released
+                        fill_cost -= used
+
+                        position += closed * (1 if quantity > 0 else -1)
+                        quantity -= closed * (1 if quantity > 0 else -1)
+
+                    position += quantity
+                    cost += fill_cost
+
+            windows += found.values()
+
+        for window_ in windows:
+            for key in ('realised', 'fees', 'funding'):
+                window_[key] /= constants.XBt_TO_XBT
+
+            window_['pnl'] = window_['realised'] - window_['fees'] + window_['funding']
+
+        windows.sort(key=lambda w: (w['funding_time'] is None, w['funding_time'] or 0))
+
+        if since is not None:
+            windows = [w for w in windows if w['funding_time'] is None or w['funding_time'] >= since]
+
+        return windows
+
+    def totals(self, account: str = None, symbol: str = None, since: float = None) -> dict:
+        """realised, fees, funding and pnl summed over the windows since a time"""
+
+        windows = self.windows(account, symbol, since)
+
+        return {key: sum(w[key] for w in windows) for key in ('realised', 'fees', 'funding', 'pnl')}
+
+
+@atexit.register
+def close_all() -> None:
+    with _journals_lock:
+        for journal in _journals.values():
+            journal.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='realised and funding pnl per funding window')
+    parser.add_argument('--db', default=settings.JOURNAL_PATH or 'journal.db')
+    parser.add_argument('--account', help='bot name, e.g. fundingbot or fundingbot3 under host.py')
+    parser.add_argument('--symbol')
+    parser.add_argument('--settle', type=float, help='seconds after funding a window ends')
+    args = parser.parse_args()
+
+    windows = Journal(args.db).windows(args.account, args.symbol, settle=args.settle)
+
+    print('%-14s %-8s %-23s %6s %9s %12s %12s %12s %12s' %
+          ('account', 'symbol', 'funding', 'fills', 'traded', 'realised', 'fees', 'funding', 'pnl'))
+
+    for w in windows:
+        print('%-14s %-8s %-23s %6i %9i %+12.8f %12.8f %+12.8f %+12.8f' %
+              (w['account'], w['symbol'],
+               'open' if w['funding_time'] is None else funding.format_time(w['funding_time']),
+               w['fills'], w['traded'], w['realised'], w['fees'], w['funding'], w['pnl']))
+
+    print('total pnl: %+.8f XBT over %i windows' % (sum(w['pnl'] for w in windows), len(windows)))
+
+
+if __name__ == '__main__':
+    main()
@@ -92,6 +92,30 @@ API_REST_INTERVAL = 1
 API_ERROR_INTERVAL = 10
 TIMEOUT = 7
 
+# Independent REST requests (e.g. new stops for one symbol and cancels for another) are sent concurrently, up to
+# API_MAX_IN_FLIGHT at a time, over a pool of API_POOL_SIZE keep-alive connections.
+API_MAX_IN_FLIGHT = 4
+API_POOL_SIZE = 8
+
+# Requests that can safely be sent twice are retried up to API_MAX_RETRIES times, backing off with jitter. That
+# includes new orders, which keep their clOrdID across attempts, and amends that don't use leavesQty. When a
+# response is lost, the websocket order table is checked first and only what didn't go through is resent.
+API_MAX_RETRIES = 3
+
+# If set, every raw websocket frame is appended to this file (use a .gz name to compress it).
+# Replay it offline with `python -m market_maker.ws.recorder bench <file>`.
+WS_RECORD_FILE = None
+
+# Trades and quotes kept per symbol for VWAP and volatility (see BitMEXWebsocket.vwap). Older rows are overwritten.
+WS_HISTORY_DEPTH = 1000
+
+# Stream the full L2 order book (orderBookL2) for each symbol, so entries and hedges are priced against real
+# liquidity rather than top of book. It's a lot of messages; off by default.
+WS_ORDER_BOOK = False
+
+# JSON library used to decode websocket frames: 'orjson', 'ujson' or 'json'. None picks the fastest one installed.
+WS_JSON_DECODER = None
+
 # If we're doing a dry run, use these numbers for BTC balances
 DRY_BTC = 50
 
@@ -111,6 +135,50 @@ ORDERID_PREFIX = "mm_bitmex_"
 WATCHED_FILES = [join('market_maker', 'market_maker.py'), join('market_maker', 'bitmex.py'), 'settings.py']
 
 
+########################################################################################################################
+# Funding Bot
+########################################################################################################################
+
+# If True, the funding bot reprices and places stops as soon as a quote, order or position update arrives on the
+# websocket. LOOP_INTERVAL then only sets how often it re-checks when nothing has happened.
+EVENT_DRIVEN = True
+
+# The funding bot enters a position FUNDING_ENTRY_LEAD seconds before each funding event (but at least a minute after
+# the previous one's exit) and exits FUNDING_EXIT_DELAY seconds after it. Both are timed from the instrument's fundingTimestamp.
+FUNDING_ENTRY_LEAD = 4 * 60 * 60 + 10 * 60
+FUNDING_EXIT_DELAY = 1
+
+# Seconds an exit waits for its limit order to fill before cancelling it and closing at market. None waits forever.
+EXIT_FILL_TIMEOUT = 300
+
+# Every fill, funding payment and order transition is appended to this sqlite file (see journal.py, which also
+# reports pnl per funding window). Bots in one process share it, each under its own name. None turns it off.
+JOURNAL_PATH = 'journal.db'
+
+# Each funding bot snapshots its flags, position and open orders to <STATE_DIR>/<name>.json whenever they change. A
+# restart with the same settings resumes from it, keeping stops that still fit instead of cancelling every order, and
+# a reconnect reconciles the same way. None turns it off, so every start cancels everything as before.
+STATE_DIR = 'state'
+
+# Each funding bot times every stage from a quote arriving to its orders coming back on the websocket, and REST calls
+# per endpoint. Every LATENCY_LOG_INTERVAL seconds it logs p50/p99/max per stage over the interval (None turns that
+# off). With METRICS_PORT set, localhost:<METRICS_PORT>/metrics serves them for Prometheus, for every bot in the process,
+# along with each bot's position, margin balance, open orders, funding rate, websocket messages and reconnects, REST
+# errors by status and rate limit remaining.
+LATENCY_LOG_INTERVAL = 60
+METRICS_PORT = None
+
+# Seconds of trades the funding bot's VWAP covers when it reports on entries and status.
+VWAP_WINDOW = 300
+
+# host.py runs one bot per row of the web app's settings table, all in one process. It re-reads the table every
+# HOST_POLL_INTERVAL seconds to pick up new, changed and deleted accounts. Every bot's REST requests share one pool
+# of HOST_POOL_SIZE keep-alive connections.
+HOST_DB_PATH = 'web-app/fundonebot.db'
+HOST_POLL_INTERVAL = 5
+HOST_POOL_SIZE = 32
+
+
 ########################################################################################################################
 # BitMEX Portfolio
 ########################################################################################################################
@@ -0,0 +1,384 @@
+"""asyncio flavour of the BitMEX connector.
+
+AsyncBitMEX has BitMEX's interface, but every REST call is a coroutine sent over an aiohttp
+session with keep-alive, and the websocket is read by a task on the same event loop instead of
+a thread. The bot, its listeners and any number of accounts can then share one thread:
+
+    bitmex = AsyncBitMEX(base_url=settings.BASE_URL, symbols=['XBTUSD', 'ETHUSD'],
+                         apiKey=settings.API_KEY, apiSecret=settings.API_SECRET)
+    await bitmex.connect()
+    await bitmex.create_bulk_orders([...])
+
+Websocket-backed getters (instrument, position, open_orders, ...) stay plain methods. Needs
+aiohttp (pip install aiohttp); nothing else in the package does.
+"""
+from __future__ import absolute_import
+import asyncio
+import datetime
+import json
+import logging
+import time
+from urllib.parse import urlencode
+
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:
+    aiohttp = None
+
+from market_maker.auth import RequestSigner
+from market_maker.bitmex import BitMEX, is_idempotent, order_keys, order_list, same_order
+from market_maker.utils import constants, errors, fastjson
+from market_maker.utils.latency import LatencyRecorder
+from market_maker.utils.metrics import Metrics
+from market_maker.utils.ratelimit import AsyncRateLimiter, backoff, PRIORITY_NORMAL
+from market_maker.ws.ws_thread import BitMEXWebsocket
+
+
+class AsyncBitMEXWebsocket(BitMEXWebsocket):
+
+    """BitMEXWebsocket read by an asyncio task rather than a thread.
+
+    Tables, getters and listeners are the base class's; listeners run on the event loop."""
+
+    reader = None
+
+    async def connect(self, endpoint="", symbol="XBTUSD", shouldAuth=True, apiKey=None, apiSecret=None,
+                      session=None):
+        '''Connect over the given aiohttp session and wait for the data images.'''
+        wsURL = self.prepare(endpoint, symbol, shouldAuth, apiKey, apiSecret)
+        self.logger.info("Connecting to %s" % wsURL)
+
+        headers = dict(header.split(':', 1) for header in self.auth_headers())
+        self.ws = await session.ws_connect(wsURL, headers={k.strip(): v.strip() for k, v in headers.items()},
+                                           heartbeat=30)
+        self.reader = asyncio.ensure_future(self.__read())
+        self.logger.info('Connected to WS. Waiting for data images, this may take a moment...')
+
+        while not self.ready():
+            if self.exited:
+                raise Exception("Websocket closed before the data images arrived: %s" % self._error)
+            await asyncio.sleep(0.1)
+        self.logger.info('Got all market data. Starting.')
+
+    def exit(self):
+        # ws.close() is a coroutine here, so it can only be scheduled; close() awaits it
+        self.exited = True
+        if self.ws is not None and not self.ws.closed:
+            try:
+                asyncio.get_running_loop().create_task(self.ws.close())
+            except RuntimeError:
+                pass  # no loop left to close it on, e.g. at interpreter exit
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    async def close(self):
+        self.exit()
+        if self.ws is not None:
+            await self.ws.close()
+        if self.reader is not None:
+            await self.reader
+
+    async def wait_for_position(self, symbol, qty=0, timeout=None):
+        '''BitMEXWebsocket.wait_for_position, awaited instead of blocking the loop.'''
+        return await self.__wait_for('position', lambda: self.position(symbol)['currentQty'] == qty, timeout)
+
+    async def wait_for_orders(self, check, timeout=None):
+        '''BitMEXWebsocket.wait_for_orders, awaited instead of blocking the loop.'''
+        return await self.__wait_for('order', check, timeout)
+
+    async def __wait_for(self, table, check, timeout):
+        '''Wait until check() is truthy, calling it again after each message for table. Returns its last result.'''
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        changed = asyncio.Event()
+
+        def listener(table, action, data):
+            changed.set()
+
+        self.add_listener(table, listener)
+        try:
+            while not self.exited and not check():
+                remaining = None if deadline is None else deadline - loop.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                # The reader finishing means the socket closed, which ends the wait too
+                waiter = asyncio.ensure_future(changed.wait())
+                done, _ = await asyncio.wait([waiter, self.reader], timeout=remaining,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                if not done:
+                    break
+                changed.clear()
+        finally:
+            self.remove_listener(table, listener)
+        return check()
+
+    async def __read(self):
+        try:
+            async for message in self.ws:
+                if message.type == aiohttp.WSMsgType.TEXT:
+                    self.feed(message.data)
+                elif message.type == aiohttp.WSMsgType.ERROR:
+                    self.error(self.ws.exception())
+        finally:
+            if not self.exited:
+                self.logger.info('Websocket Closed')
+                self.exit()
+
+
+class AsyncBitMEX(BitMEX):
+
+    """BitMEX API Connector whose REST calls are awaited.
+
+    Pass an aiohttp.ClientSession to share its connection pool with other connectors; otherwise
+    connect() opens one and close() closes it."""
+
+    def __init__(self, base_url=None, symbol=None, apiKey=None, apiSecret=None,
+                 orderIDPrefix='mm_bitmex_', shouldWSAuth=True, postOnly=False, timeout=7, symbols=None,
+                 session=None, max_retries=3):
+        """Init connector. Nothing is opened until connect() is awaited."""
+        if aiohttp is None:
+            raise ImportError("AsyncBitMEX needs aiohttp: pip install aiohttp")
+        self.logger = logging.getLogger('root')
+        self.base_url = base_url
+        self.symbols = symbols or [symbol]
+        self.symbol = symbol or self.symbols[0]
+        self.postOnly = postOnly
+        if (apiKey is None):
+            raise Exception("Please set an API key and Secret to get started. See " +
+                            "https://github.com/BitMEX/sample-market-maker/#getting-started for more information."
+                            )
+        self.apiKey = apiKey
+        self.apiSecret = apiSecret
+        if len(orderIDPrefix) > 13:
+            raise ValueError("settings.ORDERID_PREFIX must be at most 13 characters long!")
+        self.orderIDPrefix = orderIDPrefix
+        self.shouldWSAuth = shouldWSAuth
+        self.timeout = timeout
+        self.max_retries = max_retries
+
+        self.ratelimiter = AsyncRateLimiter()
+
+        # Timings of each stage from quote to order, and health gauges and counters; the websocket
+        # records into both
+        self.latency = LatencyRecorder()
+        self.metrics = Metrics()
+
+        # No thread pool: requests are awaited, so independent ones already overlap
+        self.dispatcher = None
+
+        self.session = session
+        self.ownsSession = session is None
+        # These headers are always sent. They go on each request, as a shared session isn't ours to change.
+        self.headers = {'user-agent': 'liquidbot-' + constants.VERSION,
+                        'content-type': 'application/json',
+                        'accept': 'application/json'}
+
+        # Signs every request; bodies are compact JSON, signed and sent as the same bytes
+        self.signer = RequestSigner(apiKey, apiSecret, base_url)
+        self.dumps = fastjson.encoder()
+
+        self.ws = AsyncBitMEXWebsocket(latency=self.latency, metrics=self.metrics)
+
+    async def connect(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        await self.ws.connect(self.base_url, self.symbols, shouldAuth=self.shouldWSAuth,
+                              apiKey=self.apiKey, apiSecret=self.apiSecret, session=self.session)
+        self.metrics.watch(self.ws, self.symbols, self.orderIDPrefix)
+
+    async def reconnect(self):
+        """Replace the websocket with a freshly connected one. The HTTP session and rate limiter carry over."""
+        await self.ws.close()
+        self.metrics.inc('ws_reconnects_total')
+        self.ws = AsyncBitMEXWebsocket(latency=self.latency, metrics=self.metrics)
+        await self.connect()
+
+    async def close(self):
+        await self.ws.close()
+        if self.ownsSession and self.session is not None:
+            await self.session.close()
+
+    async def http_open_orders(self):
+        """Get open orders via HTTP. Used on close to ensure we catch them all."""
+        orders = await self._curl_bitmex(
+            path="order",
+            query={
+                'filter': json.dumps({'ordStatus.isTerminated': False}),
+                'count': 500
+            },
+            verb="GET"
+        )
+        # Only return orders that start with our clOrdID prefix, on the symbols we trade.
+        return [o for o in orders if str(o['clOrdID']).startswith(self.orderIDPrefix) and
+                o['symbol'] in self.symbols]
+
+    async def _wait_for_outcomes(self, verb, orders):
+        """BitMEX._wait_for_outcomes, awaited."""
+        def outcomes():
+            rows = [self._order_outcome(verb, order) for order in orders]
+            return rows if all(rows) else None
+
+        await self.ws.wait_for_orders(outcomes, self.RESOLVE_TIMEOUT)
+        return [dict(row) if row is not None else None
+                for row in (self._order_outcome(verb, order) for order in orders)]
+
+    async def _curl_bitmex(self, path, query=None, postdict=None, timeout=None, verb=None, rethrow_errors=False,
+                           max_retries=None, priority=PRIORITY_NORMAL, attempt=0):
+        """Send a request to BitMEX Servers.
+
+        Errors are always raised, never exit(): one event loop may be running many accounts.
+        rethrow_errors is accepted so BitMEX's methods can pass it through."""
+        # Handle URL. The query string is signed exactly as it is sent
+        target = path + '?' + urlencode(query) if query else path
+        url = self.base_url + target
+
+        if timeout is None:
+            timeout = self.timeout
+
+        # Default to POST if data is attached, GET otherwise
+        if not verb:
+            verb = 'POST' if postdict else 'GET'
+
+        # Only retry requests that are safe to send twice; see is_idempotent
+        if max_retries is None:
+            max_retries = self.max_retries if is_idempotent(verb, path, postdict) else 0
+
+        # As is the body: compact JSON, encoded once
+        body = self.dumps(postdict) if postdict else b''
+
+        async def retry(postdict=postdict, wait=True):
+            if attempt >= max_retries:
+                raise Exception("Max retries on %s (%s) hit, raising." % (path, json.dumps(postdict or '')))
+            if wait:
+                await asyncio.sleep(backoff(attempt))
+            return await self._curl_bitmex(path, query, postdict, timeout, verb, rethrow_errors, max_retries,
+                                           priority, attempt + 1)
+
+        async def resolve():
+            # As in BitMEX._curl_bitmex: resend only the orders the order table doesn't show went through
+            if verb not in ('POST', 'PUT') or not path.startswith('order') or \
+                    not is_idempotent(verb, path, postdict):
+                return await retry()
+            orders = order_list(postdict)
+            rows = await self._wait_for_outcomes(verb, orders)
+            remaining = [order for order, row in zip(orders, rows) if row is None]
+            done = [row for row in rows if row is not None]
+            if not remaining:
+                self.logger.info("%s %s went through after all." % (verb, path))
+                return done if 'orders' in postdict else done[0]
+            if 'orders' not in postdict:
+                return await retry()
+            return done + await retry({'orders': remaining})
+
+        # Make the request
+        queued = time.perf_counter()
+        await self.ratelimiter.acquire(priority)
+        headers = dict(self.headers)
+        headers.update(self.signer.headers(verb, target, body))
+
+        try:
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("sending req to %s %s: %s" % (verb, url, body.decode('utf8')))
+            sent = time.perf_counter()
+            self.latency.record('ratelimit_wait', sent - queued)
+            # Before sending, as the order table can show the result before the response arrives
+            if postdict and verb in self.ORDER_STAGES and path.startswith('order'):
+                self.ws.expect_orders(order_keys(verb, postdict), self.ORDER_STAGES[verb], sent)
+            # encoded=True so the URL goes out byte for byte as it was signed
+            async with self.session.request(verb, URL(url, encoded=True), data=body or None, headers=headers,
+                                            timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                self.ratelimiter.update(response.headers)
+                if 'X-RateLimit-Remaining' in response.headers:
+                    self.metrics.set('ratelimit_remaining', int(response.headers['X-RateLimit-Remaining']))
+                text = await response.text()
+                self.latency.record('rest %s %s' % (verb, path), time.perf_counter() - sent)
+                if response.status < 400:
+                    return json.loads(text)
+                try:
+                    response.raise_for_status()
+                except aiohttp.ClientResponseError as e:
+                    error = e
+
+        except asyncio.TimeoutError:
+            self.metrics.inc('rest_errors_total', status='timeout')
+            # Timeout; find out whether it went through, and re-run what didn't
+            self.logger.warning("Timed out on request: %s (%s), retrying..." % (path, json.dumps(postdict or '')))
+            return await resolve()
+
+        except aiohttp.ClientConnectionError as e:
+            self.metrics.inc('rest_errors_total', status='connection')
+            self.logger.warning("Unable to contact the BitMEX API (%s). Please check the URL. Retrying. "
+                                "Request: %s \n %s" % (e, url, json.dumps(postdict)))
+            return await resolve()
+
+        self.metrics.inc('rest_errors_total', status=str(response.status))
+
+        # 401 - Auth error. This is fatal for this account.
+        if response.status == 401:
+            self.logger.error("API Key or Secret incorrect, please check and restart.")
+            self.logger.error("Error: " + text)
+            raise errors.AuthenticationError(text)
+
+        # 404, can be thrown if order canceled or does not exist.
+        elif response.status == 404:
+            if verb == 'DELETE':
+                self.logger.error("Order not found: %s" % postdict['orderID'])
+                return
+            self.logger.error("Unable to contact the BitMEX API (404). " +
+                              "Request: %s \n %s" % (url, json.dumps(postdict)))
+            raise error
+
+        # 429, ratelimit; hold all requests until X-RateLimit-Reset
+        elif response.status == 429:
+            self.logger.error("Ratelimited on current request. Waiting, then trying again. " +
+                              "Request: %s \n %s" % (url, json.dumps(postdict)))
+            ratelimit_reset = int(response.headers['X-RateLimit-Reset'])
+            reset_str = datetime.datetime.fromtimestamp(ratelimit_reset).strftime('%X')
+            self.logger.error("Your ratelimit will reset at %s. Waiting for %d seconds." %
+                              (reset_str, ratelimit_reset - int(time.time())))
+            self.ratelimiter.block_until(ratelimit_reset)
+            return await retry(wait=False)
+
+        # 503 - BitMEX temporary downtime, likely due to a deploy. The request wasn't processed; try again
+        elif response.status == 503:
+            self.logger.warning("Unable to contact the BitMEX API (503), retrying. " +
+                                "Request: %s \n %s" % (url, json.dumps(postdict)))
+            return await retry()
+
+        # 502/504 - a gateway gave up waiting, so the request may still have gone through
+        elif response.status in (502, 504):
+            self.logger.warning("No response from the BitMEX API (%d), checking and retrying. "
+                                "Request: %s \n %s" % (response.status, url, json.dumps(postdict)))
+            return await resolve()
+
+        elif response.status == 400:
+            message = (json.loads(text).get('error') or {}).get('message', '').lower()
+
+            # Duplicate clOrdID: an earlier attempt went through. Find the order(s) and return them
+            if 'duplicate clordid' in message:
+                orders = order_list(postdict)
+                rows = await self._wait_for_outcomes(verb, orders)
+                if not all(rows):
+                    # Not on the order table (e.g. it was placed before a reconnect); ask for them
+                    IDs = json.dumps({'clOrdID': [order['clOrdID'] for order in orders]})
+                    found = {row['clOrdID']: row for row in await self._curl_bitmex('order', query={'filter': IDs},
+                                                                                     verb='GET')}
+                    rows = [found.get(order['clOrdID']) for order in orders]
+                for order, row in zip(orders, rows):
+                    if row is None or not same_order(order, row):
+                        raise Exception('Attempted to recover from duplicate clOrdID, but order returned from API '
+                                        'did not match POST.\nPOST data: %s\nReturned order: %s' % (
+                                            json.dumps(order), json.dumps(row)))
+                return rows if 'orders' in postdict else rows[0]
+
+            elif 'insufficient available balance' in message:
+                self.logger.error('Account out of funds. The message: %s' % message)
+                raise Exception('Insufficient Funds')
+
+        # If we haven't returned or re-raised yet, we get here.
+        self.logger.error("Unhandled Error: %s: %s" % (error, text))
+        self.logger.error("Endpoint was: %s %s: %s" % (verb, path, json.dumps(postdict)))
+        raise error
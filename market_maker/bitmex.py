@@ -1,28 +1,98 @@
 """BitMEX API Connector."""
 from __future__ import absolute_import
 import requests
+from requests.adapters import HTTPAdapter
 import time
 import datetime
 import json
 import base64
 import uuid
 import logging
-from market_maker.auth import APIKeyAuthWithExpires
-from market_maker.utils import constants, errors
+from urllib.parse import urlencode
+from market_maker.auth import RequestSigner, prepare
+from market_maker.utils import constants, errors, fastjson
+from market_maker.utils.dispatch import Dispatcher
+from market_maker.utils.latency import LatencyRecorder
+from market_maker.utils.metrics import Metrics
+from market_maker.utils.ratelimit import RateLimiter, backoff, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
 from market_maker.ws.ws_thread import BitMEXWebsocket
 
 
+# An amend to an order in one of these states can't change it any more, so there's nothing to resend.
+TERMINATED = ('Filled', 'Canceled', 'Rejected')
+
+# The fields an amend sets, compared against the order table to tell whether it went through.
+AMEND_FIELDS = ('orderQty', 'leavesQty', 'price', 'stopPx', 'pegOffsetValue')
+
+
+def order_list(postdict):
+    """The orders in an order or order/bulk payload."""
+    return postdict['orders'] if 'orders' in postdict else [postdict]
+
+
+def is_idempotent(verb, path, postdict):
+    """Whether sending this request twice has the same effect as sending it once.
+
+    New orders are when each has a clOrdID, because the exchange refuses a second order with the
+    same one. Amends are unless they use leavesQty, which is relative to what has filled."""
+    if verb in ('GET', 'DELETE'):
+        return True
+    if not postdict or not path.startswith('order'):
+        return False
+    orders = order_list(postdict)
+    if verb == 'POST':
+        return all(order.get('clOrdID') for order in orders)
+    if verb == 'PUT':
+        return all('orderID' in order and 'leavesQty' not in order for order in orders)
+    return False
+
+
+def order_keys(verb, postdict):
+    """How the order table will identify the orders a request touches: clOrdIDs of new orders,
+    orderIDs of amended or canceled ones."""
+    if verb == 'DELETE':
+        orderIDs = postdict.get('orderID') or []
+        return [orderIDs] if isinstance(orderIDs, str) else orderIDs
+    return [order.get('clOrdID' if verb == 'POST' else 'orderID') for order in order_list(postdict)]
+
+
+def same_order(order, row):
+    """Whether an order row from the exchange is the one this order payload asked for."""
+    if 'side' in order:
+        side = order['side']
+    else:
+        side = 'Buy' if order.get('orderQty', 0) > 0 else 'Sell'
+    return (row['symbol'] == order['symbol'] and row['side'] == side and
+            ('orderQty' not in order or row['orderQty'] == abs(order['orderQty'])) and
+            all(row.get(key) == order[key] for key in ('price', 'stopPx') if key in order))
+
+
 # https://www.bitmex.com/api/explorer/
 class BitMEX(object):
 
     """BitMEX API Connector."""
 
+    # Seconds to wait for the order table to show what happened to a request we got no answer to
+    RESOLVE_TIMEOUT = 2
+
+    # Latency stages timed from sending an order request until the order table shows its effect
+    ORDER_STAGES = {'POST': 'order_to_ws', 'PUT': 'amend_to_ws', 'DELETE': 'cancel_to_ws'}
+
     def __init__(self, base_url=None, symbol=None, apiKey=None, apiSecret=None,
-                 orderIDPrefix='mm_bitmex_', shouldWSAuth=True, postOnly=False, timeout=7):
-        """Init connector."""
+                 orderIDPrefix='mm_bitmex_', shouldWSAuth=True, postOnly=False, timeout=7, symbols=None,
+                 session=None, max_in_flight=4, pool_size=8, max_retries=3):
+        """Init connector.
+
+        Pass symbols to stream several instruments over one websocket; symbol is then the default
+        for calls that don't name one. Pass a requests.Session to share its connection pool with
+        other connectors; auth is per request, so accounts never see each other's keys. Otherwise
+        the connector keeps pool_size connections of its own. Up to max_in_flight calls handed to
+        dispatch() are sent at once. Requests that are safe to repeat are retried up to max_retries
+        times."""
         self.logger = logging.getLogger('root')
         self.base_url = base_url
-        self.symbol = symbol
+        self.symbols = symbols or [symbol]
+        self.symbol = symbol or self.symbols[0]
         self.postOnly = postOnly
         if (apiKey is None):
             raise Exception("Please set an API key and Secret to get started. See " +
@@ -33,18 +103,41 @@ class BitMEX(object):
         if len(orderIDPrefix) > 13:
             raise ValueError("settings.ORDERID_PREFIX must be at most 13 characters long!")
         self.orderIDPrefix = orderIDPrefix
-        self.retries = 0  # initialize counter
+        self.shouldWSAuth = shouldWSAuth
+        self.max_retries = max_retries
+
+        # Every request goes through this, so bursts are allowed while we have budget
+        self.ratelimiter = RateLimiter()
+
+        # Timings of each stage from quote to order, and health gauges and counters; the websocket
+        # records into both
+        self.latency = LatencyRecorder()
+        self.metrics = Metrics()
 
         # Prepare HTTPS session
-        self.session = requests.Session()
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self.session = session
+
+        # Sends independent requests concurrently; see dispatch()
+        self.dispatcher = Dispatcher(max_in_flight)
         # These headers are always sent
         self.session.headers.update({'user-agent': 'liquidbot-' + constants.VERSION})
         self.session.headers.update({'content-type': 'application/json'})
         self.session.headers.update({'accept': 'application/json'})
+        self.headers = dict(self.session.headers)
+
+        # Signs every request; bodies are compact JSON, signed and sent as the same bytes
+        self.signer = RequestSigner(apiKey, apiSecret, base_url)
+        self.dumps = fastjson.encoder()
 
         # Create websocket for streaming data
-        self.ws = BitMEXWebsocket()
-        self.ws.connect(base_url, symbol, shouldAuth=shouldWSAuth)
+        self.ws = BitMEXWebsocket(latency=self.latency, metrics=self.metrics)
+        self.ws.connect(base_url, self.symbols, shouldAuth=shouldWSAuth, apiKey=apiKey, apiSecret=apiSecret)
+        self.metrics.watch(self.ws, self.symbols, self.orderIDPrefix)
 
         self.timeout = timeout
 
@@ -53,6 +146,24 @@ class BitMEX(object):
 
     def exit(self):
         self.ws.exit()
+        if self.dispatcher is not None:
+            self.dispatcher.shutdown(wait=False)
+
+    def dispatch(self, fn, *args, key=None, **kwargs):
+        """Call fn (usually one of our methods) on the dispatcher, returning a Future.
+
+        Calls with the same key are sent one after another, in order; others overlap."""
+        return self.dispatcher.submit(fn, *args, key=key, **kwargs)
+
+    def reconnect(self):
+        """Replace the websocket with a freshly connected one. The HTTP session and rate limiter carry over."""
+        self.ws.exit()
+        self.metrics.inc('ws_reconnects_total')
+        ws = BitMEXWebsocket(latency=self.latency, metrics=self.metrics)
+        ws.connect(self.base_url, self.symbols, shouldAuth=self.shouldWSAuth, apiKey=self.apiKey,
+                   apiSecret=self.apiSecret)
+        self.metrics.watch(ws, self.symbols, self.orderIDPrefix)
+        self.ws = ws
 
     #
     # Public methods
@@ -77,6 +188,14 @@ class BitMEX(object):
         """Get market depth / orderbook."""
         return self.ws.market_depth(symbol)
 
+    def vwap(self, symbol=None, seconds=None):
+        """Volume-weighted average trade price over the kept trade history, or its last `seconds`."""
+        return self.ws.vwap(symbol or self.symbol, seconds)
+
+    def volatility(self, symbol=None, trades=None):
+        """Standard deviation of trade-to-trade log returns over the last `trades` trades."""
+        return self.ws.volatility(symbol or self.symbol, trades)
+
     def recent_trades(self):
         """Get recent trades.
 
@@ -114,6 +233,10 @@ class BitMEX(object):
         """Get your open position."""
         return self.ws.position(symbol)
 
+    def wait_for_position(self, symbol, qty=0, timeout=None):
+        """Wait until the position in symbol is qty contracts. False on timeout."""
+        return self.ws.wait_for_position(symbol, qty, timeout)
+
     @authentication_required
     def isolate_margin(self, symbol, leverage, rethrow_errors=False):
         """Set the leverage on an isolated margin position"""
@@ -165,22 +288,29 @@ class BitMEX(object):
     def amend_bulk_orders(self, orders):
         """Amend multiple orders."""
         # Note rethrow; if this fails, we want to catch it and re-tick
-        return self._curl_bitmex(path='order/bulk', postdict={'orders': orders}, verb='PUT', rethrow_errors=True)
+        return self._curl_bitmex(path='order/bulk', postdict={'orders': orders}, verb='PUT', rethrow_errors=True,
+                                 priority=PRIORITY_LOW)
 
     @authentication_required
     def create_bulk_orders(self, orders):
         """Create multiple orders."""
         for order in orders:
-            order['clOrdID'] = self.orderIDPrefix + base64.b64encode(uuid.uuid4().bytes).decode('utf8').rstrip('=\n')
-            order['symbol'] = self.symbol
+            # Kept if already set, so an order that is sent again can't be placed twice
+            order.setdefault('clOrdID', self.orderIDPrefix +
+                             base64.b64encode(uuid.uuid4().bytes).decode('utf8').rstrip('=\n'))
+            # Orders for any of our symbols can share one bulk request
+            order.setdefault('symbol', self.symbol)
             if self.postOnly:
                 order['execInst'] = 'ParticipateDoNotInitiate'
-        return self._curl_bitmex(path='order/bulk', postdict={'orders': orders}, verb='POST')
+        # Stops protect open positions, so they jump the queue ahead of everything else
+        is_stop = any('Stop' in order.get('ordType', '') for order in orders)
+        return self._curl_bitmex(path='order/bulk', postdict={'orders': orders}, verb='POST',
+                                 priority=PRIORITY_HIGH if is_stop else PRIORITY_NORMAL)
 
     @authentication_required
-    def open_orders(self):
-        """Get open orders."""
-        return self.ws.open_orders(self.orderIDPrefix)
+    def open_orders(self, symbol=None):
+        """Get open orders, for all of our symbols unless one is given."""
+        return self.ws.open_orders(self.orderIDPrefix, symbol)
 
     @authentication_required
     def http_open_orders(self):
@@ -189,13 +319,14 @@ class BitMEX(object):
         orders = self._curl_bitmex(
             path=path,
             query={
-                'filter': json.dumps({'ordStatus.isTerminated': False, 'symbol': self.symbol}),
+                'filter': json.dumps({'ordStatus.isTerminated': False}),
                 'count': 500
             },
             verb="GET"
         )
-        # Only return orders that start with our clOrdID prefix.
-        return [o for o in orders if str(o['clOrdID']).startswith(self.orderIDPrefix)]
+        # Only return orders that start with our clOrdID prefix, on the symbols we trade.
+        return [o for o in orders if str(o['clOrdID']).startswith(self.orderIDPrefix) and
+                o['symbol'] in self.symbols]
 
     @authentication_required
     def cancel(self, orderID):
@@ -217,11 +348,35 @@ class BitMEX(object):
         }
         return self._curl_bitmex(path=path, postdict=postdict, verb="POST", max_retries=0)
 
+    def _order_outcome(self, verb, order):
+        """The order table's row showing that this new order or amend went through, or None."""
+        if verb == 'POST':
+            return self.ws.find_order(clOrdID=order['clOrdID'])
+        row = self.ws.find_order(orderID=order['orderID'])
+        if row is not None and (row['ordStatus'] in TERMINATED or
+                                all(row.get(key) == order[key] for key in AMEND_FIELDS if key in order)):
+            return row
+        return None
+
+    def _wait_for_outcomes(self, verb, orders):
+        """Give the order table up to RESOLVE_TIMEOUT to show each order's outcome; a row or None for each."""
+        def outcomes():
+            rows = [self._order_outcome(verb, order) for order in orders]
+            return rows if all(rows) else None
+
+        self.ws.wait_for_orders(outcomes, self.RESOLVE_TIMEOUT)
+        # Copies, so whoever gets the result can't change the table
+        return [dict(row) if row is not None else None
+                for row in (self._order_outcome(verb, order) for order in orders)]
+
     def _curl_bitmex(self, path, query=None, postdict=None, timeout=None, verb=None, rethrow_errors=False,
-                     max_retries=None):
-        """Send a request to BitMEX Servers."""
-        # Handle URL
-        url = self.base_url + path
+                     max_retries=None, priority=PRIORITY_NORMAL, attempt=0):
+        """Send a request to BitMEX Servers.
+
+        attempt counts the tries before this one; each call has its own max_retries budget."""
+        # Handle URL. The query string is signed exactly as it is sent
+        target = path + '?' + urlencode(query) if query else path
+        url = self.base_url + target
 
         if timeout is None:
             timeout = self.timeout
@@ -230,15 +385,12 @@ class BitMEX(object):
         if not verb:
             verb = 'POST' if postdict else 'GET'
 
-        # By default don't retry POST or PUT. Retrying GET/DELETE is okay because they are idempotent.
-        # In the future we could allow retrying PUT, so long as 'leavesQty' is not used (not idempotent),
-        # or you could change the clOrdID (set {"clOrdID": "new", "origClOrdID": "old"}) so that an amend
-        # can't erroneously be applied twice.
+        # Only retry requests that are safe to send twice; see is_idempotent
         if max_retries is None:
-            max_retries = 0 if verb in ['POST', 'PUT'] else 3
+            max_retries = self.max_retries if is_idempotent(verb, path, postdict) else 0
 
-        # Auth: API Key/Secret
-        auth = APIKeyAuthWithExpires(self.apiKey, self.apiSecret)
+        # As is the body: compact JSON, encoded once
+        body = self.dumps(postdict) if postdict else b''
 
         def exit_or_throw(e):
             if rethrow_errors:
@@ -246,19 +398,50 @@ class BitMEX(object):
             else:
                 exit(1)
 
-        def retry():
-            self.retries += 1
-            if self.retries > max_retries:
+        def retry(postdict=postdict, wait=True):
+            if attempt >= max_retries:
                 raise Exception("Max retries on %s (%s) hit, raising." % (path, json.dumps(postdict or '')))
-            return self._curl_bitmex(path, query, postdict, timeout, verb, rethrow_errors, max_retries)
+            if wait:
+                time.sleep(backoff(attempt))
+            return self._curl_bitmex(path, query, postdict, timeout, verb, rethrow_errors, max_retries,
+                                     priority, attempt + 1)
+
+        def resolve():
+            # The request may or may not have reached the exchange. If it placed or amended orders, the
+            # order table says which went through, and only the rest are sent again.
+            if verb not in ('POST', 'PUT') or not path.startswith('order') or \
+                    not is_idempotent(verb, path, postdict):
+                return retry()
+            orders = order_list(postdict)
+            rows = self._wait_for_outcomes(verb, orders)
+            remaining = [order for order, row in zip(orders, rows) if row is None]
+            done = [row for row in rows if row is not None]
+            if not remaining:
+                self.logger.info("%s %s went through after all." % (verb, path))
+                return done if 'orders' in postdict else done[0]
+            if 'orders' not in postdict:
+                return retry()
+            return done + retry({'orders': remaining})
 
         # Make the request
         response = None
+        queued = time.perf_counter()
+        self.ratelimiter.acquire(priority)
         try:
-            self.logger.info("sending req to %s: %s" % (url, json.dumps(postdict or query or '')))
-            req = requests.Request(verb, url, json=postdict, auth=auth, params=query)
-            prepped = self.session.prepare_request(req)
-            response = self.session.send(prepped, timeout=timeout)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("sending req to %s %s: %s" % (verb, url, body.decode('utf8')))
+            headers = dict(self.headers)
+            headers.update(self.signer.headers(verb, target, body))
+            sent = time.perf_counter()
+            self.latency.record('ratelimit_wait', sent - queued)
+            # Before sending, as the order table can show the result before the response arrives
+            if postdict and verb in self.ORDER_STAGES and path.startswith('order'):
+                self.ws.expect_orders(order_keys(verb, postdict), self.ORDER_STAGES[verb], sent)
+            response = self.session.send(prepare(verb, url, headers, body), timeout=timeout)
+            self.latency.record('rest %s %s' % (verb, path), time.perf_counter() - sent)
+            self.ratelimiter.update(response.headers)
+            if 'X-RateLimit-Remaining' in response.headers:
+                self.metrics.set('ratelimit_remaining', int(response.headers['X-RateLimit-Remaining']))
             # Make non-200s throw
             response.raise_for_status()
 
@@ -266,6 +449,8 @@ class BitMEX(object):
             if response is None:
                 raise e
 
+            self.metrics.inc('rest_errors_total', status=str(response.status_code))
+
             # 401 - Auth error. This is fatal.
             if response.status_code == 401:
                 self.logger.error("API Key or Secret incorrect, please check and restart.")
@@ -284,56 +469,56 @@ class BitMEX(object):
                                   "Request: %s \n %s" % (url, json.dumps(postdict)))
                 exit_or_throw(e)
 
-            # 429, ratelimit; cancel orders & wait until X-RateLimit-Reset
+            # 429, ratelimit; hold all requests until X-RateLimit-Reset
             elif response.status_code == 429:
-                self.logger.error("Ratelimited on current request. Sleeping, then trying again. Try fewer " +
-                                  "order pairs or contact support@bitmex.com to raise your limits. " +
+                self.logger.error("Ratelimited on current request. Waiting, then trying again. " +
                                   "Request: %s \n %s" % (url, json.dumps(postdict)))
 
-                # Figure out how long we need to wait.
-                ratelimit_reset = response.headers['X-RateLimit-Reset']
-                to_sleep = int(ratelimit_reset) - int(time.time())
-                reset_str = datetime.datetime.fromtimestamp(int(ratelimit_reset)).strftime('%X')
-
-                # We're ratelimited, and we may be waiting for a long time. Cancel orders.
-                self.logger.warning("Canceling all known orders in the meantime.")
-                self.cancel([o['orderID'] for o in self.open_orders()])
+                # Figure out how long we need to wait. Resting orders (including stops) are left alone.
+                ratelimit_reset = int(response.headers['X-RateLimit-Reset'])
+                reset_str = datetime.datetime.fromtimestamp(ratelimit_reset).strftime('%X')
+                self.logger.error("Your ratelimit will reset at %s. Waiting for %d seconds." %
+                                  (reset_str, ratelimit_reset - int(time.time())))
+                self.ratelimiter.block_until(ratelimit_reset)
 
-                self.logger.error("Your ratelimit will reset at %s. Sleeping for %d seconds." % (reset_str, to_sleep))
-                time.sleep(to_sleep)
-
-                # Retry the request.
-                return retry()
+                # Retry the request; it queues in the limiter until the reset.
+                return retry(wait=False)
 
-            # 503 - BitMEX temporary downtime, likely due to a deploy. Try again
+            # 503 - BitMEX temporary downtime, likely due to a deploy. The request wasn't processed; try again
             elif response.status_code == 503:
                 self.logger.warning("Unable to contact the BitMEX API (503), retrying. " +
                                     "Request: %s \n %s" % (url, json.dumps(postdict)))
-                time.sleep(3)
                 return retry()
 
+            # 502/504 - a gateway gave up waiting, so the request may still have gone through
+            elif response.status_code in (502, 504):
+                self.logger.warning("No response from the BitMEX API (%d), checking and retrying. "
+                                    "Request: %s \n %s" % (response.status_code, url, json.dumps(postdict)))
+                return resolve()
+
             elif response.status_code == 400:
                 error = response.json()['error']
                 message = error['message'].lower() if error else ''
 
-                # Duplicate clOrdID: that's fine, probably a deploy, go get the order(s) and return it
+                # Duplicate clOrdID: an earlier attempt went through. Find the order(s) and return them
                 if 'duplicate clordid' in message:
-                    orders = postdict['orders'] if 'orders' in postdict else postdict
-
-                    IDs = json.dumps({'clOrdID': [order['clOrdID'] for order in orders]})
-                    orderResults = self._curl_bitmex('/order', query={'filter': IDs}, verb='GET')
-
-                    for i, order in enumerate(orderResults):
-                        if (
-                                order['orderQty'] != abs(postdict['orderQty']) or
-                                order['side'] != ('Buy' if postdict['orderQty'] > 0 else 'Sell') or
-                                order['price'] != postdict['price'] or
-                                order['symbol'] != postdict['symbol']):
+                    orders = order_list(postdict)
+                    rows = self._wait_for_outcomes(verb, orders)
+
+                    if not all(rows):
+                        # Not on the order table (e.g. it was placed before a reconnect); ask for them
+                        IDs = json.dumps({'clOrdID': [order['clOrdID'] for order in orders]})
+                        found = {row['clOrdID']: row for row in self._curl_bitmex('order', query={'filter': IDs},
+                                                                                   verb='GET')}
+                        rows = [found.get(order['clOrdID']) for order in orders]
+
+                    for order, row in zip(orders, rows):
+                        if row is None or not same_order(order, row):
                             raise Exception('Attempted to recover from duplicate clOrdID, but order returned from API ' +
                                             'did not match POST.\nPOST data: %s\nReturned order: %s' % (
-                                                json.dumps(orders[i]), json.dumps(order)))
+                                                json.dumps(order), json.dumps(row)))
                     # All good
-                    return orderResults
+                    return rows if 'orders' in postdict else rows[0]
 
                 elif 'insufficient available balance' in message:
                     self.logger.error('Account out of funds. The message: %s' % error['message'])
@@ -346,17 +531,15 @@ class BitMEX(object):
             exit_or_throw(e)
 
         except requests.exceptions.Timeout as e:
-            # Timeout, re-run this request
+            self.metrics.inc('rest_errors_total', status='timeout')
+            # Timeout; find out whether it went through, and re-run what didn't
             self.logger.warning("Timed out on request: %s (%s), retrying..." % (path, json.dumps(postdict or '')))
-            return retry()
+            return resolve()
 
         except requests.exceptions.ConnectionError as e:
-            self.logger.warning("Unable to contact the BitMEX API (%s). Please check the URL. Retrying. " +
-                                "Request: %s %s \n %s" % (e, url, json.dumps(postdict)))
-            time.sleep(1)
-            return retry()
-
-        # Reset retry counter on success
-        self.retries = 0
+            self.metrics.inc('rest_errors_total', status='connection')
+            self.logger.warning("Unable to contact the BitMEX API (%s). Please check the URL. Retrying. "
+                                "Request: %s \n %s" % (e, url, json.dumps(postdict)))
+            return resolve()
 
         return response.json()
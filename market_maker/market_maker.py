@@ -9,8 +9,8 @@ import atexit
 import signal
 
 from market_maker import bitmex
-from market_maker.settings import settings
-from market_maker.utils import log, constants, errors, math
+from market_maker.settings import settings, symbol_argument
+from market_maker.utils import log, constants, errors, ticks
 
 # Used for reloading the bot - saves modified times of key files
 import os
@@ -24,36 +24,38 @@ logger = log.setup_custom_logger('root')
 
 
 class ExchangeInterface:
-    def __init__(self, dry_run=False):
+    def __init__(self, dry_run=False, config=None, session=None, connector=None):
+        # config replaces the global settings, so one process can run several accounts;
+        # session lets those accounts share a connection pool. connector is an already
+        # connected BitMEX (e.g. an AsyncBitMEX) to use instead of making one.
+        self.config = config or settings
         self.dry_run = dry_run
-        if len(sys.argv) > 1:
-            self.symbol = sys.argv[1]
+        if config is None and symbol_argument():
+            symbol = symbol_argument()
         else:
-            self.symbol = settings.SYMBOL
-        self.bitmex = bitmex.BitMEX(base_url=settings.BASE_URL, symbol=self.symbol,
-                                    apiKey=settings.API_KEY, apiSecret=settings.API_SECRET,
-                                    orderIDPrefix=settings.ORDERID_PREFIX, postOnly=settings.POST_ONLY,
-                                    timeout=settings.TIMEOUT)
+            symbol = self.config.SYMBOL
+        # SYMBOL can list several instruments, e.g. 'XBTUSD|ETHUSD'. The first is the default.
+        self.symbols = symbol.split('|')
+        self.symbol = self.symbols[0]
+        if connector is not None:
+            self.bitmex = connector
+            return
+        self.bitmex = bitmex.BitMEX(base_url=self.config.BASE_URL, symbol=self.symbol, symbols=self.symbols,
+                                    apiKey=self.config.API_KEY, apiSecret=self.config.API_SECRET,
+                                    orderIDPrefix=self.config.ORDERID_PREFIX, postOnly=self.config.POST_ONLY,
+                                    timeout=self.config.TIMEOUT, session=session,
+                                    max_in_flight=self.config.API_MAX_IN_FLIGHT, pool_size=self.config.API_POOL_SIZE,
+                                    max_retries=self.config.API_MAX_RETRIES)
 
     def cancel_order(self, order):
-        tickLog = self.get_instrument()['tickLog']
-        
-        if 'Close' not in order['execInst']:
-            logger.info("Canceling: %s %d @ %.*f" % (order['side'], order['orderQty'], tickLog, order['price']))
-        elif order['ordType'] == 'Stop':
-            logger.info("Canceling: Stop Close @ %.*f" % (tickLog, order['stopPx']))
-        elif order['ordType'] == 'StopLimit':
-            logger.info("Canceling: StopLimit Close @ %.*f, stopPx: %.*f" % (tickLog, order['price'], tickLog, order['stopPx']))
-        else:
-            logger.info("Canceling: %s" % order['orderID'])
-        
+        log_cancel(order, self.get_instrument()['tickLog'])
+
         while True:
             try:
                 self.bitmex.cancel(order['orderID'])
-                sleep(settings.API_REST_INTERVAL)
             except ValueError as e:
                 logger.info(e)
-                sleep(settings.API_ERROR_INTERVAL)
+                sleep(self.config.API_ERROR_INTERVAL)
             else:
                 break
 
@@ -62,30 +64,19 @@ class ExchangeInterface:
             return
 
         logger.info("Resetting current position. Canceling all existing orders.")
-        tickLog = self.get_instrument()['tickLog']
 
         # In certain cases, a WS update might not make it through before we call this.
         # For that reason, we grab via HTTP to ensure we grab them all.
         orders = self.bitmex.http_open_orders()
 
         for order in orders:
-            if 'Close' not in order['execInst']:
-                if 'Stop' not in order['ordType']:
-                    logger.info("Canceling: %s %d @ %.*f" % (order['side'], order['orderQty'], tickLog, order['price']))
-                else:
-                    logger.info("Canceling: %s %d @ %.*f" % (order['ordType'], order['orderQty'], tickLog, order['stopPx']))
-            elif order['ordType'] == 'Stop':
-                logger.info("Canceling: %s Close @ %.*f" % (order['ordType'], tickLog, order['stopPx']))
-            elif order['ordType'] == 'StopLimit':
-                logger.info("Canceling: %s Close @ %.*f, stopPx: %.*f" % (order['ordType'], tickLog, order['price'], tickLog, order['stopPx']))
+            log_cancel(order, self.get_instrument(order['symbol'])['tickLog'])
 
         if len(orders):
             self.bitmex.cancel([order['orderID'] for order in orders])
 
-        sleep(settings.API_REST_INTERVAL)
-
     def get_portfolio(self):
-        contracts = settings.CONTRACTS
+        contracts = self.config.CONTRACTS
         portfolio = {}
         for symbol in contracts:
             position = self.bitmex.position(symbol=symbol)
@@ -151,13 +142,13 @@ class ExchangeInterface:
 
     def get_margin(self):
         if self.dry_run:
-            return {'marginBalance': float(settings.DRY_BTC), 'availableFunds': float(settings.DRY_BTC)}
+            return {'marginBalance': float(self.config.DRY_BTC), 'availableFunds': float(self.config.DRY_BTC)}
         return self.bitmex.funds()
 
-    def get_orders(self):
+    def get_orders(self, symbol=None):
         if self.dry_run:
             return []
-        return self.bitmex.open_orders()
+        return self.bitmex.open_orders(symbol)
 
     def get_highest_buy(self):
         buys = [o for o in self.get_orders() if o['side'] == 'Buy']
@@ -187,15 +178,15 @@ class ExchangeInterface:
         """Check that websockets are still open."""
         return not self.bitmex.ws.exited
 
-    def check_market_open(self):
-        instrument = self.get_instrument()
+    def check_market_open(self, symbol=None):
+        instrument = self.get_instrument(symbol)
         if instrument["state"] != "Open" and instrument["state"] != "Closed":
             raise errors.MarketClosedError("The instrument %s is not open. State: %s" %
-                                           (self.symbol, instrument["state"]))
+                                           (instrument["symbol"], instrument["state"]))
 
-    def check_if_orderbook_empty(self):
+    def check_if_orderbook_empty(self, symbol=None):
         """This function checks whether the order book is empty"""
-        instrument = self.get_instrument()
+        instrument = self.get_instrument(symbol)
         if instrument['midPrice'] is None:
             raise errors.MarketEmptyError("Orderbook is empty, cannot quote")
 
@@ -209,10 +200,51 @@ class ExchangeInterface:
             return orders
         return self.bitmex.create_bulk_orders(orders)
 
-    def cancel_bulk_orders(self, orders):
+    def cancel_bulk_orders(self, orders=None, ordType=None, side=None, clOrdIDPrefix=None, symbol=None):
+        """Cancel a set of orders in a single request.
+
+        Pass the orders to cancel, or leave them out to cancel every open order (from the websocket)
+        matching the given ordType (a string or list), side, clOrdID prefix and symbol.
+
+        Returns a dict of orderID -> error for orders the exchange refused to cancel and that the
+        websocket order table still shows as open. Orders that filled or were canceled in the meantime
+        are not failures."""
+        if orders is None:
+            orders = self.filter_orders(ordType=ordType, side=side, clOrdIDPrefix=clOrdIDPrefix, symbol=symbol)
+
+        if not orders:
+            return {}
+
+        for order in orders:
+            log_cancel(order, self.get_instrument(order['symbol'])['tickLog'])
+
         if self.dry_run:
-            return orders
-        return self.bitmex.cancel([order['orderID'] for order in orders])
+            return {}
+
+        results = self.bitmex.cancel([order['orderID'] for order in orders])
+        return self.unconfirmed_cancels(results)
+
+    def unconfirmed_cancels(self, results):
+        """Turn a cancel response into orderID -> error for the orders that are really still open."""
+        errors = {o['orderID']: o['error'] for o in results or [] if o.get('error')}
+
+        # Reconcile against the websocket: only report orders that are still live.
+        failed = {}
+        for orderID, error in errors.items():
+            order = self.bitmex.ws.get_order(orderID)
+            if order is not None and order['ordStatus'] not in ['Filled', 'Canceled', 'Rejected']:
+                logger.warning("Unable to cancel %s: %s" % (orderID, error))
+                failed[orderID] = error
+        return failed
+
+    def filter_orders(self, ordType=None, side=None, clOrdIDPrefix=None, symbol=None):
+        """Return our open orders (from the websocket) matching all of the given filters."""
+        if isinstance(ordType, str):
+            ordType = [ordType]
+        return [o for o in self.get_orders(symbol) if
+                (ordType is None or o['ordType'] in ordType) and
+                (side is None or o['side'] == side) and
+                (clOrdIDPrefix is None or str(o['clOrdID']).startswith(clOrdIDPrefix))]
 
 
 class OrderManager:
@@ -232,6 +264,7 @@ class OrderManager:
 
         self.start_time = datetime.now()
         self.instrument = self.exchange.get_instrument()
+        self.grid = ticks.grid(self.instrument['tickSize'])
         self.starting_qty = self.exchange.get_delta()
         self.running_qty = self.starting_qty
         self.reset()
@@ -270,8 +303,8 @@ class OrderManager:
         # Set up our buy & sell positions as the smallest possible unit above and below the current spread
         # and we'll work out from there. That way we always have the best price but we don't kill wide
         # and potentially profitable spreads.
-        self.start_position_buy = ticker["buy"] + self.instrument['tickSize']
-        self.start_position_sell = ticker["sell"] - self.instrument['tickSize']
+        self.start_position_buy = self.grid.step(ticker["buy"], 1)
+        self.start_position_sell = self.grid.step(ticker["sell"], -1)
 
         # If we're maintaining spreads and we already have orders in place,
         # make sure they're not ours. If they are, we need to adjust, otherwise we'll
@@ -318,7 +351,7 @@ class OrderManager:
             if index < 0 and start_position > self.start_position_sell:
                 start_position = self.start_position_buy
 
-        return math.toNearest(start_position * (1 + settings.INTERVAL) ** index, self.instrument['tickSize'])
+        return self.grid.round(start_position * (1 + settings.INTERVAL) ** index)
 
     ###
     # Orders
@@ -540,6 +573,21 @@ class OrderManager:
 #
 
 
+def log_cancel(order, tickLog):
+    if 'Close' not in order['execInst']:
+        if 'Stop' not in order['ordType']:
+            logger.info("Canceling: %s %d @ %.*f" % (order['side'], order['orderQty'], tickLog, order['price']))
+        else:
+            logger.info("Canceling: %s %d @ %.*f" % (order['ordType'], order['orderQty'], tickLog, order['stopPx']))
+    elif order['ordType'] == 'Stop':
+        logger.info("Canceling: Stop Close @ %.*f" % (tickLog, order['stopPx']))
+    elif order['ordType'] == 'StopLimit':
+        logger.info("Canceling: StopLimit Close @ %.*f, stopPx: %.*f" %
+                    (tickLog, order['price'], tickLog, order['stopPx']))
+    else:
+        logger.info("Canceling: %s" % order['orderID'])
+
+
 def XBt_to_XBT(XBt):
     return float(XBt) / constants.XBt_TO_XBT
 
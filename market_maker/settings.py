@@ -22,9 +22,24 @@ def import_path(fullpath):
     return module
 
 
+def symbol_argument():
+    """
+    The symbol given as the first command-line argument (python3 strat.py XBTUSD), if any.
+    Only a configured symbol, or one with a settings-<symbol>.py, counts; options
+    (backtest.py --synthetic 365) and subcommands (orderbook bench) aren't symbols.
+    """
+    if len(sys.argv) < 2:
+        return None
+    symbol = sys.argv[1]
+    symbols = getattr(userSettings, 'SYMBOL', baseSettings.SYMBOL).split('|')
+    if symbol in symbols or os.path.exists(os.path.join('..', 'settings-%s.py' % symbol)):
+        return symbol
+    return None
+
+
 userSettings = import_path(os.path.join('.', 'settings'))
 symbolSettings = None
-symbol = sys.argv[1] if len(sys.argv) > 1 else None
+symbol = symbol_argument()
 if symbol:
     print("Importing symbol settings for %s..." % symbol)
     try:
@@ -0,0 +1,439 @@
+"""A small BitMEX-like matching engine for offline testing.
+
+It keeps one account's orders, positions and margin, and matches them against an external
+market fed in as quotes, trades and instrument updates (usually from a recording). Every
+change is published as the same partial/insert/update/delete table messages the real
+/realtime feed sends.
+
+Matching is price-time: on each quote, resting limit orders are walked best price first,
+oldest first, and filled against the quoted size on the other side. Orders that cross the
+spread on arrival fill immediately at the touch. Stops trigger on lastPrice (or markPrice
+without the LastPrice execInst) and turn into market or limit orders. Contracts are
+treated as inverse (XBTUSD-style): PnL is qty * (1/entry - 1/exit) in XBT.
+"""
+from __future__ import absolute_import
+import datetime
+import itertools
+import threading
+import uuid
+
+from market_maker.utils import constants
+
+
+ACCOUNT = 1
+
+KEYS = {
+    'instrument': ['symbol'],
+    'quote': [],
+    'trade': [],
+    'order': ['orderID'],
+    'execution': ['execID'],
+    'position': ['account', 'symbol', 'currency'],
+    'margin': ['account', 'currency'],
+}
+
+OPEN_STATUSES = ['New', 'PartiallyFilled']
+
+DEFAULT_INSTRUMENTS = [
+    {'symbol': 'XBTUSD', 'tickSize': 0.5, 'lastPrice': 10000.0},
+    {'symbol': 'ETHUSD', 'tickSize': 0.05, 'lastPrice': 200.0},
+]
+
+
+class OrderError(Exception):
+    """Rejected request; the message mirrors what BitMEX puts in error.message."""
+    pass
+
+
+def timestamp():
+    return datetime.datetime.utcnow().isoformat(timespec='milliseconds') + 'Z'
+
+
+def instrument_row(symbol, tickSize, lastPrice, **fields):
+    now = datetime.datetime.utcnow()
+    funding = now.replace(minute=0, second=0, microsecond=0)
+    # BitMEX funds at 04:00, 12:00 and 20:00 UTC
+    funding += datetime.timedelta(hours=8 - (funding.hour - 4) % 8)
+    row = {
+        'symbol': symbol, 'state': 'Open', 'tickSize': tickSize,
+        'lastPrice': lastPrice, 'markPrice': lastPrice, 'midPrice': lastPrice,
+        'bidPrice': lastPrice - tickSize, 'askPrice': lastPrice + tickSize,
+        'fundingRate': 0.0001, 'indicativeFundingRate': 0.0001,
+        'fundingTimestamp': funding.isoformat(timespec='milliseconds') + 'Z',
+        'fundingInterval': '2000-01-01T08:00:00.000Z',
+        'isQuanto': False, 'isInverse': True, 'multiplier': -100000000,
+        'underlyingToSettleMultiplier': None, 'quoteToSettleMultiplier': 100000000,
+        'indicativeSettlePrice': lastPrice, 'initMargin': 0.01, 'timestamp': timestamp(),
+    }
+    row.update(fields)
+    return row
+
+
+class MatchingEngine(object):
+
+    """Orders, positions and margin for a single simulated account."""
+
+    def __init__(self, instruments=None, balance=1.0):
+        self.lock = threading.RLock()
+        self.listeners = []
+        self.sequence = itertools.count()
+
+        self.instruments = {}
+        for instrument in instruments or DEFAULT_INSTRUMENTS:
+            row = instrument_row(**instrument) if 'state' not in instrument else dict(instrument)
+            self.instruments[row['symbol']] = row
+
+        self.orders = {}      # orderID -> order, including closed orders
+        self.by_clOrdID = {}  # clOrdID -> order
+        self.positions = {}   # symbol -> position
+        self.quotes = {}      # symbol -> last quote
+        self.margin = {'account': ACCOUNT, 'currency': 'XBt',
+                       'walletBalance': int(balance * constants.XBt_TO_XBT)}
+        self.margin['marginBalance'] = self.margin['availableMargin'] = self.margin['walletBalance']
+
+    #
+    # Table images
+    #
+    def add_listener(self, callback):
+        """callback(table, action, rows) is called, under the engine lock, for every change."""
+        self.listeners.append(callback)
+
+    def publish(self, table, action, rows):
+        if not rows:
+            return
+        for callback in self.listeners:
+            callback(table, action, rows)
+
+    def image(self, table):
+        """Rows for a partial of the given table."""
+        with self.lock:
+            if table == 'instrument':
+                return [dict(i) for i in self.instruments.values()]
+            if table == 'quote':
+                return [dict(q) for q in self.quotes.values()]
+            if table == 'order':
+                return [self.__public(o) for o in self.orders.values() if o['ordStatus'] in OPEN_STATUSES]
+            if table == 'position':
+                return [dict(p) for p in self.positions.values()]
+            if table == 'margin':
+                return [dict(self.margin)]
+            return []
+
+    def get_orders(self, symbol=None, open_only=True, clOrdIDs=None):
+        with self.lock:
+            orders = self.orders.values()
+            if clOrdIDs is not None:
+                orders = [self.by_clOrdID[c] for c in clOrdIDs if c in self.by_clOrdID]
+            return [self.__public(o) for o in orders if
+                    (not open_only or o['ordStatus'] in OPEN_STATUSES) and
+                    (symbol is None or o['symbol'] == symbol)]
+
+    #
+    # Order entry
+    #
+    def place(self, params):
+        with self.lock:
+            symbol = params.get('symbol')
+            if symbol not in self.instruments:
+                raise OrderError('Invalid symbol')
+
+            clOrdID = params.get('clOrdID') or ''
+            if clOrdID and clOrdID in self.by_clOrdID:
+                raise OrderError('Duplicate clOrdID')
+
+            qty = params.get('orderQty')
+            side = params.get('side') or ('Buy' if (qty or 0) > 0 else 'Sell')
+            execInst = params.get('execInst') or ''
+            price = params.get('price')
+            stopPx = params.get('stopPx')
+            ordType = params.get('ordType')
+            if not ordType:
+                if stopPx is not None:
+                    ordType = 'StopLimit' if price is not None else 'Stop'
+                else:
+                    ordType = 'Limit' if price is not None else 'Market'
+            if qty is None:
+                if 'Close' not in execInst:
+                    raise OrderError('Invalid orderQty')
+                qty = 0  # sized to the position when it executes
+
+            order = {
+                'orderID': str(uuid.uuid4()), 'clOrdID': clOrdID, 'account': ACCOUNT,
+                'symbol': symbol, 'side': side, 'orderQty': abs(qty), 'price': price, 'stopPx': stopPx,
+                'ordType': ordType, 'execInst': execInst, 'ordStatus': 'New', 'triggered': '',
+                'leavesQty': abs(qty), 'cumQty': 0, 'avgPx': None,
+                'timestamp': timestamp(), 'transactTime': timestamp(),
+                # internal: time priority, and whether a Close order is sized to the whole position
+                'seq': next(self.sequence), 'closeAll': 'Close' in execInst and not qty,
+            }
+            self.orders[order['orderID']] = order
+            if clOrdID:
+                self.by_clOrdID[clOrdID] = order
+            self.publish('order', 'insert', [self.__public(order)])
+
+            if ordType in ['Stop', 'StopLimit']:
+                self.__check_stops(symbol)
+            else:
+                self.__execute(order, on_arrival=True)
+            return self.__public(order)
+
+    def amend(self, params):
+        with self.lock:
+            order = self.__find(params)
+            if order['ordStatus'] not in OPEN_STATUSES:
+                raise OrderError('Invalid ordStatus')
+
+            changes = {}
+            for field in ['price', 'stopPx']:
+                if field in params:
+                    changes[field] = params[field]
+            if 'leavesQty' in params:
+                changes['leavesQty'] = params['leavesQty']
+                changes['orderQty'] = order['cumQty'] + params['leavesQty']
+            elif 'orderQty' in params:
+                changes['orderQty'] = params['orderQty']
+                changes['leavesQty'] = max(params['orderQty'] - order['cumQty'], 0)
+            if not changes:
+                return self.__public(order)
+
+            # An amend loses time priority, like on the exchange.
+            order.update(changes, seq=next(self.sequence), timestamp=timestamp())
+            self.__update_order(order, changes)
+            if order['leavesQty'] <= 0 and 'Close' not in order['execInst']:
+                order['ordStatus'] = 'Filled' if order['cumQty'] else 'Canceled'
+                self.__update_order(order, {'ordStatus': order['ordStatus']})
+            elif order['ordType'] in ['Stop', 'StopLimit'] and not order['triggered']:
+                self.__check_stops(order['symbol'])
+            else:
+                self.__execute(order, on_arrival=True)
+            return self.__public(order)
+
+    def cancel(self, params):
+        """Cancel one order. Returns the order, with 'error' set if it wasn't open."""
+        with self.lock:
+            try:
+                order = self.__find(params)
+            except OrderError as e:
+                return {'orderID': params.get('orderID'), 'clOrdID': params.get('clOrdID'), 'error': str(e)}
+            if order['ordStatus'] not in OPEN_STATUSES:
+                return dict(self.__public(order),
+                            error='Unable to cancel order due to existing state: %s' % order['ordStatus'])
+            order['ordStatus'] = 'Canceled'
+            order['leavesQty'] = 0
+            self.__update_order(order, {'ordStatus': 'Canceled', 'leavesQty': 0})
+            return self.__public(order)
+
+    def cancel_all(self, symbol=None):
+        with self.lock:
+            return [self.cancel({'orderID': o['orderID']}) for o in self.get_orders(symbol)]
+
+    #
+    # Market data
+    #
+    def on_instrument(self, row):
+        with self.lock:
+            symbol = row.get('symbol')
+            if symbol not in self.instruments:
+                if 'tickSize' not in row:
+                    return
+                self.instruments[symbol] = instrument_row(symbol, row['tickSize'], row.get('lastPrice') or 0)
+            self.instruments[symbol].update(row)
+            self.publish('instrument', 'update', [dict(row)])
+            if 'lastPrice' in row or 'markPrice' in row:
+                self.__check_stops(symbol)
+
+    def on_quote(self, quote):
+        with self.lock:
+            symbol = quote['symbol']
+            if symbol not in self.instruments:
+                return
+            self.quotes[symbol] = dict(quote)
+            instrument = self.instruments[symbol]
+            changes = {'bidPrice': quote.get('bidPrice'), 'askPrice': quote.get('askPrice')}
+            if changes['bidPrice'] and changes['askPrice']:
+                changes['midPrice'] = (changes['bidPrice'] + changes['askPrice']) / 2
+            instrument.update(changes)
+            self.publish('quote', 'insert', [dict(quote)])
+            self.publish('instrument', 'update', [dict(changes, symbol=symbol)])
+
+            # Price-time priority against the quoted size
+            for side, size in [('Buy', quote.get('askSize')), ('Sell', quote.get('bidSize'))]:
+                available = size or 0
+                for order in self.__resting(symbol, side):
+                    if available <= 0:
+                        break
+                    available -= self.__execute(order, limit=available)
+
+    def on_trade(self, trade):
+        with self.lock:
+            symbol = trade['symbol']
+            if symbol not in self.instruments:
+                return
+            self.instruments[symbol]['lastPrice'] = trade['price']
+            self.publish('trade', 'insert', [dict(trade)])
+            self.publish('instrument', 'update', [{'symbol': symbol, 'lastPrice': trade['price']}])
+            self.__check_stops(symbol)
+
+    def feed(self, message):
+        """Apply a decoded /realtime message from a recording."""
+        table = message.get('table')
+        for row in message.get('data', []):
+            if table == 'quote' and message['action'] in ['partial', 'insert']:
+                self.on_quote(row)
+            elif table == 'trade' and message['action'] in ['partial', 'insert']:
+                self.on_trade(row)
+            elif table == 'instrument' and message['action'] in ['partial', 'update', 'insert']:
+                self.on_instrument(row)
+
+    #
+    # Matching
+    #
+    def __resting(self, symbol, side):
+        orders = [o for o in self.orders.values() if
+                  o['symbol'] == symbol and o['side'] == side and o['ordStatus'] in OPEN_STATUSES and
+                  (o['ordType'] == 'Limit' or o['ordType'] == 'StopLimit' and o['triggered'])]
+        sign = -1 if side == 'Buy' else 1
+        return sorted(orders, key=lambda o: (sign * o['price'], o['seq']))
+
+    def __touch(self, order):
+        instrument = self.instruments[order['symbol']]
+        return instrument['askPrice'] if order['side'] == 'Buy' else instrument['bidPrice']
+
+    def __execute(self, order, on_arrival=False, limit=None):
+        """Fill as much of order as the market allows. Returns the quantity filled."""
+        touch = self.__touch(order)
+        if touch is None:
+            return 0
+
+        if order['ordType'] in ['Market', 'Stop']:
+            price = touch
+        else:
+            crosses = touch <= order['price'] if order['side'] == 'Buy' else touch >= order['price']
+            if not crosses:
+                return 0
+            if on_arrival and 'ParticipateDoNotInitiate' in order['execInst']:
+                order['ordStatus'] = 'Canceled'
+                order['leavesQty'] = 0
+                self.__update_order(order, {'ordStatus': 'Canceled', 'leavesQty': 0})
+                return 0
+            # Takers get the touch, resting orders get their own price
+            price = touch if on_arrival else order['price']
+
+        qty = order['leavesQty']
+        if 'Close' in order['execInst']:
+            position = self.positions.get(order['symbol'], {}).get('currentQty', 0)
+            closing = -position if order['side'] == 'Buy' else position
+            qty = max(closing, 0) if order['closeAll'] else min(qty, max(closing, 0))
+            if qty == 0:
+                if order['ordType'] in ['Market', 'Stop']:
+                    order['ordStatus'] = 'Canceled'
+                    self.__update_order(order, {'ordStatus': 'Canceled', 'leavesQty': 0})
+                return 0
+        if limit is not None:
+            qty = min(qty, limit)
+        if qty <= 0:
+            return 0
+
+        self.__fill(order, qty, price)
+        return qty
+
+    def __fill(self, order, qty, price):
+        position = self.__apply_fill(order['symbol'], qty if order['side'] == 'Buy' else -qty, price)
+
+        previous = order['cumQty']
+        order['cumQty'] = previous + qty
+        order['avgPx'] = price if not previous else \
+            (order['avgPx'] * previous + price * qty) / order['cumQty']
+        if order['closeAll']:
+            # Stays open until the position it's closing is flat
+            remaining = position if order['side'] == 'Sell' else -position
+            order['orderQty'] = order['cumQty'] + max(remaining, 0)
+        order['orderQty'] = max(order['orderQty'], order['cumQty'])
+        order['leavesQty'] = max(order['orderQty'] - order['cumQty'], 0)
+        order['ordStatus'] = 'PartiallyFilled' if order['leavesQty'] else 'Filled'
+        self.__update_order(order, {'cumQty': order['cumQty'], 'leavesQty': order['leavesQty'],
+                                    'orderQty': order['orderQty'], 'avgPx': order['avgPx'],
+                                    'ordStatus': order['ordStatus']})
+
+        self.publish('execution', 'insert', [{
+            'execID': str(uuid.uuid4()), 'orderID': order['orderID'], 'clOrdID': order['clOrdID'],
+            'account': ACCOUNT, 'symbol': order['symbol'], 'side': order['side'], 'execType': 'Trade',
+            'ordType': order['ordType'], 'lastQty': qty, 'lastPx': price, 'price': order['price'],
+            'orderQty': order['orderQty'], 'leavesQty': order['leavesQty'], 'cumQty': order['cumQty'],
+            'ordStatus': order['ordStatus'], 'execComm': 0, 'settlCurrency': 'XBt', 'timestamp': timestamp(),
+            # signed the way BitMEX signs it: inverse multiplier over price, negative buying
+            'execCost': int(round((qty if order['side'] == 'Buy' else -qty) * -constants.XBt_TO_XBT / price)),
+        }])
+
+    def __apply_fill(self, symbol, signed_qty, price):
+        if symbol not in self.positions:
+            self.positions[symbol] = {
+                'account': ACCOUNT, 'symbol': symbol, 'currency': 'XBt', 'currentQty': 0,
+                'avgEntryPrice': None, 'avgCostPrice': None, 'realisedPnl': 0, 'homeNotional': 0,
+            }
+            self.publish('position', 'insert', [dict(self.positions[symbol])])
+        position = self.positions[symbol]
+        current = position['currentQty']
+        realised = 0
+        if current == 0 or (current > 0) == (signed_qty > 0):
+            # Adding to the position: inverse contracts average entries harmonically
+            total = current + signed_qty
+            cost = (current / position['avgEntryPrice'] if current else 0) + signed_qty / price
+            position['avgEntryPrice'] = total / cost
+        else:
+            closed = min(abs(signed_qty), abs(current)) * (1 if current > 0 else -1)
+            realised = closed * (1.0 / position['avgEntryPrice'] - 1.0 / price)
+            remainder = current + signed_qty
+            if remainder == 0:
+                position['avgEntryPrice'] = None
+            elif (remainder > 0) != (current > 0):
+                position['avgEntryPrice'] = price  # flipped through flat
+        position['currentQty'] = current + signed_qty
+        position['avgCostPrice'] = position['avgEntryPrice']
+        position['homeNotional'] = (position['currentQty'] / price) if position['currentQty'] else 0
+        position['realisedPnl'] += int(realised * constants.XBt_TO_XBT)
+        position['isOpen'] = position['currentQty'] != 0
+        self.publish('position', 'update', [dict(position)])
+
+        if realised:
+            self.margin['walletBalance'] += int(realised * constants.XBt_TO_XBT)
+            self.margin['marginBalance'] = self.margin['availableMargin'] = self.margin['walletBalance']
+            self.publish('margin', 'update', [dict(self.margin)])
+        return position['currentQty']
+
+    def __check_stops(self, symbol):
+        instrument = self.instruments[symbol]
+        for order in list(self.orders.values()):
+            if (order['symbol'] != symbol or order['ordType'] not in ['Stop', 'StopLimit'] or
+                    order['triggered'] or order['ordStatus'] not in OPEN_STATUSES):
+                continue
+            reference = instrument['lastPrice'] if 'LastPrice' in order['execInst'] else instrument['markPrice']
+            if reference is None:
+                continue
+            hit = reference >= order['stopPx'] if order['side'] == 'Buy' else reference <= order['stopPx']
+            if hit:
+                order['triggered'] = 'StopOrderTriggered'
+                order['seq'] = next(self.sequence)
+                self.__update_order(order, {'triggered': order['triggered']})
+                self.__execute(order, on_arrival=True)
+
+    #
+    # Helpers
+    #
+    def __find(self, params):
+        order = None
+        if params.get('orderID'):
+            order = self.orders.get(params['orderID'])
+        elif params.get('origClOrdID') or params.get('clOrdID'):
+            order = self.by_clOrdID.get(params.get('origClOrdID') or params.get('clOrdID'))
+        if order is None:
+            raise OrderError('Not Found')
+        return order
+
+    def __update_order(self, order, changes):
+        self.publish('order', 'update', [dict(changes, orderID=order['orderID'], symbol=order['symbol'],
+                                              clOrdID=order['clOrdID'])])
+
+    def __public(self, order):
+        return {k: v for k, v in order.items() if k not in ['seq', 'closeAll']}
+
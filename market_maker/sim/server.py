@@ -0,0 +1,307 @@
+"""Local stand-in for the BitMEX REST and /realtime APIs, backed by a MatchingEngine.
+
+Speaks the subset the bot uses: POST/PUT order/bulk, POST/DELETE order, DELETE order/all,
+GET order/instrument, POST position/leverage, and the /realtime partial/insert/update/delete
+feed for instrument, quote, trade, order, execution, position and margin. Auth headers are
+accepted but not checked. The market is driven by a recorded session, or by a synthetic
+random walk for load testing:
+
+    python -m market_maker.sim.server --recording session.bin.gz --speed 10
+    python -m market_maker.sim.server --synthetic 2000
+
+then set BASE_URL = 'http://localhost:8765/api/v1/' in settings.py.
+"""
+from __future__ import absolute_import
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from market_maker.sim.engine import KEYS, MatchingEngine, OrderError, timestamp
+from market_maker.ws.recorder import read_frames
+
+
+WS_MAGIC = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+API_PREFIX = '/api/v1/'
+
+
+class Subscriber(object):
+
+    """One /realtime connection and the tables (optionally per symbol) it subscribed to."""
+
+    def __init__(self, sock, subscriptions):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.closed = False
+        self.tables = {}  # table -> set of symbols, or None for all
+        for sub in subscriptions:
+            table, _, symbol = sub.partition(':')
+            if table not in KEYS:
+                continue
+            if not symbol:
+                self.tables[table] = None
+            elif self.tables.get(table, set()) is not None:
+                self.tables.setdefault(table, set()).add(symbol)
+
+    def wants(self, table, row):
+        if table not in self.tables:
+            return False
+        symbols = self.tables[table]
+        return symbols is None or row.get('symbol') in symbols
+
+    def send(self, message):
+        payload = json.dumps(message).encode('utf8')
+        if len(payload) < 126:
+            header = struct.pack('!BB', 0x81, len(payload))
+        elif len(payload) < 65536:
+            header = struct.pack('!BBH', 0x81, 126, len(payload))
+        else:
+            header = struct.pack('!BBQ', 0x81, 127, len(payload))
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.sock.sendall(header + payload)
+            except (OSError, socket.error):
+                self.closed = True
+
+
+class SimHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        self.server.logger.debug(format % args)
+
+    #
+    # REST
+    #
+    def do_GET(self):
+        if urlparse(self.path).path == '/realtime':
+            return self.handle_realtime()
+        self.handle_rest('GET')
+
+    def do_POST(self):
+        self.handle_rest('POST')
+
+    def do_PUT(self):
+        self.handle_rest('PUT')
+
+    def do_DELETE(self):
+        self.handle_rest('DELETE')
+
+    def handle_rest(self, verb):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get('content-length') or 0)
+        body = json.loads(self.rfile.read(length) or '{}') if length else {}
+        path = url.path[len(API_PREFIX):] if url.path.startswith(API_PREFIX) else url.path
+
+        engine = self.server.engine
+        try:
+            if path == 'order/bulk' and verb == 'POST':
+                result = [engine.place(o) for o in body.get('orders', [])]
+            elif path == 'order/bulk' and verb == 'PUT':
+                result = [engine.amend(o) for o in body.get('orders', [])]
+            elif path == 'order' and verb == 'POST':
+                result = engine.place(body)
+            elif path == 'order' and verb == 'PUT':
+                result = engine.amend(body)
+            elif path == 'order' and verb == 'DELETE':
+                result = []
+                for field in ['orderID', 'clOrdID']:
+                    ids = body.get(field) or query.get(field) or []
+                    for id in ([ids] if isinstance(ids, str) else ids):
+                        result.append(engine.cancel({field: id}))
+            elif path == 'order/all' and verb == 'DELETE':
+                result = engine.cancel_all(body.get('symbol') or query.get('symbol'))
+            elif path == 'order' and verb == 'GET':
+                filter = json.loads(query.get('filter') or '{}')
+                clOrdIDs = filter.get('clOrdID')
+                result = engine.get_orders(symbol=filter.get('symbol'),
+                                           open_only=filter.get('ordStatus.isTerminated') is False,
+                                           clOrdIDs=[clOrdIDs] if isinstance(clOrdIDs, str) else clOrdIDs)
+            elif path == 'instrument' and verb == 'GET':
+                result = engine.image('instrument')
+            elif path == 'position/leverage' and verb == 'POST':
+                result = dict(body, currentQty=engine.positions.get(body.get('symbol'), {}).get('currentQty', 0))
+            else:
+                return self.reply(404, {'error': {'message': 'Not Found', 'name': 'HTTPError'}})
+        except OrderError as e:
+            return self.reply(400, {'error': {'message': str(e), 'name': 'ValidationError'}})
+        except (KeyError, TypeError, ValueError) as e:
+            return self.reply(400, {'error': {'message': 'Bad request: %s' % e, 'name': 'HTTPError'}})
+        self.reply(200, result)
+
+    def reply(self, status, body):
+        payload = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        # Plenty of budget, so the connector's limiter never has to wait
+        self.send_header('X-RateLimit-Limit', '60')
+        self.send_header('X-RateLimit-Remaining', '59')
+        self.send_header('X-RateLimit-Reset', str(int(time.time()) + 1))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    #
+    # /realtime
+    #
+    def handle_realtime(self):
+        key = self.headers.get('Sec-WebSocket-Key')
+        if not key:
+            return self.reply(400, {'error': {'message': 'Expected a websocket upgrade', 'name': 'HTTPError'}})
+        accept = base64.b64encode(hashlib.sha1((key + WS_MAGIC).encode('utf8')).digest()).decode('utf8')
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+
+        query = parse_qs(urlparse(self.path).query)
+        subscriptions = ','.join(query.get('subscribe', [])).split(',')
+        subscriber = Subscriber(self.connection, [s for s in subscriptions if s])
+        subscriber.send({'info': 'Welcome to the BitMEX simulator', 'timestamp': timestamp()})
+
+        # Partials are sent while holding the engine lock so no update can slip in between.
+        engine = self.server.engine
+        with engine.lock:
+            for table in subscriber.tables:
+                rows = [r for r in engine.image(table) if subscriber.wants(table, r)]
+                subscriber.send({'table': table, 'action': 'partial', 'keys': KEYS[table], 'data': rows})
+            self.server.subscribers.append(subscriber)
+
+        try:
+            self.read_frames(subscriber)
+        finally:
+            subscriber.closed = True
+            with engine.lock:
+                self.server.subscribers.remove(subscriber)
+        self.close_connection = True
+
+    def read_frames(self, subscriber):
+        '''Handle client frames until it closes: answer pings, ignore everything else.'''
+        while not subscriber.closed:
+            header = self.rfile.read(2)
+            if len(header) < 2:
+                return
+            opcode, length = header[0] & 0x0f, header[1] & 0x7f
+            if length == 126:
+                length = struct.unpack('!H', self.rfile.read(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', self.rfile.read(8))[0]
+            mask = self.rfile.read(4) if header[1] & 0x80 else b'\0\0\0\0'
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(self.rfile.read(length)))
+            if opcode == 0x8:
+                return
+            if opcode == 0x9:
+                with subscriber.lock:
+                    self.connection.sendall(struct.pack('!BB', 0x8a, len(payload)) + payload)
+
+
+class SimServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, engine=None):
+        ThreadingHTTPServer.__init__(self, address, SimHandler)
+        self.logger = logging.getLogger('sim')
+        self.engine = engine or MatchingEngine()
+        self.subscribers = []
+        self.engine.add_listener(self.broadcast)
+
+    def broadcast(self, table, action, rows):
+        # Called under the engine lock, so subscribers can't change underneath us
+        for subscriber in self.subscribers:
+            data = [r for r in rows if subscriber.wants(table, r)]
+            if data:
+                subscriber.send({'table': table, 'action': action, 'data': data})
+
+    @property
+    def base_url(self):
+        return 'http://%s:%d%s' % (self.server_address[0], self.server_address[1], API_PREFIX)
+
+
+def feed_recording(engine, path, speed=None, loop=False):
+    """Drive the engine's market from a websocket recording (see market_maker.ws.recorder)."""
+    while True:
+        start = first = None
+        for received, frame in read_frames(path):
+            if speed:
+                if first is None:
+                    start, first = time.monotonic(), received
+                delay = (received - first) / speed - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            engine.feed(json.loads(frame))
+        if not loop:
+            return
+
+
+def feed_synthetic(engine, rate, symbol='XBTUSD'):
+    """Random-walk quotes (and the odd trade) at roughly `rate` messages per second."""
+    instrument = engine.instruments[symbol]
+    tick = instrument['tickSize']
+    mid = instrument['lastPrice']
+    interval = 1.0 / rate
+    next_at = time.monotonic()
+    while True:
+        mid = max(tick * 2, mid + random.choice([-tick, 0, 0, tick]))
+        engine.on_quote({'symbol': symbol, 'timestamp': timestamp(),
+                         'bidPrice': mid - tick, 'bidSize': random.randint(1, 50) * 100,
+                         'askPrice': mid + tick, 'askSize': random.randint(1, 50) * 100})
+        if random.random() < 0.2:
+            engine.on_trade({'symbol': symbol, 'timestamp': timestamp(), 'side': random.choice(['Buy', 'Sell']),
+                             'size': random.randint(1, 20) * 100, 'price': mid})
+        next_at += interval
+        delay = next_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def run():
+    parser = argparse.ArgumentParser(description='local BitMEX stand-in for offline testing')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--balance', type=float, default=1.0, help='starting XBT balance')
+    parser.add_argument('--recording', help='websocket recording to drive the market from')
+    parser.add_argument('--speed', type=float, default=1.0, help='recording playback speed (0 for max)')
+    parser.add_argument('--loop', action='store_true', help='restart the recording when it ends')
+    parser.add_argument('--synthetic', type=float, metavar='RATE',
+                        help='random-walk quotes at RATE messages/s instead of a recording')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    server = SimServer((args.host, args.port), MatchingEngine(balance=args.balance))
+    if args.recording:
+        target, feed_args = feed_recording, (server.engine, args.recording, args.speed or None, args.loop)
+    elif args.synthetic:
+        target, feed_args = feed_synthetic, (server.engine, args.synthetic)
+    else:
+        target = None
+
+    if target is not None:
+        feeder = threading.Thread(target=target, args=feed_args)
+        feeder.daemon = True
+        feeder.start()
+
+    server.logger.info('BitMEX simulator listening; set BASE_URL = %r' % server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,75 @@
+import collections
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+
+
+class Dispatcher(object):
+
+    """Runs REST calls on a small pool of threads so independent ones overlap.
+
+    At most max_in_flight calls run at once; the rest wait their turn. Calls are unordered
+    unless they share a key: those run one at a time, in the order they were submitted,
+    without holding a thread while they wait (e.g. key=symbol keeps a cancel ahead of the
+    order that replaces it). submit() returns a concurrent.futures.Future either way.
+    """
+
+    def __init__(self, max_in_flight=4):
+        self.max_in_flight = max_in_flight
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='dispatch')
+        self.lock = threading.Lock()
+        # key -> calls waiting behind the one with that key that's running
+        self.queues = {}
+
+    def submit(self, fn, *args, key=None, **kwargs):
+        if key is None:
+            return self.executor.submit(fn, *args, **kwargs)
+
+        future = Future()
+        with self.lock:
+            if key in self.queues:
+                self.queues[key].append((future, fn, args, kwargs))
+                return future
+            self.queues[key] = collections.deque()
+
+        self._start(key, future, fn, args, kwargs)
+        return future
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def _start(self, key, future, fn, args, kwargs):
+        def run():
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args, **kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                self._next(key)
+
+        try:
+            self.executor.submit(run)
+        except RuntimeError as e:
+            # shut down; fail this call and everything queued behind it
+            if future.set_running_or_notify_cancel():
+                future.set_exception(e)
+            self._next(key)
+
+    def _next(self, key):
+        with self.lock:
+            queue = self.queues[key]
+            if not queue:
+                del self.queues[key]
+                return
+            future, fn, args, kwargs = queue.popleft()
+
+        self._start(key, future, fn, args, kwargs)
+
+
+def wait_all(futures):
+    """Wait for every future, then re-raise the first error any of them hit."""
+    for future in futures:
+        future.exception()
+    for future in futures:
+        future.result()
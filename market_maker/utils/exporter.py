@@ -0,0 +1,111 @@
+"""A local HTTP endpoint for what the bots in this process measure about themselves.
+
+    curl localhost:<METRICS_PORT>/metrics
+
+serves the Prometheus text format. Sources are registered under a bot's name, which every sample
+they give is labelled with as bot="...". A source is anything with a collect() method returning
+families: (name, type, help, samples), each sample being (suffix, labels, value).
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import math
+import threading
+
+# Prepended to every family name
+NAMESPACE = 'fundingbot_'
+
+_lock = threading.Lock()
+# bot name -> sources
+_sources = {}
+_server = None
+
+logger = logging.getLogger('root')
+
+
+def register(name, source):
+    with _lock:
+        _sources.setdefault(name, []).append(source)
+
+
+def unregister(name, source):
+    with _lock:
+        if source in _sources.get(name, []):
+            _sources[name].remove(source)
+            if not _sources[name]:
+                del _sources[name]
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, float) and math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+def render():
+    """Every registered source's families in the Prometheus text format, one block per family."""
+    with _lock:
+        sources = [(name, source) for name, group in sorted(_sources.items()) for source in group]
+
+    # family name -> (type, help, lines), in the order families are first seen
+    families = {}
+    for name, source in sources:
+        try:
+            collected = source.collect()
+        except Exception as e:
+            logger.warning('unable to collect metrics for %s: %s' % (name, e))
+            continue
+        for family, kind, help, samples in collected:
+            family = NAMESPACE + family
+            lines = families.setdefault(family, (kind, help, []))[2]
+            for suffix, labels, value in samples:
+                labels = dict(labels, bot=name)
+                lines.append('%s%s{%s} %s' % (family, suffix,
+                                              ','.join('%s="%s"' % (k, escape(v)) for k, v in sorted(labels.items())),
+                                              format_value(value)))
+
+    out = []
+    for family, (kind, help, lines) in families.items():
+        out.append('# HELP %s %s' % (family, help))
+        out.append('# TYPE %s %s' % (family, kind))
+        out.extend(lines)
+    return '\n'.join(out) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes are too frequent to log
+
+
+def serve(port, address='127.0.0.1'):
+    """Start serving /metrics on a daemon thread, once per process. Returns whether it's being served."""
+    global _server
+    with _lock:
+        if _server is not None:
+            return True
+        try:
+            _server = ThreadingHTTPServer((address, port), MetricsHandler)
+        except OSError as e:
+            logger.error('unable to serve metrics on %s:%s: %s' % (address, port, e))
+            return False
+        _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('serving metrics on http://%s:%s/metrics' % (address, port))
+    return True
@@ -0,0 +1,86 @@
+"""JSON decoding for hot paths such as websocket frames, and compact encoding for request bodies.
+
+Uses the fastest backend installed: orjson, then ujson, then the standard library. All three
+return the same dicts, lists, strs, ints and floats for BitMEX's messages.
+"""
+import json
+
+
+def _orjson():
+    import orjson
+    return orjson.loads
+
+
+def _ujson():
+    import ujson
+    return ujson.loads
+
+
+def _json():
+    return json.loads
+
+
+BACKENDS = {'orjson': _orjson, 'ujson': _ujson, 'json': _json}
+
+# Tried in this order when no backend is asked for
+PREFERENCE = ['orjson', 'ujson', 'json']
+
+
+def decoder(backend=None):
+    """Return a loads() function for the given backend, or for the fastest installed one if None.
+
+    Asking for a backend that isn't installed raises ImportError."""
+    if backend is not None:
+        if backend not in BACKENDS:
+            raise ValueError("Unknown JSON backend %r; expected one of %s" % (backend, ', '.join(BACKENDS)))
+        return BACKENDS[backend]()
+
+    for name in PREFERENCE:
+        try:
+            return BACKENDS[name]()
+        except ImportError:
+            continue
+
+
+def _orjson_dumps():
+    import orjson
+    return orjson.dumps
+
+
+def _json_dumps():
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf8')
+    return dumps
+
+
+# No ujson: its float formatting isn't guaranteed to round-trip prices
+ENCODERS = {'orjson': _orjson_dumps, 'json': _json_dumps}
+
+
+def encoder(backend=None):
+    """Return a dumps() function giving compact (no whitespace) UTF-8 JSON bytes, from the given
+    backend or the fastest installed one if None."""
+    if backend is not None:
+        if backend not in ENCODERS:
+            raise ValueError("Unknown JSON backend %r; expected one of %s" % (backend, ', '.join(ENCODERS)))
+        return ENCODERS[backend]()
+
+    for name in PREFERENCE:
+        if name not in ENCODERS:
+            continue
+        try:
+            return ENCODERS[name]()
+        except ImportError:
+            continue
+
+
+def available():
+    """Names of the installed backends, fastest first."""
+    names = []
+    for name in PREFERENCE:
+        try:
+            BACKENDS[name]()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
@@ -0,0 +1,144 @@
+"""Latency histograms for the tick-to-order path.
+
+Each stage (a websocket frame being applied, a quote waiting for monitor(), a REST call, an
+order showing up on the order table, ...) gets a histogram bucketed like HdrHistogram: values
+are kept in microseconds to SIGNIFICANT_BITS significant bits, so recording is a bit_length and
+a list increment, memory is fixed, and any quantile is within a few percent.
+"""
+import threading
+
+# Buckets are at most 1/2**(SIGNIFICANT_BITS - 1) wide relative to their values (about 3%)
+SIGNIFICANT_BITS = 6
+LINEAR = 1 << SIGNIFICANT_BITS
+HALF = LINEAR >> 1
+
+# Anything slower than this lands in the last bucket
+MAX_SECONDS = 120
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def bucket_of(us):
+    """Index of the bucket holding a value in whole microseconds."""
+    if us < LINEAR:
+        return us
+    shift = us.bit_length() - SIGNIFICANT_BITS
+    return LINEAR + (shift - 1) * HALF + (us >> shift) - HALF
+
+
+def value_of(bucket):
+    """The middle of a bucket's range, in microseconds."""
+    if bucket < LINEAR:
+        return bucket
+    shift, mantissa = divmod(bucket - LINEAR, HALF)
+    shift += 1
+    return ((mantissa + HALF) << shift) + ((1 << shift) >> 1)
+
+
+class Histogram(object):
+
+    """Counts of latencies (in seconds) by bucket. Not thread safe; LatencyRecorder locks around it."""
+
+    SIZE = bucket_of(int(MAX_SECONDS * 1e6)) + 1
+
+    def __init__(self):
+        self.counts = [0] * self.SIZE
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds):
+        us = int(seconds * 1e6)
+        bucket = bucket_of(us) if us > 0 else 0
+        self.counts[bucket if bucket < self.SIZE else self.SIZE - 1] += 1
+        self.count += 1
+        self.total += seconds
+
+    def copy(self):
+        other = Histogram()
+        other.counts = list(self.counts)
+        other.count = self.count
+        other.total = self.total
+        return other
+
+    def since(self, earlier):
+        """What was recorded after earlier, a copy of this histogram taken then."""
+        if earlier is None:
+            return self.copy()
+        other = Histogram()
+        other.counts = [now - then for now, then in zip(self.counts, earlier.counts)]
+        other.count = self.count - earlier.count
+        other.total = self.total - earlier.total
+        return other
+
+    def quantile(self, q):
+        """The latency q of all recorded ones are at or below, in seconds; None if there are none."""
+        if not self.count:
+            return None
+        rank = max(1, int(q * self.count + 0.5))
+        seen = 0
+        for bucket, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return value_of(bucket) / 1e6
+        return value_of(self.SIZE - 1) / 1e6
+
+    def max(self):
+        for bucket in range(self.SIZE - 1, -1, -1):
+            if self.counts[bucket]:
+                return value_of(bucket) / 1e6
+        return None
+
+
+class LatencyRecorder(object):
+
+    """A Histogram per stage name, safe to record into from any thread.
+
+    One lives on each connector and is handed to its websocket, so a bot's numbers survive
+    reconnects. Timestamps passed in are time.perf_counter() values."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        # Copies as of the last interval(), to report just what happened since
+        self.marks = {}
+
+    def record(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.record(seconds)
+
+    def snapshot(self):
+        """A copy of every stage's histogram since the start."""
+        with self.lock:
+            return {stage: histogram.copy() for stage, histogram in self.histograms.items()}
+
+    def interval(self):
+        """Each stage's histogram of what was recorded since the last call."""
+        with self.lock:
+            result = {stage: histogram.since(self.marks.get(stage))
+                      for stage, histogram in self.histograms.items()}
+            self.marks = {stage: histogram.copy() for stage, histogram in self.histograms.items()}
+        return result
+
+    def collect(self):
+        """Everything so far as a Prometheus summary family; see market_maker.utils.exporter."""
+        samples = []
+        for stage, histogram in sorted(self.snapshot().items()):
+            for q in QUANTILES:
+                samples.append(('', {'stage': stage, 'quantile': '%g' % q}, histogram.quantile(q)))
+            samples.append(('_sum', {'stage': stage}, histogram.total))
+            samples.append(('_count', {'stage': stage}, histogram.count))
+        return [('latency_seconds', 'summary', 'Time spent in each stage of the tick-to-order path.', samples)]
+
+
+def format_interval(histograms):
+    """One line of p50/p99/max per stage in milliseconds, with how many were recorded."""
+    parts = []
+    for stage, histogram in sorted(histograms.items()):
+        if histogram.count:
+            parts.append('%s %.2f/%.2f/%.2f (%i)' % (stage, histogram.quantile(0.5) * 1e3,
+                                                     histogram.quantile(0.99) * 1e3, histogram.max() * 1e3,
+                                                     histogram.count))
+    return ', '.join(parts)
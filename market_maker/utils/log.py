@@ -10,5 +10,9 @@ def setup_custom_logger(name, log_level=settings.LOG_LEVEL):
 
     logger = logging.getLogger(name)
     logger.setLevel(log_level)
-    logger.addHandler(handler)
+    # Loggers are per name, so don't stack handlers when a bot with the same name is rebuilt
+    if not logger.handlers:
+        logger.addHandler(handler)
+    # 'root' is the root logger; anything else would print every line twice through it
+    logger.propagate = logger is logging.getLogger()
     return logger
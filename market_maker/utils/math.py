@@ -1,9 +1,11 @@
-from decimal import Decimal
+from market_maker.utils import ticks
+
 
 def toNearest(num, tickSize):
     """Given a number, round it to the nearest tick. Very useful for sussing float error
        out of numbers: e.g. toNearest(401.46, 0.01) -> 401.46, whereas processing is
        normally with floats would give you 401.46000000000004.
-       Use this after adding/subtracting/multiplying numbers."""
-    tickDec = Decimal(str(tickSize))
-    return float((Decimal(round(num / tickSize, 0)) * tickDec))
+       Use this after adding/subtracting/multiplying numbers.
+
+       Kept for callers outside the package; see market_maker.utils.ticks."""
+    return ticks.grid(tickSize).round(num)
@@ -0,0 +1,78 @@
+"""Health gauges and counters for one connector, kept current as things happen.
+
+Gauges that mirror websocket tables (position, margin, open orders, funding rate) are set from
+table listeners when a message for them arrives, and counters are bumped where the event
+happens, so a scrape only formats what is already there. Served by market_maker.utils.exporter.
+"""
+import threading
+
+from market_maker.utils import constants
+
+# name -> (type, help)
+FAMILIES = {
+    'position_contracts': ('gauge', 'Current position, in contracts.'),
+    'margin_balance_xbt': ('gauge', 'Margin balance, in XBT.'),
+    'open_orders': ('gauge', 'Orders of ours open on the order table.'),
+    'funding_rate': ('gauge', 'The instrument\'s next funding rate.'),
+    'ratelimit_remaining': ('gauge', 'Requests left in the REST rate limit, as of the last response.'),
+    'ws_messages_total': ('counter', 'Websocket table messages received.'),
+    'ws_reconnects_total': ('counter', 'Times the websocket was replaced by a new connection.'),
+    'rest_errors_total': ('counter', 'REST requests that failed, by status code (or timeout / connection).'),
+}
+
+
+class Metrics(object):
+
+    """Values by (name, labels), safe to update from any thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = value
+
+    def get(self, name, **labels):
+        return self.values.get((name, tuple(sorted(labels.items()))))
+
+    def collect(self):
+        """Every value, as families for market_maker.utils.exporter."""
+        with self.lock:
+            items = sorted(self.values.items(), key=lambda item: item[0])
+        families = {}
+        for (name, labels), value in items:
+            families.setdefault(name, []).append(('', dict(labels), value))
+        return [(name, FAMILIES[name][0], FAMILIES[name][1], samples) for name, samples in families.items()]
+
+    def watch(self, ws, symbols, orderIDPrefix):
+        """Keep the table gauges for symbols up to date from a connected websocket's listeners."""
+        def on_position(table, action, data):
+            for symbol in {row.get('symbol') for row in data} & watched:
+                self.set('position_contracts', ws.position(symbol)['currentQty'], symbol=symbol)
+
+        def on_margin(table, action, data):
+            self.set('margin_balance_xbt', ws.funds()['marginBalance'] / constants.XBt_TO_XBT)
+
+        def on_order(table, action, data):
+            # Updates to order rows only carry the fields that changed, so every symbol is counted again
+            for symbol in watched:
+                self.set('open_orders', len(ws.open_orders(orderIDPrefix, symbol)), symbol=symbol)
+
+        def on_instrument(table, action, data):
+            for symbol in {row.get('symbol') for row in data} & watched:
+                self.set('funding_rate', ws.get_instrument(symbol)['fundingRate'], symbol=symbol)
+
+        watched = set(symbols)
+        listeners = {'position': on_position, 'margin': on_margin, 'order': on_order, 'instrument': on_instrument}
+        for table, listener in listeners.items():
+            ws.add_listener(table, listener)
+            if table in ws.data:
+                # Start from what the partials already brought
+                listener(table, 'partial', [{'symbol': symbol} for symbol in symbols])
@@ -0,0 +1,139 @@
+import asyncio
+import math
+import random
+import threading
+import time
+
+
+# Request priorities. When the budget runs low, lower numbers go first.
+PRIORITY_HIGH = 0    # protective orders (stops) and anything else that limits risk
+PRIORITY_NORMAL = 1  # new orders, cancels, lookups
+PRIORITY_LOW = 2     # repricing amends; these can always be redone on the next tick
+
+
+def backoff(attempt, base=0.5, cap=8.0):
+    """Seconds to wait before retry number attempt + 1: exponential, capped, with full jitter.
+
+    Drawing the whole wait at random keeps connectors that failed together (e.g. in a deploy)
+    from all retrying in the same instant."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RateLimiter(object):
+
+    """Token bucket shared by every REST request a BitMEX connector sends.
+
+    The bucket refills continuously at limit/period and is re-synced from the
+    X-RateLimit-* headers on every response, so it tracks what the exchange actually
+    thinks we have left. Requests go straight through while there is budget. Once it runs
+    low, lower priorities keep a reserve free for higher ones and wait, and nothing
+    jumps ahead of a higher priority request that is already waiting.
+    """
+
+    # Fraction of the limit each priority leaves untouched for the ones above it.
+    RESERVES = {PRIORITY_HIGH: 0, PRIORITY_NORMAL: 0.1, PRIORITY_LOW: 0.25}
+
+    def __init__(self, limit=60, period=60):
+        self.limit = limit
+        self.period = float(period)
+        self.tokens = float(limit)
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.waiting = {priority: 0 for priority in self.RESERVES}
+        self.cond = threading.Condition()
+
+    def acquire(self, priority=PRIORITY_NORMAL):
+        """Block until a request of the given priority may be sent, then spend a token."""
+        with self.cond:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    delay = self._take(priority)
+                    if delay is None:
+                        return
+                    self.cond.wait(None if delay == math.inf else delay)
+            finally:
+                self.waiting[priority] -= 1
+                self.cond.notify_all()
+
+    def update(self, headers):
+        """Sync the bucket from a response's X-RateLimit-* headers."""
+        remaining = headers.get('X-RateLimit-Remaining')
+        if remaining is None:
+            return
+
+        with self.cond:
+            limit = headers.get('X-RateLimit-Limit')
+            if limit is not None:
+                self.limit = int(limit)
+            self._refill(time.monotonic())
+            self.tokens = min(float(remaining), self.limit)
+            self.cond.notify_all()
+
+    def block_until(self, reset):
+        """Hold every request until the given epoch time, e.g. X-RateLimit-Reset after a 429."""
+        with self.cond:
+            self.tokens = 0
+            self.blocked_until = time.monotonic() + max(reset - time.time(), 0)
+            self.cond.notify_all()
+
+    def remaining(self):
+        with self.cond:
+            self._refill(time.monotonic())
+            return self.tokens
+
+    def _take(self, priority):
+        """Spend a token if this priority may send now, else return how long to wait. Hold cond.
+
+        While a higher priority request is waiting, the wait is math.inf: until that one leaves
+        acquire(), which notifies, there's nothing to poll for."""
+        now = time.monotonic()
+        self._refill(now)
+
+        if any(n for p, n in self.waiting.items() if p < priority):
+            return math.inf
+
+        reserve = self.RESERVES[priority] * self.limit
+
+        if now >= self.blocked_until and self.tokens >= reserve + 1:
+            self.tokens -= 1
+            return None
+
+        needed = (reserve + 1 - self.tokens) * self.period / self.limit
+        return max(self.blocked_until - now, needed, 0.01)
+
+    def _refill(self, now):
+        self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.limit / self.period)
+        self.updated = now
+
+
+class AsyncRateLimiter(RateLimiter):
+
+    """The same bucket for an asyncio connector: acquire() is awaited, and waiting yields to
+    the event loop instead of blocking a thread. update() and block_until() are unchanged."""
+
+    def __init__(self, limit=60, period=60):
+        super(AsyncRateLimiter, self).__init__(limit, period)
+        # Set (and replaced) whenever a request leaves acquire(), for those queued behind it
+        self.released = asyncio.Event()
+
+    async def acquire(self, priority=PRIORITY_NORMAL):
+        with self.cond:
+            self.waiting[priority] += 1
+        try:
+            while True:
+                released = self.released
+                with self.cond:
+                    delay = self._take(priority)
+                if delay is None:
+                    return
+                if delay == math.inf:
+                    await released.wait()
+                else:
+                    await asyncio.sleep(delay)
+        finally:
+            with self.cond:
+                self.waiting[priority] -= 1
+                self.cond.notify_all()
+            released, self.released = self.released, asyncio.Event()
+            released.set()
@@ -0,0 +1,81 @@
+"""Prices as whole numbers of ticks.
+
+Every instrument quotes on a grid of its tickSize. A TickGrid turns prices into integer tick
+counts and back, so stepping, comparing and rounding prices is integer arithmetic, and turning
+a count back into a price gives the float you'd get by writing the decimal out (401.46, never
+401.46000000000004) without going through Decimal:
+
+    xbt = ticks.grid(0.5)
+    xbt.round(10000.3)      # 10000.5
+    xbt.step(10000.5, -1)   # 10000.0, one tick lower
+    xbt.ticks(10000.5)      # 20001
+
+Grids are cached per tick size, so grid() is cheap to call in a loop.
+"""
+from decimal import Decimal
+import math
+
+
+class TickGrid(object):
+
+    """The price grid of one tick size."""
+
+    __slots__ = ('size', 'decimals', '_divisor', '_multiplier')
+
+    def __init__(self, size):
+        self.size = float(size)
+        # Decimals needed to print a price on the grid; BitMEX calls it tickLog
+        self.decimals = Decimal(str(size)).as_tuple().exponent * -1
+
+        # ticks / 100 and ticks * 5 are correctly rounded, so they land on the same float as the
+        # decimal price. Anything else (a tick of 0.3, say) is rounded back to the grid's decimals.
+        per_unit = 1 / self.size
+        self._divisor = float(round(per_unit)) if abs(per_unit - round(per_unit)) < 1e-9 else None
+        self._multiplier = self.size if self.size.is_integer() else None
+
+    def ticks(self, price):
+        '''The nearest whole number of ticks to a price. Halfway prices round to even, like round().'''
+        return round(price / self.size)
+
+    def price(self, ticks):
+        '''The price of a whole number of ticks.'''
+        if self._multiplier is not None:
+            return ticks * self._multiplier
+        if self._divisor is not None:
+            return ticks / self._divisor
+        return round(ticks * self.size, self.decimals)
+
+    def round(self, price):
+        '''A price rounded to the nearest tick.'''
+        return self.price(self.ticks(price))
+
+    def floor(self, price):
+        '''A price rounded down to the grid. Prices a float error below a tick count as on it.'''
+        return self.price(math.floor(price / self.size + 1e-9))
+
+    def ceil(self, price):
+        '''A price rounded up to the grid. Prices a float error above a tick count as on it.'''
+        return self.price(math.ceil(price / self.size - 1e-9))
+
+    def step(self, price, n=1):
+        '''The price n ticks from a price (rounded to the grid first); negative n steps down.'''
+        return self.price(self.ticks(price) + n)
+
+    def __repr__(self):
+        return 'TickGrid(%r)' % self.size
+
+
+_grids = {}
+
+
+def grid(size):
+    '''The shared TickGrid for a tick size.'''
+    tick_grid = _grids.get(size)
+    if tick_grid is None:
+        tick_grid = _grids[size] = TickGrid(size)
+    return tick_grid
+
+
+def to_nearest(price, size):
+    '''A price rounded to the nearest multiple of size.'''
+    return grid(size).round(price)
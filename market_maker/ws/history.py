@@ -0,0 +1,171 @@
+from array import array
+from bisect import bisect_left
+from collections import deque
+from datetime import datetime
+import math
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class RingBuffer(object):
+
+    """Fixed-capacity columns of floats. Appending overwrites the oldest row in O(1).
+
+    Each column is an array('d') allocated once at full capacity. read() and column() return
+    copies of the rows oldest first, as numpy arrays if numpy is installed, otherwise as lists.
+    Rows are appended on the websocket thread and read on others, so both take the lock, and
+    every column read() returns comes from the same rows.
+    """
+
+    def __init__(self, capacity, columns):
+        self.capacity = capacity
+        self.columns = tuple(columns)
+        self.arrays = [array('d', bytes(8 * capacity)) for _ in self.columns]
+        self.head = 0  # slot the next row goes in
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def append(self, values):
+        with self.lock:
+            i = self.head
+            for column, value in zip(self.arrays, values):
+                column[i] = value
+            self.head = (i + 1) % self.capacity
+            if self.count < self.capacity:
+                self.count += 1
+
+    def column(self, name, n=None):
+        '''The last n (default all) values of a column, oldest first.'''
+        return self.read((name,), n)[0]
+
+    def read(self, names, n=None, since=None, by=None):
+        '''The last n (default all) values of each of the named columns, oldest first.
+
+        With since, only the latest rows whose `by` column, which must be ascending, is at or after it.'''
+        with self.lock:
+            n = self.count if n is None else min(n, self.count)
+            if since is not None:
+                values = self.__slice(self.arrays[self.columns.index(by)], n)
+                # Rows arrive in order, so this is a binary search
+                if numpy is not None:
+                    n -= int(numpy.searchsorted(values, since))
+                else:
+                    n -= bisect_left(values, since)
+            return [self.__slice(self.arrays[self.columns.index(name)], n) for name in names]
+
+    def __slice(self, data, n):
+        start = (self.head - n) % self.capacity
+        end = start + n
+
+        if numpy is not None:
+            view = numpy.frombuffer(data, dtype=numpy.float64)
+            if end <= self.capacity:
+                return view[start:end].copy()
+            return numpy.concatenate((view[start:], view[:end - self.capacity]))
+
+        if end <= self.capacity:
+            return data[start:end].tolist()
+        return data[start:].tolist() + data[:end - self.capacity].tolist()
+
+    def __len__(self):
+        return self.count
+
+
+def parse_timestamp(timestamp):
+    '''BitMEX's ISO 8601 timestamps ('2019-05-01T12:00:00.000Z') as epoch seconds.'''
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00')).timestamp()
+
+
+def _number(value):
+    return NAN if value is None else float(value)
+
+
+def _side(value):
+    return 1.0 if value == 'Buy' else -1.0
+
+
+NAN = float('nan')
+
+
+class History(object):
+
+    """A keyless websocket table (trade, quote) kept as a fixed-depth ring per symbol.
+
+    Rows are still available as dicts, newest last, for code that iterates the table; the
+    numeric fields also go into a RingBuffer per symbol for vectorised queries. Unlike a
+    list trimmed by half when it grows too long, the depth never changes and nothing is
+    copied on insert.
+    """
+
+    def __init__(self, columns, depth):
+        self.columns = tuple(columns)
+        self.depth = depth
+        self.rows = deque(maxlen=depth)
+        self.rings = {}
+        self.converters = [(column, self.__timestamp if column == 'timestamp' else
+                            _side if column == 'side' else _number) for column in self.columns]
+        self.last_timestamp = (None, 0.0)
+
+    def extend(self, rows):
+        for row in rows:
+            self.rows.append(row)
+            ring = self.rings.get(row['symbol'])
+            if ring is None:
+                ring = self.rings[row['symbol']] = RingBuffer(self.depth, self.columns)
+            ring.append([convert(row.get(column)) for column, convert in self.converters])
+
+    def column(self, symbol, name, n=None):
+        return self.read(symbol, (name,), n)[0]
+
+    def read(self, symbol, names, n=None, since=None):
+        '''The named columns of a symbol's last n rows (default all), or of those with a timestamp at
+        or after epoch time `since`; all taken from the same rows, however many arrive meanwhile.'''
+        ring = self.rings.get(symbol)
+        if ring is None:
+            return [numpy.empty(0) if numpy is not None else [] for _ in names]
+        return ring.read(names, n, since, 'timestamp')
+
+    def count_since(self, symbol, since):
+        '''How many of a symbol's latest rows have a timestamp at or after epoch time `since`.'''
+        return len(self.read(symbol, ('timestamp',), since=since)[0])
+
+    def __timestamp(self, value):
+        # Rows in a message (and often consecutive messages) share a timestamp
+        if value != self.last_timestamp[0]:
+            self.last_timestamp = (value, parse_timestamp(value))
+        return self.last_timestamp[1]
+
+    def __iter__(self):
+        return iter(list(self.rows))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self.rows)[i]
+        return self.rows[i]
+
+
+def vwap(prices, sizes):
+    '''Volume-weighted average price, or None with no volume.'''
+    if numpy is not None:
+        volume = numpy.sum(sizes)
+        return float(numpy.dot(prices, sizes) / volume) if volume else None
+    volume = sum(sizes)
+    return sum(p * s for p, s in zip(prices, sizes)) / volume if volume else None
+
+
+def volatility(prices):
+    '''Standard deviation of log returns between consecutive prices, or None with fewer than three.'''
+    if len(prices) < 3:
+        return None
+    if numpy is not None:
+        return float(numpy.std(numpy.diff(numpy.log(prices))))
+    returns = [math.log(b / a) for a, b in zip(prices, prices[1:])]
+    mean = sum(returns) / len(returns)
+    return math.sqrt(sum((r - mean) ** 2 for r in returns) / len(returns))
@@ -0,0 +1,196 @@
+"""orderBookL2 maintenance.
+
+BitMEX sends every price level as a row keyed by (symbol, id, side). Inserts and deletes
+carry a price; updates usually carry only the new size. Each symbol's book keeps those rows
+by id, plus one sorted list of prices per side, so:
+
+    inserts and deletes   O(log n) to find the slot (plus a memmove)
+    size updates          O(1)
+    best bid/ask, level n O(1)
+
+    python -m market_maker.ws.orderbook bench [--levels 500] [--messages 200000]
+"""
+from __future__ import absolute_import
+import argparse
+from bisect import bisect_left
+import json
+import random
+import time
+
+
+class SymbolBook(object):
+
+    """One symbol's L2 book."""
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.rows = {}  # (id, side) -> row
+        # Prices ascending on both sides: the best bid is last, the best ask first.
+        self.prices = {'Buy': [], 'Sell': []}
+        self.levels = {'Buy': {}, 'Sell': {}}  # side -> price -> row
+
+    def insert(self, row):
+        key = (row['id'], row['side'])
+        if key in self.rows:
+            self.remove(row)
+        prices = self.prices[row['side']]
+        prices.insert(bisect_left(prices, row['price']), row['price'])
+        self.levels[row['side']][row['price']] = row
+        self.rows[key] = row
+
+    def update(self, data):
+        row = self.rows.get((data['id'], data['side']))
+        if row is None:
+            return  # Could happen before the partial
+        if 'price' in data and data['price'] != row['price']:
+            self.remove(row)
+            row = dict(row)
+            row.update(data)
+            self.insert(row)
+        else:
+            row.update(data)
+
+    def remove(self, data):
+        row = self.rows.pop((data['id'], data['side']), None)
+        if row is None:
+            return
+        prices = self.prices[row['side']]
+        i = bisect_left(prices, row['price'])
+        if i < len(prices) and prices[i] == row['price']:
+            del prices[i]
+        self.levels[row['side']].pop(row['price'], None)
+
+    def level(self, side, n=0):
+        '''The nth best (price, size) on a side ('Buy' for bids, 'Sell' for asks), or None.'''
+        prices = self.prices[side]
+        if n >= len(prices):
+            return None
+        price = prices[-1 - n] if side == 'Buy' else prices[n]
+        return price, self.levels[side][price]['size']
+
+    def best_bid(self):
+        return self.level('Buy')
+
+    def best_ask(self):
+        return self.level('Sell')
+
+    def depth(self, side, n):
+        '''Total size on the best n levels of a side.'''
+        prices = self.prices[side]
+        best = prices[-n:] if side == 'Buy' else prices[:n]
+        return sum(self.levels[side][price]['size'] for price in best)
+
+    def sweep(self, side, quantity):
+        '''What filling `quantity` against a side would cost: (average price, worst price, filled).
+
+        To buy, sweep 'Sell'. filled is less than quantity if the book is too thin.'''
+        prices = self.prices[side]
+        best_first = reversed(prices) if side == 'Buy' else iter(prices)
+        filled = cost = 0
+        worst = None
+        for price in best_first:
+            take = min(self.levels[side][price]['size'], quantity - filled)
+            filled += take
+            cost += take * price
+            worst = price
+            if filled >= quantity:
+                break
+        return (cost / filled if filled else None), worst, filled
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class OrderBook(object):
+
+    """The orderBookL2 table: a SymbolBook per subscribed symbol."""
+
+    def __init__(self):
+        self.books = {}
+
+    def book(self, symbol):
+        return self.books.get(symbol)
+
+    def apply(self, action, data):
+        if action == 'partial':
+            # A partial is a full image of the symbols in it
+            for symbol in set(row['symbol'] for row in data):
+                self.books[symbol] = SymbolBook(symbol)
+        for row in data:
+            book = self.books.get(row['symbol'])
+            if book is None:
+                if action != 'insert':
+                    continue
+                book = self.books[row['symbol']] = SymbolBook(row['symbol'])
+            if action in ['partial', 'insert']:
+                book.insert(row)
+            elif action == 'update':
+                book.update(row)
+            elif action == 'delete':
+                book.remove(row)
+            else:
+                raise Exception("Unknown action: %s" % action)
+
+    def __iter__(self):
+        return iter([row for book in self.books.values() for row in book.rows.values()])
+
+    def __len__(self):
+        return sum(len(book) for book in self.books.values())
+
+
+def synthetic_stream(levels, messages, symbol='XBTUSD', tick=0.5, mid=10000.0):
+    """A partial of `levels` per side, then random size updates with some level churn, as frames."""
+    ids = {}
+    rows = []
+    for i in range(1, levels + 1):
+        for side, price in [('Buy', mid - i * tick), ('Sell', mid + i * tick)]:
+            ids[(side, price)] = len(ids)
+            rows.append({'symbol': symbol, 'id': ids[(side, price)], 'side': side, 'size': random.randint(1, 500) * 100,
+                         'price': price})
+    yield json.dumps({'table': 'orderBookL2', 'action': 'partial', 'keys': ['symbol', 'id', 'side'], 'data': rows})
+
+    live = list(ids)
+    for _ in range(messages):
+        side, price = random.choice(live)
+        roll = random.random()
+        if roll < 0.8:
+            data, action = [{'symbol': symbol, 'id': ids[(side, price)], 'side': side,
+                             'size': random.randint(1, 500) * 100}], 'update'
+        elif roll < 0.9:
+            live.remove((side, price))
+            data, action = [{'symbol': symbol, 'id': ids[(side, price)], 'side': side}], 'delete'
+        else:
+            # Re-add a level just outside the book on the same side
+            price = (min if side == 'Buy' else max)(p for s, p in live if s == side) + (-tick if side == 'Buy' else tick)
+            ids.setdefault((side, price), len(ids))
+            live.append((side, price))
+            data, action = [{'symbol': symbol, 'id': ids[(side, price)], 'side': side,
+                             'size': random.randint(1, 500) * 100, 'price': price}], 'insert'
+        yield json.dumps({'table': 'orderBookL2', 'action': action, 'data': data})
+
+
+def bench(levels, messages):
+    from market_maker.ws.ws_thread import BitMEXWebsocket
+
+    frames = list(synthetic_stream(levels, messages))
+    ws = BitMEXWebsocket()
+
+    start = time.perf_counter()
+    for frame in frames:
+        ws.feed(frame)
+    elapsed = time.perf_counter() - start
+
+    book = ws.market_depth('XBTUSD')
+    print('%d orderBookL2 messages over %d levels/side in %.3fs: %.0f messages/s' %
+          (len(frames), levels, elapsed, len(frames) / elapsed if elapsed else 0))
+    print('  %d levels, best bid %s, best ask %s' % (len(book), book.best_bid(), book.best_ask()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark orderBookL2 maintenance on a synthetic stream')
+    parser.add_argument('command', choices=['bench'])
+    parser.add_argument('--levels', type=int, default=500, help='levels per side in the partial')
+    parser.add_argument('--messages', type=int, default=200000)
+    args = parser.parse_args()
+
+    bench(args.levels, args.messages)
@@ -0,0 +1,135 @@
+"""Record raw websocket frames to disk and replay them into a BitMEXWebsocket offline.
+
+Frames are appended to the file as they arrive, each prefixed with a little-endian
+(float64 receive time, uint32 length) header. Paths ending in .gz are gzip compressed;
+gzip members concatenate, so those files are append-only too.
+
+    python -m market_maker.ws.recorder bench session.bin.gz [--speed 10] [--decoder orjson] [--debug]
+
+bench replays once per installed JSON decoder unless one is named. --debug formats every
+debug line as if DEBUG logging were on (without printing it), which is what every frame
+used to cost regardless of the log level.
+"""
+from __future__ import absolute_import
+import argparse
+import gzip
+import logging
+import os
+import struct
+import threading
+import time
+
+
+HEADER = struct.Struct('<dI')
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+class FrameRecorder(object):
+
+    """Appends raw websocket frames with their receive timestamps to a file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = _open(path, 'ab')
+        self.lock = threading.Lock()
+
+    def write(self, frame, received=None):
+        if received is None:
+            received = time.time()
+        if not isinstance(frame, bytes):
+            frame = frame.encode('utf8')
+        with self.lock:
+            self.file.write(HEADER.pack(received, len(frame)) + frame)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_frames(path):
+    """Yield (receive time, frame) pairs from a recording."""
+    with _open(path, 'rb') as f:
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return  # end of file, or a partial write at the tail
+            received, length = HEADER.unpack(header)
+            frame = f.read(length)
+            if len(frame) < length:
+                return
+            yield received, frame.decode('utf8')
+
+
+def replay(path, ws=None, speed=None):
+    """Feed a recording into a BitMEXWebsocket without touching the network.
+
+    speed=None replays as fast as possible, 1 at the recorded pace, 10 at ten times that.
+    Listeners already registered on ws fire exactly as they would live. Returns the
+    websocket and the number of frames fed."""
+    from market_maker.ws.ws_thread import BitMEXWebsocket
+
+    if ws is None:
+        ws = BitMEXWebsocket()
+
+    count = 0
+    start = first = None
+    for received, frame in read_frames(path):
+        if speed:
+            if first is None:
+                start, first = time.monotonic(), received
+            delay = (received - first) / speed - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        ws.feed(frame)
+        count += 1
+    return ws, count
+
+
+def bench(path, speed=None, decoder=None, debug=False):
+    from market_maker.ws.ws_thread import BitMEXWebsocket
+
+    ws = BitMEXWebsocket(decoder=decoder)
+    logger = ws.logger
+    level, handlers = logger.level, logger.handlers
+    if debug:
+        logger.setLevel(logging.DEBUG)
+        logger.handlers = [logging.NullHandler()]
+
+    try:
+        start = time.perf_counter()
+        ws, count = replay(path, ws=ws, speed=speed)
+        elapsed = time.perf_counter() - start
+    finally:
+        logger.setLevel(level)
+        logger.handlers = handlers
+
+    print('%-7s%s %d frames (%.1f MB on disk) in %.3fs: %.0f frames/s' %
+          (decoder or 'auto', ' +debug' if debug else '', count, os.path.getsize(path) / 1e6, elapsed,
+           count / elapsed if elapsed else 0))
+    return ws
+
+
+if __name__ == '__main__':
+    from market_maker.utils import fastjson
+
+    parser = argparse.ArgumentParser(description='replay a recorded websocket session')
+    parser.add_argument('command', choices=['bench'])
+    parser.add_argument('path')
+    parser.add_argument('--speed', type=float, default=None,
+                        help='replay speed relative to the recording (default: as fast as possible)')
+    parser.add_argument('--decoder', choices=sorted(fastjson.BACKENDS),
+                        help='JSON decoder to use (default: compare every installed one)')
+    parser.add_argument('--debug', action='store_true',
+                        help='also format debug log lines, as every frame did before they were made lazy')
+    args = parser.parse_args()
+
+    for decoder in [args.decoder] if args.decoder else fastjson.available():
+        ws = bench(args.path, args.speed, decoder, args.debug)
+
+    for table in sorted(ws.data):
+        print('  %s: %d rows' % (table, len(ws.data[table])))
@@ -0,0 +1,59 @@
+class KeyedTable(object):
+
+    """A websocket table indexed by the keys sent on its partial.
+
+    Rows live in a dict keyed by the tuple of key values, so inserts, updates and deletes
+    are O(1). Dicts keep insertion order, so iterating the table still yields rows in the
+    order the exchange sent them. An optional secondary index maps a single field (e.g.
+    'symbol' for positions, whose keys also include account and currency) to its row.
+    """
+
+    def __init__(self, keys, index=None):
+        self.keys = tuple(keys)
+        self.index_field = index
+        self.rows = {}
+        self.index = {}
+
+    def key_of(self, item):
+        return tuple(item[k] for k in self.keys)
+
+    def get(self, matchData):
+        '''Return the row matching the keys in matchData, or None.'''
+        return self.rows.get(self.key_of(matchData))
+
+    def find(self, value):
+        '''Return the row whose index field equals value, or None.'''
+        return self.index.get(value)
+
+    def insert(self, items):
+        for item in items:
+            self.rows[self.key_of(item)] = item
+            if self.index_field is not None:
+                self.index[item.get(self.index_field)] = item
+
+    def remove(self, item):
+        row = self.rows.pop(self.key_of(item), None)
+        if row is not None and self.index_field is not None:
+            if self.index.get(row.get(self.index_field)) is row:
+                del self.index[row.get(self.index_field)]
+        return row
+
+    def values(self):
+        return list(self.rows.values())
+
+    def __iter__(self):
+        return iter(list(self.rows.values()))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, item):
+        return self.key_of(item) in self.rows
+
+    def __getitem__(self, i):
+        if i == 0:
+            # Fast path for single-row tables like 'margin'
+            for row in self.rows.values():
+                return row
+            raise IndexError('table is empty')
+        return self.values()[i]
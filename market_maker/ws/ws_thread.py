@@ -1,16 +1,24 @@
 import sys
+from collections import OrderedDict
 import websocket
 import threading
 import traceback
 import ssl
-from time import sleep
+from time import perf_counter, sleep, time
 import json
-import decimal
 import logging
+from types import MappingProxyType
 from market_maker.settings import settings
 from market_maker.auth.APIKeyAuth import generate_expires, generate_signature
+from market_maker.utils import fastjson
+from market_maker.utils.latency import LatencyRecorder
+from market_maker.utils.metrics import Metrics
 from market_maker.utils.log import setup_custom_logger
-from market_maker.utils.math import toNearest
+from market_maker.utils import ticks
+from market_maker.ws import history
+from market_maker.ws.orderbook import OrderBook
+from market_maker.ws.recorder import FrameRecorder
+from market_maker.ws.table import KeyedTable
 from future.utils import iteritems
 from future.standard_library import hooks
 with hooks():  # Python 2/3 compat
@@ -30,60 +38,125 @@ class BitMEXWebsocket():
     # Don't grow a table larger than this amount. Helps cap memory usage.
     MAX_TABLE_LEN = 200
 
-    def __init__(self):
+    # Orders remembered after they leave the order table, so a request whose response was lost
+    # can still be checked against what the exchange did with it.
+    MAX_RECENT_ORDERS = 1000
+
+    # Keyless tables kept as fixed-depth history rings (settings.WS_HISTORY_DEPTH rows per symbol)
+    # instead of trimmed lists, with these fields stored as columns.
+    HISTORY_COLUMNS = {'trade': ('timestamp', 'price', 'size', 'side'),
+                       'quote': ('timestamp', 'bidPrice', 'bidSize', 'askPrice', 'askSize')}
+
+    # Secondary indexes for keyed tables whose keys aren't what we look rows up by.
+    INDEX_FIELDS = {'instrument': 'symbol', 'position': 'symbol'}
+
+    def __init__(self, decoder=None, latency=None, metrics=None):
+        '''decoder names the JSON backend for frames (see market_maker.utils.fastjson);
+        settings.WS_JSON_DECODER if not given. Timings go to latency, a LatencyRecorder, and
+        message counts to metrics.'''
         self.logger = logging.getLogger('root')
+        self.latency = latency or LatencyRecorder()
+        self.metrics = metrics or Metrics()
+        self.ws = None
+        self.recorder = None
+        self.decode = fastjson.decoder(decoder or settings.WS_JSON_DECODER)
+        # Notified after every position message, and on exit
+        self._position_changed = threading.Condition()
+        # Notified after every order message, and on exit
+        self._orders_changed = threading.Condition()
         self.__reset()
 
     def __del__(self):
         self.exit()
 
-    def connect(self, endpoint="", symbol="XBTN15", shouldAuth=True):
-        '''Connect to the websocket and initialize data stores.'''
+    def connect(self, endpoint="", symbol="XBTN15", shouldAuth=True, apiKey=None, apiSecret=None):
+        '''Connect to the websocket and initialize data stores.
+
+        symbol may be a list, in which case every symbol is streamed over this one connection.
+        apiKey/apiSecret default to the ones in settings.'''
 
         self.logger.debug("Connecting WebSocket.")
-        self.symbol = symbol
+        wsURL = self.prepare(endpoint, symbol, shouldAuth, apiKey, apiSecret)
+        self.logger.info("Connecting to %s" % wsURL)
+        self.__connect(wsURL)
+        self.logger.info('Connected to WS. Waiting for data images, this may take a moment...')
+
+        # Connected. Wait for partials
+        while not self.ready():
+            sleep(0.1)
+        self.logger.info('Got all market data. Starting.')
+
+    def prepare(self, endpoint, symbol, shouldAuth=True, apiKey=None, apiSecret=None):
+        '''Set up everything connect() needs short of the socket itself, and return the URL to open.
+
+        Lets another transport (see market_maker.async_bitmex) share the setup.'''
+        self.symbols = [symbol] if isinstance(symbol, str) else list(symbol)
+        self.symbol = self.symbols[0]
         self.shouldAuth = shouldAuth
+        self.apiKey = apiKey or settings.API_KEY
+        self.apiSecret = apiSecret or settings.API_SECRET
+
+        if settings.WS_RECORD_FILE:
+            self.logger.info("Recording websocket frames to %s" % settings.WS_RECORD_FILE)
+            self.recorder = FrameRecorder(settings.WS_RECORD_FILE)
 
         # We can subscribe right in the connection querystring, so let's build that.
         # Subscribe to all pertinent endpoints
-        subscriptions = [sub + ':' + symbol for sub in ["quote", "trade"]]
+        subscriptions = [sub + ':' + symbol for symbol in self.symbols for sub in ["quote", "trade"]]
         subscriptions += ["instrument"]  # We want all of them
+        if settings.WS_ORDER_BOOK:
+            subscriptions += ["orderBookL2:" + symbol for symbol in self.symbols]
         if self.shouldAuth:
-            subscriptions += [sub + ':' + symbol for sub in ["order", "execution"]]
+            subscriptions += [sub + ':' + symbol for symbol in self.symbols for sub in ["order", "execution"]]
             subscriptions += ["margin", "position"]
 
-        # Get WS URL and connect.
+        # Get WS URL
         urlParts = list(urlparse(endpoint))
         urlParts[0] = urlParts[0].replace('http', 'ws')
         urlParts[2] = "/realtime?subscribe=" + ",".join(subscriptions)
-        wsURL = urlunparse(urlParts)
-        self.logger.info("Connecting to %s" % wsURL)
-        self.__connect(wsURL)
-        self.logger.info('Connected to WS. Waiting for data images, this may take a moment...')
+        return urlunparse(urlParts)
 
-        # Connected. Wait for partials
-        self.__wait_for_symbol(symbol)
+    def ready(self):
+        '''True once the partials we subscribed to have all come down.'''
+        tables = {'instrument', 'trade', 'quote'}
         if self.shouldAuth:
-            self.__wait_for_account()
-        self.logger.info('Got all market data. Starting.')
+            tables |= {'margin', 'position', 'order'}
+        return tables <= set(self.data)
 
     #
     # Data methods
     #
     def get_instrument(self, symbol):
-        instruments = self.data['instrument']
-        matchingInstruments = [i for i in instruments if i['symbol'] == symbol]
-        if len(matchingInstruments) == 0:
-            raise Exception("Unable to find instrument or index with symbol: " + symbol)
-        instrument = matchingInstruments[0]
-        # Turn the 'tickSize' into 'tickLog' for use in rounding
-        # http://stackoverflow.com/a/6190291/832202
-        instrument['tickLog'] = decimal.Decimal(str(instrument['tickSize'])).as_tuple().exponent * -1
-        return instrument
+        '''Return a read-only snapshot of an instrument, with 'tickLog' filled in.
+
+        Snapshots are cached until the next 'instrument' message for that symbol.'''
+        return self.__cached(self._instruments, self._instrument_versions, symbol, self.__build_instrument)
 
     def get_ticker(self, symbol):
-        '''Return a ticker object. Generated from instrument.'''
+        '''Return a ticker object. Generated from instrument and the latest quote, and cached until either changes.'''
+        return self.__cached(self._tickers, self._ticker_versions, symbol, self.__build_ticker)
+
+    def __cached(self, cache, versions, symbol, build):
+        # Entries are (version, snapshot). The version is read before the row, so a snapshot built
+        # from a row the websocket thread updates meanwhile is stored under the old version and
+        # rebuilt on the next read rather than served until the following message.
+        version = versions.get(symbol, 0)
+        entry = cache.get(symbol)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        snapshot = MappingProxyType(build(symbol))
+        cache[symbol] = (version, snapshot)
+        return snapshot
+
+    def __build_instrument(self, symbol):
+        instrument = self.data['instrument'].find(symbol)
+        if instrument is None:
+            raise Exception("Unable to find instrument or index with symbol: " + symbol)
+        snapshot = dict(instrument)
+        snapshot['tickLog'] = ticks.grid(instrument['tickSize']).decimals
+        return snapshot
 
+    def __build_ticker(self, symbol):
         instrument = self.get_instrument(symbol)
 
         # If this is an index, we have to get the data from the last trade.
@@ -92,8 +165,10 @@ class BitMEXWebsocket():
             ticker['mid'] = ticker['buy'] = ticker['sell'] = ticker['last'] = instrument['markPrice']
         # Normal instrument
         else:
-            bid = instrument['bidPrice'] or instrument['lastPrice']
-            ask = instrument['askPrice'] or instrument['lastPrice']
+            # Quotes arrive ahead of the instrument's bidPrice/askPrice, so prefer them.
+            quote = self._quotes.get(symbol) or instrument
+            bid = quote['bidPrice'] or instrument['lastPrice']
+            ask = quote['askPrice'] or instrument['lastPrice']
             ticker = {
                 "last": instrument['lastPrice'],
                 "buy": bid,
@@ -102,32 +177,110 @@ class BitMEXWebsocket():
             }
 
         # The instrument has a tickSize. Use it to round values.
-        return {k: toNearest(float(v or 0), instrument['tickSize']) for k, v in iteritems(ticker)}
+        grid = ticks.grid(instrument['tickSize'])
+        return {k: grid.round(float(v or 0)) for k, v in iteritems(ticker)}
 
     def funds(self):
         return self.data['margin'][0]
 
     def market_depth(self, symbol):
-        raise NotImplementedError('orderBook is not subscribed; use askPrice and bidPrice on instrument')
-        # return self.data['orderBook25'][0]
+        '''The symbol's L2 book (see market_maker.ws.orderbook.SymbolBook), or None until it has come down.
 
-    def open_orders(self, clOrdIDPrefix):
-        orders = self.data['order']
+        Only streamed with settings.WS_ORDER_BOOK; otherwise use askPrice and bidPrice on instrument.'''
+        book = self.data.get('orderBookL2')
+        return book.book(symbol) if book is not None else None
+
+    def open_orders(self, clOrdIDPrefix, symbol=None):
+        # Filled and canceled orders are dropped from the table as they come in, so this
+        # only walks orders that are still live.
+        orders = self.data['order'].rows.values()
         # Filter to only open orders (leavesQty > 0) and those that we actually placed
         return [o for o in orders if str(o['clOrdID']).startswith(clOrdIDPrefix) and
-                ('Close' in o['execInst'] or o['leavesQty'] > 0)]
+                ('Close' in o['execInst'] or o['leavesQty'] > 0) and
+                (symbol is None or o['symbol'] == symbol)]
+
+    def get_order(self, orderID):
+        '''Look up an order we've seen on the order table, open or not yet removed.'''
+        return self.data['order'].get({'orderID': orderID})
+
+    def find_order(self, orderID=None, clOrdID=None):
+        '''Look up a recent order by orderID or clOrdID, whether it's open or has since filled or
+        been canceled. None if the order table hasn't shown it.'''
+        if orderID is not None:
+            return self._recent_orders.get(orderID)
+        return self._recent_clOrdIDs.get(clOrdID)
+
+    def wait_for_orders(self, check, timeout=None):
+        '''Block until check() returns something truthy, calling it again after each order message.
+
+        Returns its last result, which is falsy after timeout seconds or if the websocket closes.'''
+        with self._orders_changed:
+            self._orders_changed.wait_for(lambda: self.exited or check(), timeout)
+        return check()
+
+    def quote_received(self, symbol):
+        '''perf_counter() when the frame with the symbol's latest quote arrived, or None.'''
+        return self._quote_received.get(symbol)
+
+    def expect_orders(self, keys, stage, sent):
+        '''Record stage as the time from sent until the order table first shows each of keys:
+        clOrdIDs of new orders, or orderIDs of amended ones.'''
+        # Requests that failed never show up; start over rather than grow
+        if len(self._awaited) > BitMEXWebsocket.MAX_RECENT_ORDERS:
+            self._awaited.clear()
+        for key in keys:
+            self._awaited[key] = (stage, sent)
 
     def position(self, symbol):
-        positions = self.data['position']
-        pos = [p for p in positions if p['symbol'] == symbol]
-        if len(pos) == 0:
+        pos = self.data['position'].find(symbol)
+        if pos is None:
             # No position found; stub it
             return {'avgCostPrice': 0, 'avgEntryPrice': 0, 'currentQty': 0, 'symbol': symbol}
-        return pos[0]
+        return pos
+
+    def wait_for_position(self, symbol, qty=0, timeout=None):
+        '''Block until the symbol's currentQty is qty, waking as soon as the position message arrives.
+
+        Returns whether it got there: False after timeout seconds, or if the websocket closes.'''
+        with self._position_changed:
+            self._position_changed.wait_for(
+                lambda: self.exited or self.position(symbol)['currentQty'] == qty, timeout)
+        return self.position(symbol)['currentQty'] == qty
 
     def recent_trades(self):
         return self.data['trade']
 
+    def vwap(self, symbol, seconds=None):
+        '''Volume-weighted average price of the trades in the history, or of the last `seconds` of them.
+
+        None if there were no trades.'''
+        trades = self.data.get('trade')
+        if trades is None:
+            return None
+        prices, sizes = trades.read(symbol, ('price', 'size'), since=None if seconds is None else time() - seconds)
+        return history.vwap(prices, sizes)
+
+    def volatility(self, symbol, trades=None):
+        '''Standard deviation of trade-to-trade log returns over the last `trades` trades (default all kept).'''
+        table = self.data.get('trade')
+        if table is None:
+            return None
+        return history.volatility(table.column(symbol, 'price', trades))
+
+    #
+    # Event methods
+    #
+    def add_listener(self, table, callback):
+        '''Call callback(table, action, data) whenever a message for table has been applied.
+
+        Callbacks run on the websocket thread, so they should hand off work rather than
+        block (e.g. by setting a threading.Event).'''
+        self._listeners.setdefault(table, []).append(callback)
+
+    def remove_listener(self, table, callback):
+        if callback in self._listeners.get(table, []):
+            self._listeners[table].remove(callback)
+
     #
     # Lifecycle methods
     #
@@ -138,7 +291,35 @@ class BitMEXWebsocket():
 
     def exit(self):
         self.exited = True
-        self.ws.close()
+        with self._position_changed:
+            self._position_changed.notify_all()
+        with self._orders_changed:
+            self._orders_changed.notify_all()
+        if self.ws is not None:
+            self.ws.close()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def feed(self, message):
+        '''Process a raw frame as if it had arrived on the socket. Used to replay recordings.'''
+        self.__on_message(message)
+
+    def auth_headers(self):
+        '''Return auth headers as "name: value" strings. Uses the keys given to connect(), or settings'.'''
+
+        if self.shouldAuth is False:
+            return []
+
+        self.logger.info("Authenticating with API Key.")
+        # To auth to the WS using an API key, we generate a signature of a nonce and
+        # the WS API endpoint.
+        nonce = generate_expires()
+        return [
+            "api-expires: " + str(nonce),
+            "api-signature: " + generate_signature(self.apiSecret, 'GET', '/realtime', nonce, ''),
+            "api-key:" + self.apiKey
+        ]
 
     #
     # Private methods
@@ -155,7 +336,7 @@ class BitMEXWebsocket():
                                          on_close=self.__on_close,
                                          on_open=self.__on_open,
                                          on_error=self.__on_error,
-                                         header=self.__get_auth()
+                                         header=self.auth_headers()
                                          )
 
         setup_custom_logger('websocket', log_level=settings.LOG_LEVEL)
@@ -175,32 +356,58 @@ class BitMEXWebsocket():
             self.exit()
             sys.exit(1)
 
-    def __get_auth(self):
-        '''Return auth headers. Will use API Keys if present in settings.'''
-
-        if self.shouldAuth is False:
-            return []
-
-        self.logger.info("Authenticating with API Key.")
-        # To auth to the WS using an API key, we generate a signature of a nonce and
-        # the WS API endpoint.
-        nonce = generate_expires()
-        return [
-            "api-expires: " + str(nonce),
-            "api-signature: " + generate_signature(settings.API_SECRET, 'GET', '/realtime', nonce, ''),
-            "api-key:" + settings.API_KEY
-        ]
-
-    def __wait_for_account(self):
-        '''On subscribe, this data will come down. Wait for it.'''
-        # Wait for the keys to show up from the ws
-        while not {'margin', 'position', 'order'} <= set(self.data):
-            sleep(0.1)
-
-    def __wait_for_symbol(self, symbol):
-        '''On subscribe, this data will come down. Wait for it.'''
-        while not {'instrument', 'trade', 'quote'} <= set(self.data):
-            sleep(0.1)
+    def __invalidate_instruments(self, action, data):
+        '''Move on the versions of instruments touched by a message, so their cached snapshots are rebuilt.'''
+        if action == 'partial':
+            self._instruments.clear()
+            self._tickers.clear()
+        for row in data:
+            symbol = row.get('symbol')
+            self._instrument_versions[symbol] = self._instrument_versions.get(symbol, 0) + 1
+            self.__refresh_ticker(symbol)
+
+    def __track_quotes(self, data, received):
+        '''Remember the latest quote per symbol so tickers follow the top of book.'''
+        for quote in data:
+            self._quotes[quote['symbol']] = quote
+            self._quote_received[quote['symbol']] = received
+            self.__refresh_ticker(quote['symbol'])
+
+    def __refresh_ticker(self, symbol):
+        # Quotes move the ticker on every message, so once a symbol's ticker has been read it's rebuilt
+        # here on the websocket thread, where nothing can change underneath it, rather than by the
+        # next reader. Every instrument is streamed; the rest are left for get_ticker().
+        version = self._ticker_versions[symbol] = self._ticker_versions.get(symbol, 0) + 1
+        if symbol in self._tickers and self.data['instrument'].find(symbol) is not None:
+            self._tickers[symbol] = (version, MappingProxyType(self.__build_ticker(symbol)))
+
+    def __notify(self, table, action, data):
+        for callback in self._listeners.get(table, ()):
+            try:
+                callback(table, action, data)
+            except Exception:
+                self.logger.error(traceback.format_exc())
+
+    def __remember_orders(self, rows):
+        # These are the row objects the table holds, so later updates show up here too,
+        # including the last one before a filled or canceled order is removed.
+        for row in rows:
+            self._recent_orders[row['orderID']] = row
+            if row.get('clOrdID'):
+                self._recent_clOrdIDs[row['clOrdID']] = row
+        while len(self._recent_orders) > BitMEXWebsocket.MAX_RECENT_ORDERS:
+            _, row = self._recent_orders.popitem(last=False)
+            if self._recent_clOrdIDs.get(row.get('clOrdID')) is row:
+                del self._recent_clOrdIDs[row['clOrdID']]
+
+    def __arrived(self, rows, received):
+        # Inserts carry the clOrdID a new order was sent with; amends come back as updates by orderID
+        for row in rows:
+            for key in (row.get('clOrdID'), row.get('orderID')):
+                awaited = self._awaited.pop(key, None)
+                if awaited is not None:
+                    self.latency.record(awaited[0], received - awaited[1])
+                    break
 
     def __send_command(self, command, args):
         '''Send a raw command.'''
@@ -208,8 +415,14 @@ class BitMEXWebsocket():
 
     def __on_message(self, message):
         '''Handler for parsing WS messages.'''
-        message = json.loads(message)
-        self.logger.debug(json.dumps(message))
+        received = perf_counter()
+        if self.recorder is not None:
+            self.recorder.write(message)
+        message = self.decode(message)
+        # Checked once per frame; formatting the debug lines costs more than applying the message
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.logger.debug(json.dumps(message))
 
         table = message['table'] if 'table' in message else None
         action = message['action'] if 'action' in message else None
@@ -228,7 +441,13 @@ class BitMEXWebsocket():
             elif action:
 
                 if table not in self.data:
-                    self.data[table] = []
+                    if table in BitMEXWebsocket.HISTORY_COLUMNS:
+                        self.data[table] = history.History(BitMEXWebsocket.HISTORY_COLUMNS[table],
+                                                           settings.WS_HISTORY_DEPTH)
+                    elif table == 'orderBookL2':
+                        self.data[table] = OrderBook()
+                    else:
+                        self.data[table] = []
 
                 if table not in self.keys:
                     self.keys[table] = []
@@ -238,26 +457,48 @@ class BitMEXWebsocket():
                 # 'insert'  - new row
                 # 'update'  - update row
                 # 'delete'  - delete row
-                if action == 'partial':
-                    self.logger.debug("%s: partial" % table)
-                    self.data[table] += message['data']
+                if isinstance(self.data[table], OrderBook):
+                    # Kept by price level rather than as a keyed table; updates there carry no price
+                    if debug:
+                        self.logger.debug('%s: %s %d rows' % (table, action, len(message['data'])))
+                    self.data[table].apply(action, message['data'])
+                elif action == 'partial':
+                    if debug:
+                        self.logger.debug("%s: partial" % table)
                     # Keys are communicated on partials to let you know how to uniquely identify
                     # an item. We use it for updates.
                     self.keys[table] = message['keys']
+                    if self.keys[table]:
+                        # Anything that arrived before the partial is carried over.
+                        rows = list(self.data[table])
+                        self.data[table] = KeyedTable(self.keys[table], BitMEXWebsocket.INDEX_FIELDS.get(table))
+                        self.data[table].insert(rows)
+                        self.data[table].insert(message['data'])
+                    else:
+                        self.data[table].extend(message['data'])
                 elif action == 'insert':
-                    self.logger.debug('%s: inserting %s' % (table, message['data']))
-                    self.data[table] += message['data']
-
-                    # Limit the max length of the table to avoid excessive memory usage.
-                    # Don't trim orders because we'll lose valuable state if we do.
-                    if table not in ['order', 'orderBookL2'] and len(self.data[table]) > BitMEXWebsocket.MAX_TABLE_LEN:
-                        self.data[table] = self.data[table][(BitMEXWebsocket.MAX_TABLE_LEN // 2):]
+                    if debug:
+                        self.logger.debug('%s: inserting %s' % (table, message['data']))
+                    if isinstance(self.data[table], KeyedTable):
+                        self.data[table].insert(message['data'])
+                    else:
+                        self.data[table].extend(message['data'])
+
+                        # Limit the max length of the table to avoid excessive memory usage.
+                        # Keyed tables (orders, positions, ...) are never trimmed because we'd
+                        # lose valuable state if we did. History rings cap themselves.
+                        if (isinstance(self.data[table], list) and
+                                len(self.data[table]) > BitMEXWebsocket.MAX_TABLE_LEN):
+                            self.data[table] = self.data[table][(BitMEXWebsocket.MAX_TABLE_LEN // 2):]
 
                 elif action == 'update':
-                    self.logger.debug('%s: updating %s' % (table, message['data']))
+                    if debug:
+                        self.logger.debug('%s: updating %s' % (table, message['data']))
+                    if not isinstance(self.data[table], KeyedTable):
+                        return  # No partial yet, so no keys to match on
                     # Locate the item in the collection and update it.
                     for updateData in message['data']:
-                        item = findItemByKeys(self.keys[table], self.data[table], updateData)
+                        item = self.data[table].get(updateData)
                         if not item:
                             continue  # No item found to update. Could happen before push
 
@@ -268,9 +509,12 @@ class BitMEXWebsocket():
                                 contExecuted = updateData['cumQty'] - item['cumQty']
                                 if contExecuted > 0:
                                     instrument = self.get_instrument(item['symbol'])
+                                    # Market orders have no price; fall back on what they filled at
+                                    price = item['price'] if item['price'] is not None else \
+                                        updateData.get('avgPx') or 0
                                     self.logger.info("Execution: %s %d Contracts of %s at %.*f" %
                                              (item['side'], contExecuted, item['symbol'],
-                                              instrument['tickLog'], item['price']))
+                                              instrument['tickLog'], price))
 
                         # Update this item.
                         item.update(updateData)
@@ -280,13 +524,35 @@ class BitMEXWebsocket():
                             self.data[table].remove(item)
 
                 elif action == 'delete':
-                    self.logger.debug('%s: deleting %s' % (table, message['data']))
+                    if debug:
+                        self.logger.debug('%s: deleting %s' % (table, message['data']))
+                    if not isinstance(self.data[table], KeyedTable):
+                        return
                     # Locate the item in the collection and remove it.
                     for deleteData in message['data']:
-                        item = findItemByKeys(self.keys[table], self.data[table], deleteData)
-                        self.data[table].remove(item)
+                        self.data[table].remove(deleteData)
                 else:
                     raise Exception("Unknown action: %s" % action)
+
+                # Done after the table is updated so a reader can't re-cache the old row.
+                if table == 'instrument':
+                    self.__invalidate_instruments(action, message['data'])
+                elif table == 'quote':
+                    self.__track_quotes(message['data'], received)
+                elif table == 'position':
+                    with self._position_changed:
+                        self._position_changed.notify_all()
+                elif table == 'order':
+                    if action in ('partial', 'insert'):
+                        self.__remember_orders(message['data'])
+                    if self._awaited:
+                        self.__arrived(message['data'], received)
+                    with self._orders_changed:
+                        self._orders_changed.notify_all()
+
+                self.__notify(table, action, message['data'])
+                self.metrics.inc('ws_messages_total', table=table)
+                self.latency.record('ws_frame', perf_counter() - received)
         except:
             self.logger.error(traceback.format_exc())
 
@@ -304,19 +570,21 @@ class BitMEXWebsocket():
     def __reset(self):
         self.data = {}
         self.keys = {}
+        # symbol -> (version, snapshot); versions are bumped on the websocket thread
+        self._instruments = {}
+        self._tickers = {}
+        self._instrument_versions = {}
+        self._ticker_versions = {}
+        self._quotes = {}
+        self._quote_received = {}
+        self._awaited = {}
+        self._listeners = {}
+        self._recent_orders = OrderedDict()
+        self._recent_clOrdIDs = {}
         self.exited = False
         self._error = None
 
 
-def findItemByKeys(keys, table, matchData):
-    for item in table:
-        matched = True
-        for key in keys:
-            if item[key] != matchData[key]:
-                matched = False
-        if matched:
-            return item
-
 if __name__ == "__main__":
     # create console handler and set level to debug
     logger = logging.getLogger()
@@ -15,10 +15,12 @@ HEDGE_SIDE = 'Buy|Sell'
 HEDGE_MULTIPLIER = .5
 
 STOP_LIMIT_MULTIPLIER = .015
-STOP_MARKET_MULTIPlIER = .0175
+STOP_MARKET_MULTIPLIER = .0175
 
 LOOP_INTERVAL = 1
 
+EVENT_DRIVEN = True
+
 API_REST_INTERVAL = 3
 
 TIMEOUT = 10
@@ -0,0 +1,180 @@
+"""bot state snapshots, so a restart or reconnect picks up where the bot left off
+
+a snapshot holds each symbol's flags (limits_exist, hedge_exists, could_hedge), its position and
+its open orders (ids, stop levels and prices) as last seen on the websocket. it's written
+atomically whenever it changes; see FundingBot.resume and FundingBot.reconcile for how it's used
+
+bots hand snapshots to a background writer, which writes the latest one per file at most once
+every WRITE_DELAY seconds, so amending a working order never waits on the disk
+"""
+
+import atexit
+import json
+import os
+import tempfile
+import threading
+from time import monotonic
+
+from market_maker.utils import log
+
+
+logger = log.setup_custom_logger('snapshot')
+
+# a snapshot taken under different values of these is for different orders; start afresh instead
+SETTINGS = ('SYMBOL', 'ORDERID_PREFIX', 'POSITION_SIZE_BUY', 'POSITION_SIZE_SELL', 'HEDGE',
+            'HEDGE_SIDE', 'HEDGE_MULTIPLIER', 'STOP_LIMIT_MULTIPLIER', 'STOP_MARKET_MULTIPLIER')
+
+# the fields of each open order that are kept
+ORDER_KEYS = ('orderID', 'clOrdID', 'ordType', 'side', 'price', 'stopPx', 'orderQty', 'leavesQty')
+
+STOP_TYPES = ('Stop', 'StopLimit')
+
+# a snapshot is written this many seconds after the first change since the last write, so a burst
+# of amends costs one write
+WRITE_DELAY = 1
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def snapshot_path(config, name: str) -> str:
+    """where a bot's snapshot lives, or None if they're turned off"""
+
+    if not config.STATE_DIR:
+        return None
+
+    return os.path.join(config.STATE_DIR, name + '.json')
+
+
+def snapshot_settings(config) -> dict:
+    return {key: config.get(key) for key in SETTINGS}
+
+
+def write_snapshot(path: str, snapshot: dict) -> None:
+    """replace the file in one step, so a crash never leaves half a snapshot behind"""
+
+    directory = os.path.dirname(path) or '.'
+
+    os.makedirs(directory, exist_ok=True)
+
+    fd, temp = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot, f, indent=1, sort_keys=True)
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+def read_snapshot(path: str) -> dict:
+    """the snapshot at path, or None if there isn't a readable one"""
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning('unable to read snapshot %s: %s' % (path, e))
+
+        return None
+
+
+class SnapshotWriter:
+    """writes snapshots from a background thread, only the latest one handed over for each path
+
+    use SnapshotWriter.open() to share the one per process
+    """
+
+    def __init__(self, delay: float = WRITE_DELAY) -> None:
+        self.delay = delay
+
+        self.changed = threading.Condition()
+
+        # path -> the latest snapshot not yet written
+        self.pending = {}
+
+        # when the pending snapshots are written, on the monotonic clock
+        self.due = None
+
+        # how many snapshots have been handed over, and how many of those are on disk (or failed)
+        self.saved = 0
+        self.written = 0
+
+        self.thread = threading.Thread(target=self.__write, name='snapshot', daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def open(cls) -> 'SnapshotWriter':
+        global _writer
+
+        with _writer_lock:
+            if _writer is None:
+                _writer = cls()
+
+            return _writer
+
+    def save(self, path: str, snapshot: dict) -> None:
+        """queue a snapshot to replace the file at path; safe from any thread, and never touches the disk
+
+        the snapshot mustn't be changed afterwards
+        """
+
+        with self.changed:
+            self.pending[path] = snapshot
+
+            self.saved += 1
+
+            if self.due is None:
+                self.due = monotonic() + self.delay
+
+            self.changed.notify_all()
+
+    def flush(self, timeout: float = None) -> bool:
+        """write everything queued so far now, and wait until it's done"""
+
+        with self.changed:
+            saved = self.saved
+
+            if self.pending:
+                self.due = monotonic()
+
+            self.changed.notify_all()
+
+            return self.changed.wait_for(lambda: self.written >= saved, timeout)
+
+    def __write(self) -> None:
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: self.pending)
+
+                # a flush() moves the deadline up and wakes this
+                while monotonic() < self.due:
+                    self.changed.wait(self.due - monotonic())
+
+                pending, saved = self.pending, self.saved
+
+                self.pending, self.due = {}, None
+
+            for path, snapshot in pending.items():
+                try:
+                    write_snapshot(path, snapshot)
+                except (OSError, TypeError, ValueError) as e:
+                    logger.warning('unable to save state to %s: %s' % (path, e))
+
+            with self.changed:
+                self.written = saved
+
+                self.changed.notify_all()
+
+
+@atexit.register
+def flush_all() -> None:
+    if _writer is not None:
+        _writer.flush()
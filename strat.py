@@ -1,57 +1,73 @@
-from datetime import datetime
-from dateutil import tz
 import signal
-import schedule
 import threading
-from time import sleep
 
 from market_maker.utils import log
 
 from bot import FundingBot
-import settings
+from funding import FundingScheduler
 
 
 logger = log.setup_custom_logger('strat')
 
 
-def half_funding(bot: FundingBot) -> None:
-    """4 hours until funding: enter a position
+def half_funding(bot: FundingBot, symbol: str) -> None:
+    """funding is coming up: enter a position in the symbol
     if funding is negative, go long
     if funding is positive, go short
     """
 
-    bot.could_hedge = False
+    state = bot.get_state(symbol)
 
-    bot.exit_position(market=False, wait_for_fill=True)
+    state.could_hedge = False
 
-    bot.cancel_open_orders()
+    bot.exit_position(market=False, wait_for_fill=True, symbol=symbol)
 
-    funding_rate = bot.get_funding_rate()
+    bot.cancel_open_orders(symbol)
 
-    logger.info('funding rate: %.4f%%' % (funding_rate * 100))
+    funding_rate = bot.get_funding_rate(symbol)
+
+    logger.info('%s funding rate: %.4f%%' % (symbol, funding_rate * 100))
 
     if funding_rate < 0:
         side = 'Buy'
-        quantity = settings.POSITION_SIZE_BUY
+        quantity = state.size_buy
     else:
         side = 'Sell'
-        quantity = settings.POSITION_SIZE_SELL
-    
-    bot.enter_position(side, quantity, market=False)
+        quantity = state.size_sell
 
+    bot.enter_position(side, quantity, market=False, symbol=symbol)
 
-def funding_over(bot: FundingBot) -> None:
-    """funding is over, exit all positions"""
 
-    sleep(1)
-    
-    bot.exit_position(market=False, wait_for_fill=True)
+def funding_over(bot: FundingBot, symbol: str) -> None:
+    """funding is over, exit the symbol's position"""
+
+    bot.exit_position(market=False, wait_for_fill=True, symbol=symbol)
+
+
+def run_threaded(job, bot: FundingBot, symbol: str) -> None:
+    """run a funding job on its own thread, so one symbol waiting for a fill doesn't hold up
+    the jobs of every other symbol and bot on the same scheduler
+    """
+
+    thread = threading.Thread(target=job, args=(bot, symbol))
+    thread.daemon = True
+    thread.start()
+
+
+def schedule_funding(scheduler: FundingScheduler, bot: FundingBot, tag=None,
+                     jobs=(half_funding, funding_over), run=run_threaded) -> None:
+    """add a bot's funding jobs to a scheduler; tag them to clear them again later
+
+    jobs are the (entry, exit) pair, and run(job, bot, symbol) starts one when it's due
+    """
+
+    scheduler.add(bot, jobs, run, tag)
 
 
 def main() -> None:
     """place bitmex orders based on current funding rate
 
-    if 4 hours until funding: enter a position
+    a little over 4 hours before funding: enter a position
     if funding is negative, go long
     if funding is positive, go short
     if the price moves negatively 1.5% away from a position, exit the position
@@ -63,28 +79,11 @@ def main() -> None:
     signal.signal(signal.SIGTERM, bot.exit)
     signal.signal(signal.SIGINT, bot.exit)
     
-    def convert_utc(utc_time : str) -> str:
-        utc = datetime.strptime(utc_time, '%H:%M')
+    scheduler = FundingScheduler()
 
-        utc = utc.replace(tzinfo=tz.tzutc())
+    schedule_funding(scheduler, bot)
 
-        local = utc.astimezone(tz.tzlocal())
-
-        return local.strftime('%H:%M')
-
-    schedule.every().day.at(convert_utc('23:50')).do(half_funding, bot)
-    schedule.every().day.at(convert_utc('04:00')).do(funding_over, bot)
-    schedule.every().day.at(convert_utc('07:50')).do(half_funding, bot)
-    schedule.every().day.at(convert_utc('12:00')).do(funding_over, bot)
-    schedule.every().day.at(convert_utc('15:50')).do(half_funding, bot)
-    schedule.every().day.at(convert_utc('20:00')).do(funding_over, bot)
-
-    def run_scheduled() -> None:
-        while True:
-            schedule.run_pending()
-            sleep(1)
-    
-    sched = threading.Thread(target=run_scheduled)
+    sched = threading.Thread(target=scheduler.run)
     sched.daemon = True
     sched.start()
     
@@ -0,0 +1,230 @@
+"""search strategy settings with the backtester, on every core
+
+    python3 sweep.py --synthetic 365 --grid STOP_LIMIT_MULTIPLIER=.01,.015,.02 --grid HEDGE_MULTIPLIER=0,.5,1
+    python3 sweep.py --funding funding.csv --prices trades.csv --random 500 \\
+        --space STOP_LIMIT_MULTIPLIER=.005:.03 --space STOP_MARKET_MULTIPLIER=.01:.04
+
+--grid KEY=a,b,c tries every combination of the listed values; --random N draws N settings
+with each --space KEY=low:high uniform (whole numbers if both ends are). values with a '|'
+are per symbol, as in settings.py. anything not searched comes from settings.py
+
+the price and funding arrays are put in shared memory once, and every worker process
+backtests on views of them, so tasks only carry the settings they try. results are ranked
+by pnl, then drawdown
+"""
+
+import argparse
+import csv
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+from multiprocessing import shared_memory
+import os
+import random
+import time
+
+import numpy as np
+
+from market_maker.settings import settings
+from market_maker.utils.dotdict import dotdict
+
+import backtest
+
+
+# the settings a sweep is meant for; others work too
+KEYS = ('POSITION_SIZE_BUY', 'POSITION_SIZE_SELL', 'HEDGE_MULTIPLIER',
+        'STOP_LIMIT_MULTIPLIER', 'STOP_MARKET_MULTIPLIER')
+
+ARRAYS = ('funding_times', 'funding_rates', 'times', 'open', 'high', 'low')
+
+# filled in each worker by attach()
+_markets = None
+_memory = None
+
+
+def share(markets: dict) -> tuple:
+    """copy every market's arrays into one shared memory block
+
+    returns the block and a layout (symbol -> array -> (offset, length)) to find them again
+    """
+
+    layout = {}
+    offset = 0
+
+    for symbol, market in markets.items():
+        layout[symbol] = {}
+
+        for name in ARRAYS:
+            length = len(getattr(market, name))
+
+            layout[symbol][name] = (offset, length)
+
+            offset += length
+
+    memory = shared_memory.SharedMemory(create=True, size=max(offset, 1) * 8)
+
+    block = np.ndarray(offset, dtype=np.float64, buffer=memory.buf)
+
+    for symbol, market in markets.items():
+        for name, (start, length) in layout[symbol].items():
+            block[start:start + length] = getattr(market, name)
+
+    return memory, layout
+
+
+def attach(name: str, layout: dict) -> None:
+    """worker initializer: rebuild the markets as views on the shared block"""
+
+    global _markets, _memory
+
+    _memory = shared_memory.SharedMemory(name=name)
+
+    block = np.ndarray(sum(length for arrays in layout.values() for _, length in arrays.values()),
+                       dtype=np.float64, buffer=_memory.buf)
+
+    _markets = {}
+
+    for symbol, arrays in layout.items():
+        views = [block[start:start + length] for start, length in (arrays[name] for name in ARRAYS)]
+
+        _markets[symbol] = backtest.Market(symbol, *views)
+
+
+def evaluate(overrides: dict) -> tuple:
+    config = dotdict(settings)
+    config.update(overrides)
+
+    return overrides, backtest.backtest(_markets, config)['summary']
+
+
+def parse_value(value: str):
+    if '|' in value:
+        return value
+
+    number = float(value)
+
+    return int(number) if number.is_integer() and '.' not in value else number
+
+
+def grid(specs: list) -> list:
+    keys, values = [], []
+
+    for spec in specs:
+        key, _, listed = spec.partition('=')
+
+        keys.append(key)
+        values.append([parse_value(v) for v in listed.split(',')])
+
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+
+def random_space(specs: list, count: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+
+    ranges = []
+
+    for spec in specs:
+        key, _, bounds = spec.partition('=')
+        low, high = (parse_value(v) for v in bounds.split(':'))
+
+        ranges.append((key, low, high))
+
+    return [{key: rng.randint(low, high) if isinstance(low, int) and isinstance(high, int)
+             else rng.uniform(low, high) for key, low, high in ranges} for _ in range(count)]
+
+
+def sweep(markets: dict, candidates: list, workers: int = None) -> list:
+    """backtest every candidate set of overrides; returns (overrides, summary) best first"""
+
+    memory, layout = share(markets)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=attach,
+                                 initargs=(memory.name, layout)) as pool:
+            chunksize = max(1, len(candidates) // (4 * (workers or os.cpu_count() or 1)))
+
+            results = list(pool.map(evaluate, candidates, chunksize=chunksize))
+    finally:
+        memory.close()
+        memory.unlink()
+
+    return sorted(results, key=lambda r: (-r[1]['pnl'], r[1]['max_drawdown']))
+
+
+def print_table(results: list, top: int) -> None:
+    keys = list(results[0][0]) if results else []
+
+    print(' '.join(['rank'] + keys + ['%10s' % 'pnl', '%10s' % 'funding', '%7s' % 'max dd', '%5s' % 'stops']))
+
+    for rank, (overrides, summary) in enumerate(results[:top], 1):
+        print(' '.join(['%4i' % rank] + ['%*s' % (len(key), format_value(overrides[key])) for key in keys] +
+                       ['%+10.5f' % summary['pnl'], '%+10.5f' % summary['funding'],
+                        '%6.2f%%' % (summary['max_drawdown'] * 100), '%5i' % summary['stops']]))
+
+
+def format_value(value) -> str:
+    return '%.5g' % value if isinstance(value, float) else str(value)
+
+
+def write_csv(path: str, results: list) -> None:
+    keys = list(results[0][0]) if results else []
+    columns = list(results[0][1]) if results else []
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+
+        writer.writerow(['rank'] + keys + columns)
+
+        for rank, (overrides, summary) in enumerate(results, 1):
+            writer.writerow([rank] + [overrides[key] for key in keys] + [summary[column] for column in columns])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='search strategy settings with backtest.py')
+    parser.add_argument('--funding', help='funding history (csv or parquet)')
+    parser.add_argument('--prices', help='bars or trades (csv or parquet)')
+    parser.add_argument('--synthetic', type=int, metavar='DAYS', help='use random data instead')
+    parser.add_argument('--symbols', help="e.g. 'XBTUSD|ETHUSD'; defaults to settings.SYMBOL")
+    parser.add_argument('--grid', action='append', default=[], metavar='KEY=a,b,c')
+    parser.add_argument('--random', type=int, metavar='N', help='draw N settings from the --space ranges')
+    parser.add_argument('--space', action='append', default=[], metavar='KEY=low:high')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, help='processes to use; defaults to one per core')
+    parser.add_argument('--top', type=int, default=20, help='rows of the ranking to print')
+    parser.add_argument('--csv', help='write every result to this file')
+    args = parser.parse_args()
+
+    symbols = (args.symbols or settings.SYMBOL).split('|')
+
+    if args.synthetic:
+        markets = backtest.synthetic_markets(args.synthetic, symbols)
+    elif args.funding and args.prices:
+        markets = backtest.load_markets(args.funding, args.prices, symbols)
+    else:
+        parser.error('give --funding and --prices, or --synthetic')
+
+    if args.random:
+        candidates = random_space(args.space, args.random, args.seed)
+    elif args.grid:
+        candidates = grid(args.grid)
+    else:
+        parser.error('give --grid, or --random with --space')
+
+    for key in set(key for candidate in candidates for key in candidate) - set(KEYS):
+        print('note: %s is not one of %s' % (key, ', '.join(KEYS)))
+
+    start = time.perf_counter()
+
+    results = sweep(markets, candidates, args.workers)
+
+    elapsed = time.perf_counter() - start
+
+    print_table(results, args.top)
+
+    print('%i settings in %.2fs on %i processes' % (len(results), elapsed, args.workers or os.cpu_count()))
+
+    if args.csv:
+        write_csv(args.csv, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+import threading
+
+import pytest
+
+from market_maker.sim.engine import MatchingEngine
+from market_maker.sim.server import SimServer
+
+
+@pytest.fixture
+def sim():
+    """A local BitMEX stand-in on a free port, with no market feed: only our orders move it."""
+    server = SimServer(('127.0.0.1', 0), MatchingEngine())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
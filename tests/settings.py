@@ -0,0 +1,10 @@
+# Settings the tests are run under, in place of the settings.py a bot is started with. Only
+# what differs from market_maker/_settings_base.py; connectors under test are given the
+# simulator's URL directly.
+import logging
+
+API_KEY = 'key'
+API_SECRET = 'secret'
+LOG_LEVEL = logging.WARNING
+STATE_DIR = None
+JOURNAL_PATH = None
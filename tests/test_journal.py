@@ -0,0 +1,113 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from journal import Journal
+from market_maker.utils import constants
+
+FUNDING = datetime(2020, 1, 1, 8)
+
+# a window ends this long after its funding payment
+SETTLE = 120
+
+
+def at(seconds):
+    """an ISO timestamp seconds after FUNDING"""
+    return (FUNDING + timedelta(seconds=seconds)).isoformat(timespec='milliseconds') + 'Z'
+
+
+def fill(id, seconds, side, qty, price, fee=0, account='bot', symbol='XBTUSD'):
+    # signed as BitMEX signs execCost on an inverse contract: negative buying, positive selling
+    cost = int(round((qty if side == 'Buy' else -qty) * -constants.XBt_TO_XBT / price))
+    return account, {'execID': id, 'transactTime': at(seconds), 'symbol': symbol, 'execType': 'Trade',
+                     'side': side, 'lastQty': qty, 'lastPx': price, 'execCost': cost, 'execComm': fee}
+
+
+def payment(id, seconds, received, account='bot', symbol='XBTUSD'):
+    # execComm is what was paid, so negative when funding was received
+    return account, {'execID': id, 'transactTime': at(seconds), 'symbol': symbol, 'execType': 'Funding',
+                     'lastQty': 0, 'execCost': 0, 'execComm': -received}
+
+
+def inverse(qty, entry, exit):
+    """what a long of qty contracts from entry to exit makes, in XBT"""
+    return round(qty * constants.XBt_TO_XBT / entry) / constants.XBt_TO_XBT - \
+        round(qty * constants.XBt_TO_XBT / exit) / constants.XBt_TO_XBT
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = Journal(str(tmp_path / 'journal.db'))
+    yield journal
+    journal.close()
+
+
+def record(journal, *executions):
+    for account, row in executions:
+        journal.record(account, [row])
+    assert journal.flush(5)
+
+
+def test_a_window_holds_the_fills_around_its_funding(journal):
+    record(journal,
+           fill('a', -4 * 3600, 'Buy', 100, 10000.0, fee=50),
+           payment('b', 0, 700),
+           fill('c', 5, 'Sell', 100, 11000.0, fee=40))
+
+    window, = journal.windows(settle=SETTLE)
+
+    assert window['funding_time'] == pytest.approx(journal.executions()[1]['timestamp'])
+    assert (window['fills'], window['traded']) == (2, 200)
+    assert window['realised'] == pytest.approx(inverse(100, 10000.0, 11000.0))
+    assert window['fees'] == pytest.approx(90 / constants.XBt_TO_XBT)
+    assert window['funding'] == pytest.approx(700 / constants.XBt_TO_XBT)
+    assert window['pnl'] == pytest.approx(window['realised'] - window['fees'] + window['funding'])
+
+
+def test_a_position_carried_over_is_realised_in_the_window_it_closes(journal):
+    record(journal,
+           fill('a', -60, 'Buy', 100, 10000.0),
+           payment('b', 0, 100),
+           payment('c', 8 * 3600, 100),
+           fill('d', 8 * 3600 + 5, 'Sell', 100, 9000.0))
+
+    first, second = journal.windows(settle=SETTLE)
+
+    assert first['realised'] == 0
+    assert second['realised'] == pytest.approx(inverse(100, 10000.0, 9000.0))
+    assert second['realised'] < 0
+
+
+def test_a_fill_that_flips_the_position_realises_only_what_it_closes(journal):
+    record(journal,
+           fill('a', -60, 'Buy', 100, 10000.0),
+           payment('b', 0, 0),
+           fill('c', 5, 'Sell', 150, 11000.0),
+           # the 50 short from the flip, covered lower
+           fill('d', 10, 'Buy', 50, 10000.0))
+
+    window, = journal.windows(settle=SETTLE)
+
+    # the short's entry cost is the flipping fill's, prorated; allow for its rounding to a satoshi
+    expected = inverse(100, 10000.0, 11000.0) + inverse(50, 10000.0, 11000.0)
+    assert window['realised'] == pytest.approx(expected, abs=2 / constants.XBt_TO_XBT)
+
+
+def test_fills_after_the_last_funding_make_an_open_window(journal):
+    record(journal,
+           payment('a', 0, 100),
+           fill('b', 3600, 'Buy', 100, 10000.0),
+           fill('c', 3600, 'Buy', 100, 10000.0, account='other'))
+
+    closed, opened = journal.windows(account='bot', settle=SETTLE)
+
+    assert closed['funding_time'] is not None and closed['fills'] == 0
+    assert opened['funding_time'] is None and opened['fills'] == 1
+    # since keeps the open window, and the ones whose funding is at or after it
+    assert journal.windows(account='bot', since=closed['funding_time'] + 1, settle=SETTLE) == [opened]
+
+
+def test_rows_are_journalled_once(journal):
+    record(journal, fill('a', 0, 'Buy', 100, 10000.0), fill('a', 0, 'Buy', 100, 10000.0))
+
+    assert len(journal.executions()) == 1
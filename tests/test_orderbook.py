@@ -0,0 +1,119 @@
+import json
+import random
+
+from market_maker.ws.orderbook import OrderBook, SymbolBook, synthetic_stream
+
+
+def level(id, side, price, size):
+    return {'symbol': 'XBTUSD', 'id': id, 'side': side, 'price': price, 'size': size}
+
+
+def book_of(*rows):
+    book = SymbolBook('XBTUSD')
+    for row in rows:
+        book.insert(dict(row))
+    return book
+
+
+def test_insert_keeps_each_side_sorted():
+    book = book_of(level(1, 'Buy', 99.0, 10), level(2, 'Buy', 100.0, 20), level(3, 'Buy', 98.0, 30),
+                   level(4, 'Sell', 102.0, 40), level(5, 'Sell', 101.0, 50))
+
+    assert book.best_bid() == (100.0, 20)
+    assert book.best_ask() == (101.0, 50)
+    assert [book.level('Buy', n) for n in range(4)] == [(100.0, 20), (99.0, 10), (98.0, 30), None]
+    assert book.depth('Buy', 2) == 30
+    assert len(book) == 5
+
+
+def test_update_without_a_price_changes_the_size_in_place():
+    book = book_of(level(1, 'Buy', 100.0, 10))
+
+    book.update({'symbol': 'XBTUSD', 'id': 1, 'side': 'Buy', 'size': 25})
+
+    assert book.best_bid() == (100.0, 25)
+    assert book.prices['Buy'] == [100.0]
+
+
+def test_update_with_a_new_price_moves_the_level():
+    book = book_of(level(1, 'Buy', 100.0, 10), level(2, 'Buy', 99.0, 20))
+
+    book.update({'symbol': 'XBTUSD', 'id': 1, 'side': 'Buy', 'price': 98.5, 'size': 15})
+
+    assert book.prices['Buy'] == [98.5, 99.0]
+    assert book.best_bid() == (99.0, 20)
+    assert book.level('Buy', 1) == (98.5, 15)
+    assert 100.0 not in book.levels['Buy']
+    assert book.rows[(1, 'Buy')]['price'] == 98.5
+
+
+def test_remove_drops_the_level():
+    book = book_of(level(1, 'Sell', 101.0, 10), level(2, 'Sell', 102.0, 20))
+
+    book.remove({'symbol': 'XBTUSD', 'id': 1, 'side': 'Sell'})
+    # Removing one that isn't there is a no-op
+    book.remove({'symbol': 'XBTUSD', 'id': 7, 'side': 'Sell'})
+
+    assert book.best_ask() == (102.0, 20)
+    assert book.prices['Sell'] == [102.0]
+    assert len(book) == 1
+
+
+def test_inserting_an_id_again_replaces_its_level():
+    book = book_of(level(1, 'Buy', 100.0, 10))
+
+    book.insert(level(1, 'Buy', 99.5, 30))
+
+    assert book.prices['Buy'] == [99.5]
+    assert book.best_bid() == (99.5, 30)
+
+
+def test_sweep_walks_the_book_best_first():
+    book = book_of(level(1, 'Sell', 101.0, 10), level(2, 'Sell', 102.0, 10), level(3, 'Sell', 103.0, 10))
+
+    assert book.sweep('Sell', 15) == ((101.0 * 10 + 102.0 * 5) / 15, 102.0, 15)
+    assert book.sweep('Sell', 50) == (102.0, 103.0, 30)
+
+
+def test_order_book_ignores_updates_before_the_partial_and_resets_on_one():
+    books = OrderBook()
+    books.apply('update', [{'symbol': 'XBTUSD', 'id': 1, 'side': 'Buy', 'size': 5}])
+    assert books.book('XBTUSD') is None
+
+    books.apply('partial', [level(1, 'Buy', 100.0, 10)])
+    books.apply('insert', [level(2, 'Buy', 101.0, 10)])
+    books.apply('partial', [level(3, 'Buy', 99.0, 10)])
+
+    assert books.book('XBTUSD').prices['Buy'] == [99.0]
+
+
+def test_matches_a_plain_dict_of_rows_under_random_changes():
+    rng = random.Random(7)
+    books = OrderBook()
+    # (id, side) -> row; sorted at the end to check the book against
+    expected = {}
+
+    frames = [json.loads(frame) for frame in synthetic_stream(50, 2000)]
+    for i, frame in enumerate(frames):
+        if frame['action'] == 'update' and rng.random() < 0.2:
+            # The synthetic stream never moves a level; have some updates carry a new price, off the
+            # tick grid so it can't land on another level's
+            row = expected[(frame['data'][0]['id'], frame['data'][0]['side'])]
+            frame['data'][0]['price'] = row['price'] + rng.choice([-1, 1]) * 0.25 + i * 1e-6
+        books.apply(frame['action'], frame['data'])
+
+        for data in frame['data']:
+            key = (data['id'], data['side'])
+            if frame['action'] in ('partial', 'insert'):
+                expected[key] = dict(data)
+            elif frame['action'] == 'update':
+                expected[key].update(data)
+            else:
+                del expected[key]
+
+    book = books.book('XBTUSD')
+    for side, best_first in [('Buy', True), ('Sell', False)]:
+        rows = sorted((row for (id, s), row in expected.items() if s == side),
+                      key=lambda row: row['price'], reverse=best_first)
+        assert [book.level(side, n) for n in range(len(rows))] == [(row['price'], row['size']) for row in rows]
+    assert len(book) == len(expected)
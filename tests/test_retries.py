@@ -0,0 +1,200 @@
+"""Order requests whose outcome is unknown (lost responses, duplicate clOrdIDs) are resolved
+against the order table, and only what didn't go through is sent again."""
+import asyncio
+import json
+
+import pytest
+import requests
+from requests.adapters import HTTPAdapter
+
+from market_maker.async_bitmex import AsyncBitMEX, aiohttp
+from market_maker.bitmex import BitMEX
+
+
+class FlakyAdapter(HTTPAdapter):
+
+    """Sends requests to the simulator, but can lose the response or part of a bulk request on the way."""
+
+    def __init__(self):
+        super(FlakyAdapter, self).__init__()
+        self.fault = None
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        body = json.loads(request.body) if request.body else None
+        self.sent.append((request.method, request.path_url.split('?')[0], body))
+        fault, self.fault = self.fault, None
+
+        if fault == 'partial':
+            # Only the first order gets there, and the response never comes back
+            request.prepare_body(json.dumps(dict(body, orders=body['orders'][:1])).encode('utf8'), None)
+            super(FlakyAdapter, self).send(request, **kwargs)
+            raise requests.exceptions.ReadTimeout('lost after the first order')
+
+        response = super(FlakyAdapter, self).send(request, **kwargs)
+        if fault == 'lost':
+            raise requests.exceptions.ReadTimeout('lost response')
+        return response
+
+
+@pytest.fixture
+def adapter():
+    return FlakyAdapter()
+
+
+@pytest.fixture
+def bitmex(sim, adapter):
+    session = requests.Session()
+    session.mount('http://', adapter)
+    bitmex = BitMEX(base_url=sim.base_url, symbols=['XBTUSD'], apiKey='key', apiSecret='secret',
+                    orderIDPrefix='test_', session=session, timeout=2)
+    # Orders that didn't go through are only known to be missing once this runs out
+    bitmex.RESOLVE_TIMEOUT = 0.5
+    yield bitmex
+    bitmex.exit()
+
+
+def bids(n):
+    # Well under the market, so they rest
+    return [{'symbol': 'XBTUSD', 'side': 'Buy', 'orderQty': 100, 'price': 9000.0 - i} for i in range(n)]
+
+
+def posts(adapter):
+    return [body for verb, path, body in adapter.sent if verb == 'POST']
+
+
+def resting(sim):
+    return sorted(o['clOrdID'] for o in sim.engine.get_orders())
+
+
+def test_lost_response_after_every_order_landed(sim, adapter, bitmex):
+    orders = bids(2)
+    adapter.fault = 'lost'
+
+    result = bitmex.create_bulk_orders(orders)
+
+    assert len(posts(adapter)) == 1
+    assert [row['clOrdID'] for row in result] == [order['clOrdID'] for order in orders]
+    assert resting(sim) == sorted(order['clOrdID'] for order in orders)
+
+
+def test_lost_response_after_some_orders_landed(sim, adapter, bitmex):
+    orders = bids(3)
+    adapter.fault = 'partial'
+
+    result = bitmex.create_bulk_orders(orders)
+
+    first, second = posts(adapter)
+    # Only the orders the order table didn't show are sent again, under the same clOrdIDs
+    assert [order['clOrdID'] for order in second['orders']] == [order['clOrdID'] for order in orders[1:]]
+    assert [row['clOrdID'] for row in result] == [order['clOrdID'] for order in orders]
+    assert resting(sim) == sorted(order['clOrdID'] for order in orders)
+
+
+def test_lost_response_to_an_amend(sim, adapter, bitmex):
+    row, = bitmex.create_bulk_orders(bids(1))
+    adapter.fault = 'lost'
+
+    result = bitmex.amend_bulk_orders([{'orderID': row['orderID'], 'price': 8500.0}])
+
+    assert [verb for verb, path, body in adapter.sent].count('PUT') == 1
+    assert result[0]['price'] == 8500.0
+    assert sim.engine.get_orders()[0]['price'] == 8500.0
+
+
+def test_duplicate_clordid_returns_the_orders_already_placed(sim, adapter, bitmex):
+    orders = bids(2)
+    placed = bitmex.create_bulk_orders(orders)
+
+    result = bitmex.create_bulk_orders(orders)
+
+    assert [row['orderID'] for row in result] == [row['orderID'] for row in placed]
+    assert len(resting(sim)) == 2
+
+
+def test_duplicate_clordid_looks_up_orders_the_table_has_not_shown(sim, adapter, bitmex):
+    orders = bids(2)
+    placed = bitmex.create_bulk_orders(orders)
+    # Their inserts can come down after the response; once they have, nothing will put them back
+    assert bitmex.ws.wait_for_orders(
+        lambda: all(bitmex.ws.find_order(clOrdID=order['clOrdID']) for order in orders), 5)
+    # As after a reconnect: the new websocket never saw them being placed
+    bitmex.ws._recent_clOrdIDs.clear()
+    bitmex.RESOLVE_TIMEOUT = 0
+
+    result = bitmex.create_bulk_orders(orders)
+
+    assert adapter.sent[-1][:2] == ('GET', '/api/v1/order')
+    assert [row['orderID'] for row in result] == [row['orderID'] for row in placed]
+
+
+def test_duplicate_clordid_for_a_different_order_raises(sim, adapter, bitmex):
+    orders = bids(1)
+    bitmex.create_bulk_orders(orders)
+
+    with pytest.raises(Exception, match='did not match POST'):
+        bitmex.create_bulk_orders([dict(orders[0], price=8000.0)])
+
+    assert len(resting(sim)) == 1
+
+
+class FlakySession(object):
+
+    """An aiohttp session that can lose the response to, or part of, a bulk order request."""
+
+    def __init__(self, session):
+        self.session = session
+        self.fault = None
+        self.sent = []
+
+    def request(self, verb, url, data=None, **kwargs):
+        body = json.loads(data) if data else None
+        self.sent.append((verb, body))
+        fault, self.fault = self.fault, None
+        if fault is None:
+            return self.session.request(verb, url, data=data, **kwargs)
+        if fault == 'partial':
+            data = json.dumps(dict(body, orders=body['orders'][:1])).encode('utf8')
+        return LostResponse(self.session.request(verb, url, data=data, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+class LostResponse(object):
+
+    def __init__(self, request):
+        self.request = request
+
+    async def __aenter__(self):
+        async with self.request:
+            pass
+        raise asyncio.TimeoutError()
+
+    async def __aexit__(self, *args):
+        pass
+
+
+@pytest.mark.skipif(aiohttp is None, reason='needs aiohttp')
+@pytest.mark.parametrize('fault', ['lost', 'partial'])
+def test_async_lost_response(sim, fault):
+    async def run():
+        session = FlakySession(aiohttp.ClientSession())
+        bitmex = AsyncBitMEX(base_url=sim.base_url, symbols=['XBTUSD'], apiKey='key', apiSecret='secret',
+                             orderIDPrefix='test_', session=session, timeout=2)
+        bitmex.RESOLVE_TIMEOUT = 0.5
+        await bitmex.connect()
+        try:
+            orders = bids(3)
+            session.fault = fault
+
+            result = await bitmex.create_bulk_orders(orders)
+
+            assert len(session.sent) == (1 if fault == 'lost' else 2)
+            assert [row['clOrdID'] for row in result] == [order['clOrdID'] for order in orders]
+            assert resting(sim) == sorted(order['clOrdID'] for order in orders)
+        finally:
+            await bitmex.close()
+            await session.session.close()
+
+    asyncio.run(run())